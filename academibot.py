@@ -5,39 +5,132 @@ Email bot for managing classes, including assignment submission, gradebook
 management, and automatic grading.
 """
 
-import mail
 import storage
+import grader
 import commands
 import config
+import ratelimit
+import stats
+import tracelog
+import admission
+import surge
 import traceback
 import sys
+import asyncio
+import collections
+import threading
+import signal
+import concurrent.futures
+import queue
+import zlib
+import hashlib
+import weakref
 
 import time
 
 CONTEXT = "unknown"
 
-LOG = None
+# Set by request_shutdown to make run_server finish up and exit
+SHUTDOWN = threading.Event()
+
+# The event that the current wait_for_channels call is waiting on (if any),
+# so that a shutdown request can cut the wait short
+WAITING = None
+
+def request_shutdown(signum=None, frame=None):
+  """
+  Asks run_server to stop checking for messages and shut down once the work
+  it has already taken on is finished (see finish_work). Installed as the
+  SIGTERM and SIGINT handler; a second signal stops right away.
+  """
+  if SHUTDOWN.is_set():
+    raise KeyboardInterrupt
+  SHUTDOWN.set()
+  waiting = WAITING
+  if waiting != None:
+    waiting.set()
 
 def log(message, end="\n"):
-  global LOG
-  LOG = LOG or open(config.LOGFILE, 'a')
-  LOG.write(message + end)
-  LOG.flush()
+  tracelog.write(message + end)
 
 def done_logging():
-  global LOG
-  if LOG:
-    LOG.close()
+  tracelog.close()
 
 def process(sender, body, reply_function, now):
+  commands.run_sync(process_async(sender, body, reply_function, now))
+
+async def process_async(sender, body, reply_function, now):
   log(
     "Processing message received at {} from '{}':\n{}".format(
       now,
       sender,
-      body
+      tracelog.truncate(body)
     )
   )
   user = sender.lower()
+  message_id = getattr(reply_function, "message_id", None)
+  if message_id in (None, "?"):
+    message_id = None
+  else:
+    digest = hashlib.sha256(body.encode()).hexdigest()
+    if storage.message_processed(message_id, digest):
+      log(" ...already processed {}; skipping...".format(message_id))
+      stats.count("ledger.skipped")
+      return
+  # The commands' effects, their replies (for channels that queue replies in
+  # the outbox) and the ledger entry are committed together, so a crash
+  # can't leave a command done but unanswered or unrecorded.
+  turn = WriteTurn()
+  try:
+    with storage.transaction():
+      await handle_message(user, sender, body, reply_function, now, turn)
+      await turn.take()
+      if message_id:
+        storage.record_processed(message_id, digest, user, now)
+  finally:
+    turn.release()
+
+class WriteTurn:
+  """
+  Makes the messages processed on one event loop take turns writing to the
+  database. Each message has its own transaction (see storage.transaction),
+  but SQLite allows only one writer at a time, so if a message holding the
+  write lock waits (at an await) while another message on the loop tries to
+  write, the second one blocks the loop's thread and the first can never
+  finish. So a message takes the loop's turn before it writes anything and
+  keeps it until its transaction has ended.
+  """
+  def __init__(self):
+    self.lock = TURNS.setdefault(asyncio.get_running_loop(), asyncio.Lock())
+    self.held = False
+
+  async def take(self):
+    if not self.held:
+      await self.lock.acquire()
+      self.held = True
+
+  def release(self):
+    if self.held:
+      self.lock.release()
+      self.held = False
+
+# Maps event loops to the locks behind their WriteTurns.
+TURNS = weakref.WeakKeyDictionary()
+
+async def handle_message(user, sender, body, reply_function, now, turn):
+  # Messages whose commands only read (like ':help') can run alongside a
+  # writing message until they reply.
+  if not commands.read_only(body):
+    await turn.take()
+  if surge.applies(user, body, now):
+    if storage.status(user) != "blocking":
+      log(" ...logging submission for later (deadline surge)...")
+      surge.defer(user, body, now, reply_function)
+    return
+  if surge.waiting(user) and storage.status(user) != "blocking":
+    log(" ...logging message for later (after logged submissions)...")
+    surge.defer(user, body, now, reply_function, receipt=False)
+    return
   log(" ...parsing commands...")
   cmds = commands.parse(body)
   log(" ...commands parsed...")
@@ -50,16 +143,353 @@ def process(sender, body, reply_function, now):
       return
   if cmds:
     log(" ...handling commands...")
-    response = commands.handle_commands(user, body, cmds, now)
+    response = await commands.handle_commands_async(user, body, cmds, now)
     log(" ...response created...")
+    await turn.take()
     log(
       "Sending response to '{}':\n{}".format(
         sender,
-        response
+        tracelog.truncate(response)
       )
     )
     reply_function(response)
 
+async def process_guarded(sender, body, rf, now):
+  try:
+    await process_async(sender, body, rf, now)
+  except Exception as e:
+    print("Error while...")
+    print(CONTEXT)
+    #print(e)
+    traceback.print_exc()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log(
+      "Error while {}:\n{}".format(
+        CONTEXT[3:-3],
+        traceback.format_exc()
+      )
+    )
+    print("...error processing message; reporting to user...")
+    log("...reporting error to user...")
+    turn = WriteTurn() # replying may write to the outbox
+    await turn.take()
+    try:
+      rf(
+        """
+Academibot encountered an error while trying to to process your message.
+
+Please either re-send your message with different data or try to contact an
+instructor about what you should do.
+
+The message you sent was:
+
+{}
+""".format(body)
+      )
+    finally:
+      turn.release()
+    print("...done reporting; ignoring message...")
+    sys.stdout.flush()
+    sys.stderr.flush()
+    log("...done reporting error; ignoring message...")
+
+async def process_in_order(messages, now):
+  for sender, body, rf in messages:
+    await process_guarded(sender, body, rf, now)
+
+def process_all(messages, now):
+  """
+  Processes a batch of (sender, body, reply_function) messages on an event
+  loop. Messages from the same sender are processed one at a time in order,
+  while messages from different senders run concurrently (whenever a command
+  handler awaits something, commands for other senders get to run, though
+  only one message at a time may write; see WriteTurn).
+  """
+  by_sender = collections.OrderedDict()
+  for m in messages:
+    by_sender.setdefault(m[0].lower(), []).append(m)
+
+  async def run_all():
+    await asyncio.gather(
+      *(process_in_order(ms, now) for ms in by_sender.values())
+    )
+
+  commands.run_sync(run_all())
+
+class Dispatcher:
+  """
+  Processes messages on a pool of worker threads. Each sender is hashed onto
+  a single worker, so a sender's messages are processed one at a time in the
+  order they arrived, while different senders' messages run in parallel.
+  The number of messages waiting or in progress is recorded in the
+  'dispatch.queue-depth' statistics gauge.
+  """
+  def __init__(self, workers=None):
+    self.queues = [ queue.Queue() for i in range(workers or config.WORKERS) ]
+    self.depth = 0
+    self.done = threading.Condition()
+    self.errors = []
+    self.workers = [
+      threading.Thread(target=self.work, args=(q,), daemon=True)
+        for q in self.queues
+    ]
+    for w in self.workers:
+      w.start()
+
+  def submit(self, messages, now):
+    """
+    Queues a batch of (sender, body, reply_function) messages received at
+    the given time.
+    """
+    self.submit_received([ (m, now) for m in messages ])
+
+  def submit_received(self, items):
+    """
+    Queues a batch of ((sender, body, reply_function), received) pairs, where
+    received is the time each message was received.
+    """
+    with self.done:
+      self.depth += len(items)
+      stats.gauge("dispatch.queue-depth", self.depth)
+    for m, received in items:
+      self.queues[self.worker_for(m[0])].put((m, received))
+
+  def call(self, sender, function):
+    """
+    Runs function() on the given sender's worker, after any of that sender's
+    messages already queued, counting it as a queued message. Returns a
+    concurrent.futures.Future for its result.
+    """
+    future = concurrent.futures.Future()
+    def run():
+      if future.set_running_or_notify_cancel():
+        try:
+          future.set_result(function())
+        except BaseException as e:
+          future.set_exception(e)
+    with self.done:
+      self.depth += 1
+      stats.gauge("dispatch.queue-depth", self.depth)
+    self.queues[self.worker_for(sender)].put(run)
+    return future
+
+  def worker_for(self, sender):
+    return zlib.crc32(sender.lower().encode()) % len(self.queues)
+
+  def work(self, q):
+    loop = asyncio.new_event_loop()
+    while True:
+      item = q.get()
+      if item == None:
+        break
+      if callable(item): # see call
+        item()
+      else:
+        (sender, body, rf), now = item
+        try:
+          loop.run_until_complete(process_guarded(sender, body, rf, now))
+        except BaseException as e: # e.g., SystemExit; re-raised by wait
+          self.errors.append(e)
+      with self.done:
+        self.depth -= 1
+        stats.gauge("dispatch.queue-depth", self.depth)
+        self.done.notify_all()
+    loop.close()
+
+  def wait(self, timeout=None):
+    """
+    Waits until every queued message has been processed, or until the
+    timeout expires. Returns True if the queues are empty. Messages that are
+    still being processed carry on in the background.
+    """
+    with self.done:
+      self.done.wait_for(lambda: self.depth == 0 or self.errors, timeout)
+      if self.errors:
+        raise self.errors.pop(0)
+      return self.depth == 0
+
+  def shutdown(self):
+    for q in self.queues:
+      q.put(None)
+
+def wait_for_channels(channels, timeout):
+  """
+  Waits until any of the given channels reports new messages, until the
+  timeout expires, or until shutdown is requested. Returns True if a channel
+  reported new messages.
+  """
+  global WAITING
+  stop = threading.Event()
+  WAITING = stop
+  if SHUTDOWN.is_set():
+    return False
+  if not channels:
+    stop.wait(timeout)
+    return False
+  if len(channels) == 1:
+    return channels[0].wait(timeout, stop)
+  def watch(c):
+    if c.wait(timeout, stop):
+      stop.set()
+  watchers = [ threading.Thread(target=watch, args=(c,)) for c in channels ]
+  for w in watchers:
+    w.start()
+  for w in watchers:
+    w.join()
+  return stop.is_set() and not SHUTDOWN.is_set()
+
+class ChannelPool:
+  """
+  Polls and flushes channels concurrently on a bounded thread pool. A channel
+  call that doesn't finish within the timeout only delays that channel: it's
+  left running, the channel is skipped until it finishes, and its result is
+  collected in a later cycle.
+  """
+  def __init__(self, channels, workers=None, timeout=None):
+    self.channels = channels
+    self.timeout = timeout if timeout != None else config.CHANNEL_TIMEOUT
+    self.pool = concurrent.futures.ThreadPoolExecutor(
+      workers or config.CHANNEL_WORKERS,
+      "channel"
+    )
+    # maps (channel, method) pairs to calls left running by earlier cycles
+    self.pending = {}
+    self.saturated = False
+
+  def run(self, method, timeout=None, channels=None):
+    """
+    Calls the named method of each channel (or of the given channels) on the
+    pool and waits up to the timeout (by default self.timeout) for them to
+    finish. Returns a list of the results of the calls that finished
+    successfully; errors are reported and skipped.
+    """
+    timeout = timeout if timeout != None else self.timeout
+    futures = []
+    for c in (channels if channels != None else self.channels):
+      f = self.pending.pop((c, method), None)
+      if f == None:
+        f = self.pool.submit(getattr(c, method))
+      futures.append((c, f))
+    concurrent.futures.wait([f for c, f in futures], timeout=timeout)
+    results = []
+    for c, f in futures:
+      if not f.done():
+        self.pending[(c, method)] = f
+        report_slow_channel(c, method, timeout)
+        continue
+      error = f.exception()
+      if error == None:
+        results.append(f.result())
+      elif not isinstance(error, Exception): # e.g., SystemExit
+        raise error
+      else:
+        report_channel_error(c, method, error)
+    return results
+
+  def poll(self):
+    """
+    Polls every channel, returning all of the messages received. Sets
+    self.saturated if any channel returned a full batch (see
+    config.POLL_BATCH), meaning that it may have more messages waiting.
+    """
+    messages = []
+    self.saturated = False
+    for result in self.run("poll"):
+      messages.extend(result)
+      if len(result) >= config.POLL_BATCH:
+        self.saturated = True
+    return messages
+
+  def flush(self, timeout=None):
+    self.run("flush", timeout)
+
+  def checkpoint(self, timeout=None):
+    """
+    Checkpoints the channels (see Channel.checkpoint), skipping any with a
+    poll or flush still running from an earlier cycle: a running poll may
+    already have moved its channel's position past messages that it hasn't
+    returned yet, and a running flush may not have written out replies yet.
+    Those channels are checkpointed in a later cycle.
+    """
+    busy = [ c for c, method in self.pending if method != "checkpoint" ]
+    self.run(
+      "checkpoint",
+      timeout,
+      [ c for c in self.channels if c not in busy ]
+    )
+
+  def idle_channels(self):
+    """
+    Returns the channels that don't have calls still running, which are safe
+    to wait on.
+    """
+    busy = [ c for c, method in self.pending ]
+    return [ c for c in self.channels if c not in busy ]
+
+  def shutdown(self):
+    self.pool.shutdown(wait=False, cancel_futures=True)
+
+def report_slow_channel(c, method, timeout):
+  print(
+    "...{} of {} is taking more than {} seconds; continuing without it..."\
+    .format(method, c, timeout)
+  )
+  sys.stdout.flush()
+  log(
+    "...{} of {} is taking more than {} seconds; continuing without it..."\
+    .format(method, c, timeout)
+  )
+
+def report_channel_error(c, method, error):
+  trace = "".join(traceback.format_exception(error))
+  print("Error while...")
+  print("...{} of {}...".format(method, c))
+  print(trace)
+  sys.stdout.flush()
+  sys.stderr.flush()
+  log("Error during {} of {}:\n{}".format(method, c, trace))
+
+def next_wakeup(now, interval):
+  """
+  Returns how many seconds to wait for new messages before the next cycle:
+  until the next grading deadline (unless grading is left to the grading
+  worker) or token expiry, but no longer than the given interval.
+  """
+  events = [ storage.next_token_expiry(now) ]
+  if not config.GRADING_WORKER:
+    events.append(storage.next_grading_deadline(now))
+  events = [ t for t in events if t != None ]
+  return max(0, min([interval] + [ t - now for t in events ]))
+
+def finish_work(pool, admitted, dispatcher, drainer, timeout):
+  """
+  Finishes the work that run_server has taken on, taking at most timeout
+  seconds: messages waiting for admission are processed along with those in
+  progress, logged submissions are processed (see surge.Drainer), and then
+  the channels are flushed and checkpointed, sending replies and saving
+  their positions. If messages are still being processed when time runs
+  out, the channels are flushed but not checkpointed, so that those
+  messages are fetched again on the next start (the ones that were finished
+  are skipped; see storage.message_processed). Returns True if everything
+  was finished.
+  """
+  deadline = time.monotonic() + timeout
+  remaining = lambda: max(0, deadline - time.monotonic())
+  dispatcher.submit_received(admitted.take(storage.now_ts(), admitted.pending))
+  finished = dispatcher.wait(remaining())
+  drainer.stop(remaining())
+  pool.flush(remaining())
+  if not finished:
+    log(
+      "...{} messages unfinished; not saving channel positions...".format(
+        dispatcher.depth
+      )
+    )
+    return False
+  pool.checkpoint(remaining())
+  return True
+
 def run_server(channels, db_name="academibot.db", interval=10):
   global CONTEXT
   print("Starting academibot with channels:")
@@ -72,25 +502,62 @@ def run_server(channels, db_name="academibot.db", interval=10):
   sys.stdout.flush()
   log("...setting up storage...")
   storage.setup(db_name)
+  limiter = ratelimit.RateLimiter()
+  limiter.load()
   print("...setting up channels...")
   log("...setting up channels...")
   sys.stdout.flush()
   for c in channels:
     c.setup()
+  pool = ChannelPool(channels)
+  admitted = admission.AdmissionQueue()
+  dispatcher = Dispatcher()
+  grading = None
+  if config.GRADING_WORKER:
+    print("...starting grading worker...")
+    log("...starting grading worker...")
+    sys.stdout.flush()
+    grading = grader.GraderProcess(db_name)
+    grading.start()
+  drainer = surge.Drainer(dispatcher)
+  drainer.start()
+  metrics_server = None
+  if config.METRICS_PORT != None:
+    print("...serving metrics on port {}...".format(config.METRICS_PORT))
+    log("...serving metrics on port {}...".format(config.METRICS_PORT))
+    sys.stdout.flush()
+    import metrics
+    metrics_server = metrics.start()
   print("...done...")
   sys.stdout.flush()
   log("...done with setup...")
+  SHUTDOWN.clear()
+  handlers = {}
+  if threading.current_thread() is threading.main_thread():
+    for signum in (signal.SIGTERM, signal.SIGINT):
+      handlers[signum] = signal.signal(signum, request_shutdown)
   try:
     now = 0
     last = 0
-    while True:
+    while not SHUTDOWN.is_set():
       last = now
       now = storage.now_ts()
+      cycle_start = time.perf_counter()
       try:
         CONTEXT = "...cleaning auth tokens..."
         storage.clean_tokens()
+        storage.clean_outbox(now)
+        storage.clean_processed(now)
         CONTEXT = "...auto-grading..."
-        err = storage.maintain_grade_info(last, now)
+        err = None
+        if grading:
+          code = grading.check()
+          if code != None:
+            err = "Grading worker exited with code {}; restarted it.".format(
+              code
+            )
+        else:
+          err = storage.maintain_grade_info(last, now)
         if err:
           print("Error while...")
           print(CONTEXT)
@@ -101,48 +568,42 @@ def run_server(channels, db_name="academibot.db", interval=10):
           log("Error while {}:\n{}".format(CONTEXT[3:-3], err))
         CONTEXT = "...checking channels..."
         messages = []
-        for c in channels:
-          messages.extend(c.poll())
+        if not admitted.full():
+          messages = pool.poll()
+        CONTEXT = "...rate-limiting {} messages...".format(len(messages))
+        messages = limiter.filter(messages, now)
+        limiter.checkpoint(now)
+        CONTEXT = "...admitting {} messages...".format(len(messages))
+        admitted.add(messages, now)
+        messages = admitted.take(now)
         CONTEXT = "...processing {} messages...".format(len(messages))
-        for sender, body, rf in messages:
-          try:
-            process(sender, body, rf, now)
-          except Exception as e:
-            print("Error while...")
-            print(CONTEXT)
-            #print(e)
-            traceback.print_exc()
-            sys.stdout.flush()
-            sys.stderr.flush()
-            log(
-              "Error while {}:\n{}".format(
-                CONTEXT[3:-3],
-                traceback.format_exc()
-              )
+        dispatcher.submit_received(messages)
+        finished = dispatcher.wait(config.DISPATCH_WAIT)
+        if not finished:
+          log(
+            "...{} messages still processing; flushing anyway...".format(
+              dispatcher.depth
             )
-            print("...error processing message; reporting to user...")
-            log("...reporting error to user...")
-            rf(
-                """
-Academibot encountered an error while trying to to process your message.
-
-Please either re-send your message with different data or try to contact an
-instructor about what you should do.
-
-The message you sent was:
-
-{}
-""".format(body)
-            )
-            print("...done reporting; ignoring message...")
-            sys.stdout.flush()
-            sys.stderr.flush()
-            log("...done reporting error; ignoring message...")
+          )
         CONTEXT = "...flushing channels..."
-        for c in channels:
-          c.flush()
-        CONTEXT = "...done; sleeping for {} seconds...".format(interval)
-        time.sleep(interval)
+        pool.flush()
+        # Channels are only checkpointed once every message they've returned
+        # is done, so that a crash can't lose messages still being processed
+        # or held for admission (those are fetched again after a restart, and
+        # the processed-message ledger skips the ones that were finished).
+        if finished and not admitted.pending:
+          CONTEXT = "...checkpointing channels..."
+          pool.checkpoint()
+        CONTEXT = "...dumping statistics..."
+        stats.record("loop.cycle", time.perf_counter() - cycle_start)
+        stats.gauge("loop.messages", len(messages))
+        stats.count("loop.messages", len(messages))
+        stats.maybe_dump(now)
+        if pool.saturated or admitted.pending:
+          continue # more messages are waiting
+        timeout = next_wakeup(storage.now_ts(), interval)
+        CONTEXT = "...done; waiting up to {:.2f} seconds...".format(timeout)
+        wait_for_channels(pool.idle_channels(), timeout)
       except Exception as e:
         if type(e) == KeyboardInterrupt:
           print("During...")
@@ -168,9 +629,44 @@ The message you sent was:
           )
         )
         log("...retrying next interval...")
-        time.sleep(interval)
+        SHUTDOWN.wait(interval)
+    print(
+      "Shutting down; finishing work in progress (up to {} seconds)...".format(
+        config.SHUTDOWN_TIMEOUT
+      )
+    )
+    sys.stdout.flush()
+    log("...shutting down; finishing work in progress...")
+    CONTEXT = "...finishing work in progress..."
+    try:
+      if not finish_work(
+        pool,
+        admitted,
+        dispatcher,
+        drainer,
+        config.SHUTDOWN_TIMEOUT
+      ):
+        print("...some messages will be processed again on the next start...")
+    except Exception:
+      print("Error while...")
+      print(CONTEXT)
+      traceback.print_exc()
+      log("Error while {}:\n{}".format(CONTEXT[3:-3], traceback.format_exc()))
   except KeyboardInterrupt:
-    pass
+    print("...stopping without finishing work in progress...")
+    log("...stopping without finishing work in progress...")
+  for signum, handler in handlers.items():
+    signal.signal(signum, handler)
+  pool.shutdown()
+  dispatcher.shutdown()
+  drainer.stop(0)
+  if grading:
+    grading.stop()
+  if metrics_server:
+    metrics.stop(metrics_server)
+  limiter.checkpoint(storage.now_ts(), force=True)
+  if config.STATS_FILE:
+    stats.dump()
   print("Exiting academibot (incoming email will be ignored).")
   sys.stdout.flush()
   sys.stderr.flush()
@@ -178,6 +674,9 @@ The message you sent was:
   done_logging()
 
 def main():
+  # Imported here so that other channels (like the test and Maildir ones)
+  # start without loading the email stack.
+  import mail
   run_server(
     [
       mail.AsyncEmailChannel(
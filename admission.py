@@ -0,0 +1,104 @@
+"""
+admission.py
+Admission control for incoming messages: decides which waiting messages are
+processed in each cycle, so that cycle time stays bounded during floods and
+staff commands aren't stuck behind a rush of submissions.
+"""
+
+import collections
+import itertools
+import heapq
+
+import config
+import commands
+import stats
+import storage
+
+class AdmissionQueue:
+  """
+  Holds incoming (sender, body, reply_function) messages until they're taken
+  for processing, along with the time each was received. Messages are taken
+  by priority class (see classify and config.ADMISSION_BUDGET), moving up a
+  class for every config.ADMISSION_AGING seconds they wait. Each sender's
+  messages are taken in the order they arrived; a sender's first waiting
+  message is treated as having the highest priority of any of that sender's
+  waiting messages, so an urgent command isn't held back by the same
+  sender's earlier bulk messages.
+  """
+  def __init__(self, budget=None, aging=None):
+    self.budget = budget or config.ADMISSION_BUDGET
+    self.aging = aging or config.ADMISSION_AGING
+    # maps senders to deques of (class, sequence, received, message) tuples
+    self.senders = collections.OrderedDict()
+    self.sequence = itertools.count()
+    self.pending = 0
+
+  def classify(self, sender, body):
+    """
+    Returns the priority class (0 is most urgent) of a message from the
+    given sender.
+    """
+    names = commands.command_names(body)
+    if storage.role(sender.lower()) in config.ADMISSION_STAFF_ROLES:
+      if any(n in config.ADMISSION_URGENT_COMMANDS for n in names):
+        return 0
+      return 1
+    if any(n in config.ADMISSION_BULK_COMMANDS for n in names):
+      return 3
+    return 2
+
+  def add(self, messages, now):
+    """
+    Adds a batch of (sender, body, reply_function) messages received at the
+    given time.
+    """
+    for m in messages:
+      self.senders.setdefault(m[0].lower(), collections.deque()).append(
+        (self.classify(m[0], m[1]), next(self.sequence), now, m)
+      )
+    self.pending += len(messages)
+    stats.gauge("admission.pending", self.pending)
+
+  def priority(self, entries, now):
+    """
+    Returns the sort key for a sender's waiting messages: the best effective
+    class among them (after aging), then the arrival order of the first.
+    """
+    best = min(
+      cls - int((now - received) / self.aging)
+        for cls, seq, received, m in entries
+    )
+    return (best, entries[0][1])
+
+  def take(self, now, budget=None):
+    """
+    Removes and returns up to budget (by default self.budget) waiting
+    messages as ((sender, body, reply_function), received) pairs, most
+    urgent first.
+    """
+    budget = budget if budget != None else self.budget
+    result = []
+    heap = [
+      (self.priority(entries, now), sender)
+        for sender, entries in self.senders.items()
+    ]
+    heapq.heapify(heap)
+    while heap and len(result) < budget:
+      key, sender = heapq.heappop(heap)
+      entries = self.senders[sender]
+      cls, seq, received, m = entries.popleft()
+      result.append((m, received))
+      if entries:
+        heapq.heappush(heap, (self.priority(entries, now), sender))
+      else:
+        del self.senders[sender]
+    self.pending -= len(result)
+    stats.gauge("admission.pending", self.pending)
+    return result
+
+  def full(self):
+    """
+    Returns True if enough messages are waiting that channels shouldn't be
+    polled for more (see config.ADMISSION_MAX_PENDING).
+    """
+    return self.pending >= config.ADMISSION_MAX_PENDING
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+bench.py
+End-to-end load generator: delivers a burst of messages to a loopback mail
+server (see loopback.py), or writes them to a local Maildir (see maildir.py),
+and measures how long academibot takes to answer them. With --startup, it
+instead measures how long a fresh process takes to import academibot and set
+up storage.
+
+Usage: bench.py [--maildir] [messages [senders]]
+       bench.py --startup [runs]
+"""
+
+import sys
+import os
+import subprocess
+import json
+import time
+import tempfile
+import mailbox
+
+import academibot
+import channel
+import config
+import loopback
+import mail
+import maildir
+import stats
+import storage
+
+BENCH_DB = "academibot-bench.db"
+
+def fresh_storage():
+  for suffix in ("", "-wal", "-shm"):
+    if os.path.exists(BENCH_DB + suffix):
+      os.remove(BENCH_DB + suffix)
+  storage.setup(BENCH_DB)
+  config.LOGFILE = "academibot-bench.log"
+
+def run_cycles(ch, count):
+  """
+  Runs poll/process/flush/checkpoint cycles on the given channel until count messages
+  have been processed. Returns (cycles, seconds).
+  """
+  start = time.perf_counter()
+  processed = 0
+  cycles = 0
+  while processed < count:
+    messages = ch.poll()
+    academibot.process_all(messages, storage.now_ts())
+    ch.flush()
+    ch.checkpoint()
+    processed += len(messages)
+    cycles += 1
+  return cycles, time.perf_counter() - start
+
+def bench(count=200, senders=20, body=":help"):
+  """
+  Delivers count messages from the given number of senders to a loopback
+  server and runs cycles until all of them have been answered. Returns a
+  dictionary of measurements.
+  """
+  fresh_storage()
+  with loopback.LoopbackServer() as server:
+    for n in range(count):
+      server.deliver(
+        loopback.compose("sender{}@bench.test".format(n % senders), body)
+      )
+    ch = channel.BlockingChannel(
+      mail.AsyncioEmailChannel(
+        "bench",
+        "bot@bench.test",
+        "bot",
+        "bot",
+        password="bench"
+      )
+    )
+    ch.setup()
+    cycles, elapsed = run_cycles(ch, count)
+    ch.close()
+    return {
+      "messages": count,
+      "senders": senders,
+      "cycles": cycles,
+      "emails sent": len(server.sent),
+      "seconds": elapsed,
+      "messages/second": count / elapsed,
+      "server commands": sum(server.commands.values()),
+    }
+
+def bench_maildir(count=200, senders=20, body=":help"):
+  """
+  Like bench, but reads the messages from a local Maildir and writes the
+  replies to another one.
+  """
+  fresh_storage()
+  with tempfile.TemporaryDirectory() as tmp:
+    source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+    for n in range(count):
+      source.add(
+        loopback.compose("sender{}@bench.test".format(n % senders), body)
+      )
+    ch = maildir.MailboxChannel(
+      "bench",
+      os.path.join(tmp, "in"),
+      os.path.join(tmp, "out")
+    )
+    ch.setup()
+    cycles, elapsed = run_cycles(ch, count)
+    return {
+      "messages": count,
+      "senders": senders,
+      "cycles": cycles,
+      "replies written": len(os.listdir(os.path.join(tmp, "out", "new"))),
+      "seconds": elapsed,
+      "messages/second": count / elapsed,
+    }
+
+STARTUP_SCRIPT = """
+import sys, time, json
+start = time.perf_counter()
+import academibot
+import storage
+imported = time.perf_counter()
+storage.setup(sys.argv[1])
+done = time.perf_counter()
+print(json.dumps([imported - start, done - imported]))
+"""
+
+def bench_startup(runs=5):
+  """
+  Starts runs fresh Python processes which import academibot and set up
+  storage, the first on a new database and the rest on the existing one.
+  Returns a dictionary of measurements (best times, in seconds).
+  """
+  for suffix in ("", "-wal", "-shm"):
+    if os.path.exists(BENCH_DB + suffix):
+      os.remove(BENCH_DB + suffix)
+  here = os.path.dirname(os.path.abspath(__file__))
+  times = []
+  for n in range(runs):
+    start = time.perf_counter()
+    output = subprocess.run(
+      [sys.executable, "-c", STARTUP_SCRIPT, BENCH_DB],
+      cwd=here,
+      check=True,
+      capture_output=True,
+      text=True
+    ).stdout
+    total = time.perf_counter() - start
+    times.append(json.loads(output.strip().split("\n")[-1]) + [total])
+  rest = times[1:] or times
+  return {
+    "runs": runs,
+    "setup (new db)": times[0][1],
+    "import": min(t[0] for t in times),
+    "setup": min(t[1] for t in rest),
+    "process total": min(t[2] for t in rest),
+  }
+
+if __name__ == "__main__":
+  args = sys.argv[1:]
+  run = bench
+  if args and args[0] == "--maildir":
+    run = bench_maildir
+    args = args[1:]
+  elif args and args[0] == "--startup":
+    run = bench_startup
+    args = args[1:]
+  results = run(*[ int(a) for a in args[:2] ])
+  for name, value in results.items():
+    if isinstance(value, float):
+      print("{:>16}: {:.3f}".format(name, value))
+    else:
+      print("{:>16}: {}".format(name, value))
+  print()
+  print(stats.report())
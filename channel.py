@@ -3,6 +3,10 @@ channel.py
 Abstract "channel" class for implementing input feeds to academibot.
 """
 
+import abc
+import time
+import asyncio
+
 class Channel:
   """
   An abstract class representing a communication method by which messages might
@@ -21,12 +25,133 @@ class Channel:
     """
     return []
 
+  def wait(self, timeout, stop=None):
+    """
+    Blocks until new messages might be available, the timeout (in seconds)
+    expires, or the given threading.Event (if any) is set. Returns True if
+    the channel knows that messages are waiting. The default implementation
+    just sleeps.
+    """
+    if stop:
+      stop.wait(timeout)
+    else:
+      time.sleep(timeout)
+    return False
+
   def flush(self):
     """
     Called every cycle after message responses have been issued. Allows the
     channel to buffer responses if it wishes.
     """
     return
+
+  def checkpoint(self):
+    """
+    Records that every message returned by poll so far has been processed
+    (and its responses flushed), so that those messages aren't returned
+    again after a restart. Called after flush, but only once all of those
+    messages are done. The default implementation does nothing.
+    """
+    return
  
   def __str__(self):
     return "a channel"
+
+class AsyncChannel(abc.ABC):
+  """
+  An abstract class representing a channel built on asyncio. Messages are
+  delivered by an asynchronous iterator instead of a list, and replies can
+  be sent right away instead of waiting for a flush. Subclasses must
+  implement send; every other method has a default.
+  """
+  async def setup(self):
+    """
+    Perform any necessary setup tasks.
+    """
+    return
+
+  async def poll(self):
+    """
+    An asynchronous iterator of sender, message, response_function tuples
+    (see Channel.poll). Implementations should be async generators.
+    """
+    return
+    yield
+
+  @abc.abstractmethod
+  async def send(self, reply, key=None):
+    """
+    Sends a single reply (a dictionary with 'to', 'subject', 'body', and
+    optionally 'references' entries) immediately. The key, if given,
+    identifies the reply so that recipients can discard duplicates. This
+    is required (a subclass without it can't be instantiated); a channel
+    that can't send right away should queue the reply for its next flush.
+    """
+
+  async def wait(self, timeout, stop=None):
+    """
+    See Channel.wait. The default implementation just sleeps (or waits for
+    the given threading.Event in a worker thread).
+    """
+    if stop:
+      await asyncio.get_running_loop().run_in_executor(None, stop.wait, timeout)
+    else:
+      await asyncio.sleep(timeout)
+    return False
+
+  async def flush(self):
+    """
+    See Channel.flush.
+    """
+    return
+
+  async def checkpoint(self):
+    """
+    See Channel.checkpoint.
+    """
+    return
+
+  async def close(self):
+    """
+    Releases any connections or other resources held by the channel.
+    """
+    return
+
+  def __str__(self):
+    return "an asyncio channel"
+
+async def collect(iterator):
+  """
+  Returns a list of everything produced by the given asynchronous iterator.
+  """
+  return [ item async for item in iterator ]
+
+class BlockingChannel(Channel):
+  """
+  Adapts an AsyncChannel for use by the blocking main loop, running each call
+  to completion on a fresh event loop in the calling thread (so that the
+  channel's own database access happens on the caller's thread).
+  """
+  def __init__(self, channel):
+    self.channel = channel
+
+  def setup(self):
+    asyncio.run(self.channel.setup())
+
+  def poll(self):
+    return asyncio.run(collect(self.channel.poll()))
+
+  def wait(self, timeout, stop=None):
+    return asyncio.run(self.channel.wait(timeout, stop))
+
+  def flush(self):
+    asyncio.run(self.channel.flush())
+
+  def checkpoint(self):
+    asyncio.run(self.channel.checkpoint())
+
+  def close(self):
+    asyncio.run(self.channel.close())
+
+  def __str__(self):
+    return str(self.channel)
@@ -3,9 +3,17 @@ commands.py
 academibot commands.
 """
 
+import asyncio
+import inspect
+import types
+import concurrent.futures
+import contextvars
+
 import storage
 import formats
 import config
+import stats
+import grader
 
 def parse(body):
   words = []
@@ -22,6 +30,32 @@ def parse(body):
     result = []
   return result
 
+def command_names(body):
+  """
+  Returns the names of the commands in a message body, in order, without
+  parsing their arguments (a cheap version of parse for classifying
+  messages).
+  """
+  names = []
+  for l in body.replace('\r', '').split('\n'):
+    l = l.strip()
+    if not l or l[0] == ">":
+      continue
+    for w in l.split():
+      if w[0] == ":" and w[1:] in COMMANDS:
+        names.append(w[1:])
+  return names
+
+def read_only(body):
+  """
+  Returns True if every command in a message body is marked as never
+  writing to the database (with "writes": False in COMMANDS).
+  """
+  return all(
+    COMMANDS[name].get("writes", True) == False
+      for name in command_names(body)
+  )
+
 def sort_commands(cmds):
   result = []
   prioritized = []
@@ -59,7 +93,37 @@ def get_args(words):
     args, rest = get_args(tail)
     return ([head] + args, rest)
 
+def run_sync(coroutine):
+  """
+  Runs a coroutine to completion from synchronous code, returning its
+  result. asyncio.run refuses to run inside a running event loop (as when a
+  command handler calls back into this), so in that case the coroutine gets
+  its own loop on a separate thread while this one waits. It runs in a copy
+  of the caller's context, so it uses the caller's database transaction and
+  connection (see storage.transaction) instead of waiting for its lock.
+  """
+  try:
+    asyncio.get_running_loop()
+  except RuntimeError:
+    return asyncio.run(coroutine)
+  context = contextvars.copy_context()
+  with concurrent.futures.ThreadPoolExecutor(1) as pool:
+    return pool.submit(context.run, asyncio.run, coroutine).result()
+
 def handle_commands(user, message, cmdlist, now):
+  return run_sync(handle_commands_async(user, message, cmdlist, now))
+
+async def handle_commands_async(user, message, cmdlist, now):
+  """
+  Runs each command in the given (already sorted) list in order, returning
+  the combined response text. Command handlers may be either normal
+  functions or coroutine functions; the latter are awaited, which lets
+  commands from other messages on the same event loop run while they wait
+  (see academibot.process_all). Storage calls are synchronous, so this only
+  helps at a handler's own await points; in the server, messages from
+  different senders run in parallel on the dispatcher's threads instead
+  (see academibot.Dispatcher).
+  """
   responses = []
   context = {
     "user": user,
@@ -74,6 +138,8 @@ def handle_commands(user, message, cmdlist, now):
   }
   for (cmd, args) in cmdlist:
     result = COMMANDS[cmd]["run"](context, *args)
+    if inspect.isawaitable(result):
+      result = await result
     responses.append("""\
 Response for:
   :{cmd}{args}
@@ -182,12 +248,16 @@ def get_assignment(course_id, name):
     )
   return ("", aid)
 
-#############
-# Commands: #
-#############
+#########
+# Help: #
+#########
 
-def cmd_help(context, *args):
-  general = """\
+# The (pages, suggestions) pair from build_help_index, once built
+HELP_INDEX = None
+
+def render_general_help():
+  import helptext
+  return """\
 To interact with academibot, send it an email containing one or more commands (each command should be on a separate line). Lines starting with '>' are ignored (so that it doesn't re-process commands in reply chains). Commands may take arguments, in which case they should come after the command on the same line, separated by spaces.
   
 Academibot recognizes the following commands:
@@ -219,34 +289,127 @@ Finally, there are some other general help topics:
     "  {topic} -- {d}".format(
       topic = t["name"],
       d = t["desc"]
-    ) for t in sorted(TOPICS.values(), key=lambda t: t["name"])
+    ) for t in sorted(helptext.TOPICS.values(), key=lambda t: t["name"])
   ),
 )
-  body = ""
+
+def fuzzy_keys(name):
+  """
+  Returns the given name along with every string that can be made by
+  deleting a single character from it. If two names are within one edit of
+  each other (see within_one_edit), their fuzzy keys overlap, so looking up
+  a misspelling's keys in an index of topic keys finds the candidates for
+  close topic names without comparing against every topic. Some names whose
+  keys overlap are further apart (like "acb" and "abd"), so candidates still
+  need to be checked.
+  """
+  return set([name] + [ name[:i] + name[i+1:] for i in range(len(name)) ])
+
+def within_one_edit(a, b):
+  """
+  Returns True if a can be turned into b by at most one insertion, deletion,
+  substitution, or swap of adjacent characters.
+  """
+  if abs(len(a) - len(b)) > 1:
+    return False
+  if len(a) > len(b):
+    a, b = b, a
+  i = 0
+  while i < len(a) and a[i] == b[i]:
+    i += 1
+  if i == len(b):
+    return True # identical
+  if len(a) < len(b):
+    return a[i:] == b[i+1:] # insertion
+  if a[i+1:] == b[i+1:]:
+    return True # substitution
+  return (
+    a[i] == b[i+1]
+and a[i+1] == b[i]
+and a[i+2:] == b[i+2:]
+  ) # adjacent swap
+
+def build_help_index():
+  """
+  Renders every help page, returning a (pages, suggestions) pair of
+  read-only dictionaries. Pages maps topic names (and "" for the general
+  help) to reply text, while suggestions maps fuzzy keys (see fuzzy_keys) to
+  tuples of topic names.
+  """
+  import helptext
+  pages = {}
+  # Commands take precedence over formats, which take precedence over topics:
+  for t in helptext.TOPICS.values():
+    pages[t["name"]] = t["help"]
+  for f in formats.FORMATS.values():
+    pages[f["name"]] = f["help"]
+  for c in COMMANDS.values():
+    pages[c["name"]] = helptext.COMMAND_HELP[c["name"]]
+
+  suggestions = {}
+  for name in pages:
+    for key in fuzzy_keys(name):
+      suggestions.setdefault(key, set()).add(name)
+
+  pages[""] = render_general_help()
+  return (
+    types.MappingProxyType(pages),
+    types.MappingProxyType(
+      { key: tuple(sorted(names)) for key, names in suggestions.items() }
+    )
+  )
+
+def help_index():
+  """
+  Returns the (pages, suggestions) pair from build_help_index, building it
+  (and importing helptext) the first time help is requested.
+  """
+  global HELP_INDEX
+  if HELP_INDEX == None:
+    HELP_INDEX = build_help_index()
+  return HELP_INDEX
+
+def suggest_topics(topic):
+  """
+  Returns a sorted list of help topics within one edit of the given one.
+  """
+  pages, suggestions = help_index()
+  topic = topic.lower()
+  result = set()
+  for key in fuzzy_keys(topic):
+    result.update(suggestions.get(key, ()))
+  return sorted(name for name in result if within_one_edit(topic, name))
+
+#############
+# Commands: #
+#############
+
+def cmd_help(context, *args):
+  pages, suggestions = help_index()
   if len(args) == 0:
-    body = general
+    return pages[""]
+  topic = args[0]
+  if isinstance(topic, str):
+    if topic in pages:
+      return pages[topic]
+    if topic.lower() in pages:
+      return pages[topic.lower()]
+    suggestions = suggest_topics(topic)
   else:
-    topic = args[0]
-    if topic in COMMANDS:
-      body = COMMANDS[topic]["help"]
-    elif topic in formats.FORMATS:
-      body = formats.FORMATS[topic]["help"]
-    elif topic in TOPICS:
-      body = TOPICS[topic]["help"]
-    else:
-      body = """\
+    suggestions = []
+  return """\
 Unknown topic '{bad}'.
 
 Full command was understood as:
 
 :help {bad}
-
-{general}
+{suggest}
 """.format(
   bad = topic,
-  general = general
-)
-  return body
+  suggest = "\nDid you mean:\n\n{}\n".format(
+    "\n".join(":help " + s for s in suggestions)
+  ) if suggestions else ""
+) + pages[""] + "\n"
 
 def cmd_auth(context, *args):
   user = context["user"]
@@ -819,7 +982,7 @@ Question '{}':
   result += "\nAnswer format:\n" + aformat
   return ("", result)
 
-def cmd_list_assignments(context, *args):
+async def cmd_list_assignments(context, *args):
   user = context["user"]
   list_all = False
   courses = []
@@ -850,6 +1013,9 @@ def cmd_list_assignments(context, *args):
     assignments = storage.assignments_for(cid, context["now"], mode)
     for a in assignments:
       result += " " + assignment_summary(context, cid, status, a)
+      # Instructor summaries grade every student, so give commands from other
+      # messages a chance to run in between.
+      await asyncio.sleep(0)
     if not assignments:
       if mode == "current" or mode == "future":
         result += "<no current assignments>\n"
@@ -1057,25 +1223,123 @@ def cmd_submit(context, *args):
 
   return delegate(storage.submit_assignment(user, aid, context["now"], answers))
 
+def cmd_submit_batch(context, *args):
+  user = context["user"]
+
+  ( err, (course, batch) ) = unpack_args(
+    "submit-batch",
+    args,
+    2,
+    "a course and a map from assignment names to answers maps"
+  )
+  if err:
+    return err
+
+  if not isinstance(batch, dict):
+    return "Error: ':submit-batch' requires a map from assignment names to answers maps.\n"
+
+  err = check_user_auth(context, user, "submit assignments")
+  if err:
+    return err
+
+  err, course_id, tag = get_course(user, course)
+  if err:
+    return err
+
+  status = storage.enrollment_status(user, course_id)
+  if status == "none":
+    return "Error: cannot submit assignments in {} as you are not enrolled.".format(
+      tag
+    )
+
+  aids = storage.get_assignment_ids(course_id, batch.keys())
+  results = {
+    name: (name, False, "no assignment '{}' in course {}".format(name, tag))
+      for name in batch if name not in aids
+  }
+  for r in storage.submit_assignments(
+    user,
+    context["now"],
+    [ (name, aids[name], batch[name]) for name in batch if name in aids ]
+  ):
+    results[r[0]] = r
+  results = [ results[name] for name in batch ]
+
+  width = max(len(r[0]) for r in results) if results else 0
+  return """\
+Submitted {}/{} assignments in course {} for user {}.
+
+Results:
+  {}
+""".format(
+  len([r for r in results if r[1]]),
+  len(results),
+  tag,
+  user,
+  "\n  ".join(
+    "{} {} -- {}".format(
+      " + " if r[1] else "***",
+      r[0].ljust(width),
+      r[2]
+    ) for r in results
+  )
+)
+
+def cmd_stats(context, *args):
+  user = context["user"]
+
+  err = check_user_auth(context, user, "view statistics")
+  if err:
+    return err
+
+  if storage.role(user) != "admin":
+    return "Error: only admins may view statistics.\n"
+
+  prefix = args[0] if args else ""
+  now = context["now"]
+  queued, oldest, failed = storage.outbox_status(now)
+  result = "Statistics{}:\n{}\nOutbox: {} queued (oldest {}s), {} failed.\n".format(
+    " for '{}'".format(prefix) if prefix else "",
+    stats.report(prefix),
+    queued,
+    int(oldest),
+    failed
+  )
+  if config.GRADING_WORKER:
+    queued, oldest, failed = storage.grading_status(now)
+    result += "Grading: {} queued (oldest {}s), {} failed.\n".format(
+      queued,
+      int(oldest),
+      failed
+    )
+    worker = storage.worker_status(grader.WORKER_NAME)
+    if worker:
+      result += (
+        "Grading worker: pid {}, up {}s, last heartbeat {}s ago, {} graded"
+        " ({} failed).\n"
+      ).format(
+        worker["pid"],
+        int(now - worker["started"]),
+        int(now - worker["heartbeat"]),
+        worker["processed"],
+        worker["failed"]
+      )
+    else:
+      result += "Grading worker: no heartbeat yet.\n"
+  return result
+
+# Commands marked "writes": False promise not to write to the database,
+# which lets messages containing only them run alongside messages that are
+# writing (see academibot.WriteTurn).
 COMMANDS = {
   "help": {
     "name": "help",
     "run" : cmd_help,
+    "writes": False,
     "priority": 10,
     "argdesc": "[command]",
     "desc": \
 "Gives an explanation of [command], or general help if no [command] is given.",
-    "help": """\
-Help for command:
-  :help
-
-Usage examples:
-  :help
-
-  :help help
-
-The help command. Replies with a general help message, or with help for a specific command if given as ":help <command>". For example you got this message because you sent a command ":help help". Note that the command name for the argument to help may not include the leading colon, or it will be interpreted as a command itself.
-"""
   },
   "auth": {
     "name": "auth",
@@ -1083,23 +1347,6 @@ The help command. Replies with a general help message, or with help for a specif
     "priority": 1,
     "argdesc": "<purpose> <token>",
     "desc": "Authenticates for a particular purpose. User, course, and token authentication are supported.",
-    "help": """\
-Help for command:
-  :auth
-
-Usage examples:
-  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
-
-  :auth example-college/test-course/winter/2035 cec46ec5145ab51eb92fafa418768686
-
-  :auth #register fab9df15f2f0897f0043393c45326d10
-
-Authenticates for a given purpose, enabling all commands in the same email requiring that specific privilege to function (:auth runs before other commands). You will receive an authentication token from academibot when you need one (for example, when you register you will receive a temporary token for registration, and then your permanent user token).
-    
-For user authentication, use your email as the <purpose>. To authenticate with a temporary token, use the token's purpose, preceded by a '#' sign (with no space in between). For course authentication, use either the numeric course ID, the full course tag (institution/course/term/year) or an alias that you have set up for that course.
-
-You can use the ':scramble' command to reset permanent authentication tokens if you need to; temporary tokens can generally be re-requested by re-issuing the command that generated them.
-"""
   },
   "user": {
     "name": "user",
@@ -1107,16 +1354,6 @@ You can use the ':scramble' command to reset permanent authentication tokens if
     "priority": 2,
     "argdesc": "<email>",
     "desc": "(requires auth) Indicates that commands are from someone other than the sender of this email.",
-    "help": """\
-Help for command:
-  :user
-
-Usage examples:
-  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
-  :user test@example.com
-
-Tells academibot who you are, when you are sending email from another account. For example, if you are registered as "test@example.com" but you have another account "test@gmail.com" from which you send mail to academibot, your mail from "test@gmail.com" should contain the command ":user test@example.com". Naturally, this requires the specified sender's authorization token.
-"""
   },
   "scramble": {
     "name": "scramble",
@@ -1124,19 +1361,6 @@ Tells academibot who you are, when you are sending email from another account. F
     "priority": 100,
     "argdesc": "<entity>",
     "desc": "(requires authorization) Generates a new authentication token for the given user or course.",
-    "help": """\
-Help for command:
-  :scramble
-
-Usage examples:
-  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
-  :scramble test@example.com
-
-  :auth example-college/test-course/winter/2035 cec46ec5145ab51eb92fafa418768686
-  :scramble example-college/test-course/winter/2035
-
-Generates a fresh authentication token for the given user or course. Requires appropriate authorization (the old auth token). :scramble isn't run until after all other commands, so :auth commands using the old token will still work for the email in which :scramble is sent.
-"""
   },
   "register": {
     "name": "register",
@@ -1144,35 +1368,15 @@ Generates a fresh authentication token for the given user or course. Requires ap
     "priority": 10,
     "argdesc": None,
     "desc": "(requires token) Registers the sender as a new user. Does nothing if already registered.",
-    "help": """\
-Help for command:
-  :register
-
-Usage examples:
-  :register
-
-  :auth #register 99dc985e08fcfb28382186ab8e3d6cc2
-  :register
-
-Registers the sender as a new user, which is required before enrolling in courses and submitting assignments. First use will generate a temporary authentication token in reply, which should be used with ':auth #register' and a second register command to actually register. Does nothing if the sender is already registered. Use :status to view role and status info.
-"""
   },
   "status": {
     "name": "status",
     "priority": 10,
     "run" : cmd_status,
+    "writes": False,
     "argdesc": None,
     "desc": \
 "Responds with information about the sender's role and status.",
-    "help": """\
-Help for command:
-  :status
-
-Usage examples:
-  :status
-
-Responds with information about the sender's role and status. Roles give users special permissions (like the ability to create new courses and register students). Most users have the 'default' role. Statuses indicate whether a user is 'active,' or an 'alias.'
-"""
   },
   "block": {
     "name": "block",
@@ -1180,15 +1384,6 @@ Responds with information about the sender's role and status. Roles give users s
     "priority": 10,
     "argdesc": None,
     "desc": "Prevents the user from receiving any further mail. Commands except ':unblock' will be ignored",
-    "help": """\
-Help for command:
-  :block
-
-Usage examples:
-  :block
-
-Adds the sender to the 'blocking' list which prevents academibot from sending any mail to them and prevents academibot from processing their commands. The only exception to this is the ':unblock' command, which will remove them from the 'blocking' list. Commands sent in the same email as a ':block' or ':unblock' command will be processed normally and will generate responses. You can be on the 'blocking' list without being registered.
-"""
   },
   "unblock": {
     "name": "unblock",
@@ -1196,15 +1391,6 @@ Adds the sender to the 'blocking' list which prevents academibot from sending an
     "priority": 10,
     "argdesc": None,
     "desc": "Removes the user from the 'blocking' list, undoing a previous ':block' command.",
-    "help": """\
-Help for command:
-  :unblock
-
-Usage examples:
-  :unblock
-
-Reverses a previous ':block' command, removing the sender from the 'blocking' list. Commands sent in the same email as a ':block' or ':unblock' command will be processed normally and will generate responses. If ':block' and ':unblock' are sent in the same message, the final status of the sender depends on their order within the message, but all other commands in the message will be processed and generate responses regardless of their order in relation to the ':block' and ':unblock' commands. You can be on the 'blocking' list without being registered.
-"""
   },
   "expect": {
     "name": "expect",
@@ -1212,19 +1398,6 @@ Reverses a previous ':block' command, removing the sender from the 'blocking' li
     "priority": 10,
     "argdesc": "<course> <user1> <user2> ...",
     "desc": "(requires auth) Takes a course followed by a list of email addresses and populates the expected roster for a course.",
-    "help": """\
-Help for command:
-  :expect
-
-Usage examples:
-  :auth example-college/test-course/fall/2016 99dc985e08fcfb28382186ab8e3d6cc2
-  :expect test-course test@example.com
-    more@example.com
-    with_commas@example.com,
-    this_is_fine@example.com
-
-For a user to enroll in a course, they must be expected. An instructor for the course should enter each student's email via this command before asking students to enroll in the course. Multiple emails can be entered across multiple lines, and commas are ignored. The first argument is the course in which to expect students; authorization for that course must be entered beforehand.
-"""
   },
   "enroll": {
     "name": "enroll",
@@ -1232,15 +1405,6 @@ For a user to enroll in a course, they must be expected. An instructor for the c
     "priority": 10,
     "argdesc": "<course>",
     "desc": "Takes a course and enrolls the sender in that course.",
-    "help": """\
-Help for command:
-  :enroll
-
-Usage examples:
-  :enroll example-college/test-course/fall/2016
-
-Enrolls the sender in the given course. Ask your instructor for the correct course ID or tag. You won't be able to enroll unless your instructor has already added you to the course roster, so if you get an error about unexpected enrollment, ask your instructor to add you  using the ':expect' command.
-"""
   },
   "request": {
     "name": "request",
@@ -1248,15 +1412,6 @@ Enrolls the sender in the given course. Ask your instructor for the correct cour
     "priority": 10,
     "argdesc": "<type> <value>",
     "desc": "Submits a permission request of the given type/value.",
-    "help": """\
-Help for command:
-  :request
-
-Usage examples:
-  :request role instructor
-
-Used to submit a request for a particular status or permission, which can then be granted by an admin using ':grant'. The ':grant' command may also happen before the ':request' command, in which case the change is pre-approved and takes place immediately.
-"""
   },
   "grant": {
     "name": "grant",
@@ -1264,16 +1419,6 @@ Used to submit a request for a particular status or permission, which can then b
     "priority": 10,
     "argdesc": "<user> <type> <value>",
     "desc": "(requires auth) Grants the specified user's request of the given type/value.",
-    "help": """\
-Help for command:
-  :grant
-
-Usage examples:
-  :auth admin@example.com a46590b7c08591b4b1a62417c8b68fe0
-  :grant test@example.com role instructor
-
-Grants a user's request. It requires user authorization from the granting party (the sender). Use ':requests' to view outstanding requests. ':grant' may also be used preemtively, in which case when a user submits a request, it will immediately be approved. Requests are one-time transactions: if a user requires multiple requests of the same type they must be granted permission multiple times.
-"""
 # TODO: log requests & permission changes
   },
   "create-course": {
@@ -1282,18 +1427,6 @@ Grants a user's request. It requires user authorization from the granting party
     "priority": 10,
     "argdesc": "<institution> <name> <term> <year>",
     "desc": "(requires auth) Creates a new course, assigning the creator as an instructor.",
-    "help": """\
-Help for command:
-  :create-course
-
-Usage examples:
-  :auth instructor@example.com c3ed3ab84e43f0c74a35b206ec43149a
-  :create-course example-college test-course spring 1948
-
-Creates a new course and assigns the creator as an instructor. It requires user authentication for the creator (the sender) who must be have either the 'admin' or 'instructor' role system-wide (this is different from being an instructor on a course). Note that none of the course elements may contain the '@' or '/' symbols.
-
-The response to this command will include an authentication token for the new course, which the creator should keep track of.
-"""
   },
   "add-instructor": {
     "name": "add-instructor",
@@ -1301,16 +1434,6 @@ The response to this command will include an authentication token for the new co
     "priority": 10,
     "argdesc": "<user> <course>",
     "desc": "(requires auth) Adds the given user as an instructor for the given course.",
-    "help": """\
-Help for command:
-  :add-instructor
-
-Usage examples:
-  :auth example-college/test-course/summer/2021 7b839a93c1012d2029cbe7d048716b34
-  :add-instructor test@example.com example-college/test-course/summer/2021
-
-Adds the given user as an instructor for the given course. Course-level authentication is required.
-"""
   },
   "create-assignment": {
     "name": "create-assignment",
@@ -1318,60 +1441,6 @@ Adds the given user as an instructor for the given course. Course-level authenti
     "priority": 10,
     "argdesc": "<course> <assignment>",
     "desc": "(requires auth) Creates a new assignment for the given course.",
-    "help": """\
-Help for command:
-  :create-assignment
-
-Usage examples:
-  :auth example-college/test-course/spring/2019 846fc9b98ac4b5a859d5ded801154ce6
-  :create-assignment
-    example-college/test-course/spring/2019
-    map{
-      name : quiz-1
-      type : quiz
-      value : 1.0
-      flags : list{ grade-late-immediately }
-  > This assignment will be published on January 25th at midnight (the beginning of the day, i.e., right after the end of January 24th):
-      publish : 2019-1-25T00:00:00
-  > It's due by the end of January 30th:
-      due : 2019-1-30T23:59:59
-  > But submissions won't really be marked as late until 4:00 a.m. on January 31st:
-      late-after : 2019-1-31T04:00:00
-  > Even late submissions won't be accepted after February 7th:
-      reject-after : 2019-2-8T00:00:00
-  > The 'problems' value defines individual problems. Be careful not to include a valid command (a word starting with a ':') in any of the problem definitions. The problems are parsed as a 'list{' of 'map{' blocks (see ':help list' and ':help map').
-      problems : list{
-        map{
-          name : 1
-          type : multiple-choice
-          flags : list{ randomize-order }
-          prompt : text{
-            If two trains leave New York and Boston travelling towards each other, one going 30 km/h and the other travelling at 70 km/h, which train will reach the other first? }
-          answers : map{
-            ny : text{ The New York train. }
-            bos : text{ The Boston train. }
-            same : text{ They will reach each other at the same time. }
-            sense : text{ This question doesn't make sense. }
-          }
-          solution : same
-        }
-        map{
-          name : text{ Problem 2 }
-          type : multiple-choice
-          prompt : text{ This is problem 2. Good luck. }
-          answers : map{
-            1 : text{ Um... }
-            2 : text{ what? }
-            3 : text{ This is not a good question. }
-          }
-          solution : 3
-        }
-      }
-    }
-
-
-':create-assignment' creates a new assignment in the given course. It requires two arguments: a course ID, tag, or alias, and an assignment map. For the details of the format of the assignment map, see ':help assignment'. ':help problem' gives details on the format of individual problems.
-"""
   },
   "list-assignments": {
     "name": "list-assignments",
@@ -1379,20 +1448,6 @@ Usage examples:
     "priority": 10,
     "argdesc": "[-any] [<course>]",
     "desc": "(auth optional) Lists all assignments for the given course (or all enrolled courses).",
-    "help": """\
-Help for command:
-  :list-assignments
-
-Usage examples:
-  :list-assignments
-  :list-assignments -any
-  :list-assignments example-college/test-course/spring/2019
-  :list-assignments -any example-college/test-course/spring/2019
-  :list-assignments example-college/test-course/spring/2019 -any
-  :list-assignments example-college/test-course/spring/2019 example-college/other-course/spring/2019
-
-Responds with a list of all currently-open assignments. You must be enrolled in a class to view assignments. If 'any' is given as an argument, closed assignments and submitted-to assignments will also be included. The list includes an assignment's status and name, information about your last submission time, and the due date or closing date. See also ':help assignment-status' and ':help submit'. If course auth is given, the command lists submission information.
-"""
   },
   "assignment-status": {
     "name": "assignment-status",
@@ -1400,15 +1455,6 @@ Responds with a list of all currently-open assignments. You must be enrolled in
     "priority": 10,
     "argdesc": "<course> <assignment>",
     "desc": "(auth optional) Shows the status of an assignment.",
-    "help": """\
-Help for command:
-  :assignment-status
-
-Usage examples:
-  :assignment-status example-college/test-course/spring/2000 quiz-1
-
-Responds with details about the specified assignment. These include the due date (or closing date for past-due assignments), your latest submission time, and your grade if the assignment has been graded. See also ':help list-assignments', ':help submit', and ':help assignment'. If course auth is given, additional information about grades and student submissions is displayed.
-"""
   },
   "assignment": {
     "name": "assignment",
@@ -1416,15 +1462,6 @@ Responds with details about the specified assignment. These include the due date
     "priority": 10,
     "argdesc": "<course> <assignment>",
     "desc": "Displays an assignment.",
-    "help": """\
-Help for command:
-  :assignment
-
-Usage examples:
-  :assignment example-college/test-course/spring/2000 quiz-1
-
-Responds with the requested assignment, including each problem and a solution template. See ':help submit' for how to submit answers.
-""" # TODO: require enrollment to view assignments/assignment statuses?
   },
   "view-submissions": {
     "name": "view-submissions",
@@ -1432,26 +1469,6 @@ Responds with the requested assignment, including each problem and a solution te
     "priority": 10,
     "argdesc": "[<user>] <course> <assignment> [-all]",
     "desc": "(requires auth) Shows the latest submission for an assignment.",
-    "help": """\
-Help for command:
-  :view-submissions
-
-Usage examples:
-  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
-  :view-submissions example-college/test-course/spring/2000 quiz-1
-
-  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
-  :view-submissions example-college/test-course/spring/2000 quiz-1 -all
-
-  :auth example-college/test-course/spring/2000 846fc9b98ac4b5a859d5ded801154ce6
-  :view-submissions other.user@example.com example-college/test-course/spring/2000 quiz-1 -all
-
-By default, responds with the content sender's latest submission to the given assignment in the given course. If '-all' is given, it will instead reply with all submissions to that assignment. This requires user authentication. If the assignment is past-due, both the latest-on-time and actual-latest submissions will be shown.
-
-If a user different from the sender is given, it requires course authentication for the course in question instead of user authentication.
-
-See also: ':help submit' and ':help assignment-status'.
-"""
   },
   "submit": {
     "name": "submit",
@@ -1459,200 +1476,23 @@ See also: ':help submit' and ':help assignment-status'.
     "priority": 10,
     "argdesc": "<course> <assignment> <content>",
     "desc": "(requires auth) Submits an assignment.",
-    "help": """\
-Help for command:
-  :submit
-
-Usage examples:
-  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
-  :submit example-college/test-course/fall/2004 quiz-1
-  map{
-    1 : A
-    2 : B
-    problem-name : Answer-selection
-    Q : text{ A sentence as an answer }
-  }
-
-Submits answers for an assignment. Requires user authentication as the sending user. You must be enrolled in the class that you're submitting to, and the assignment must be accepting submissions (see ':help assignment-status'). When you view an assignment with ':assignment' the last part of the result will include a submission template, it is a good idea to start by copying this template and then editing it to ensure your answers are correctly formatted. If your submission is badly formatted, you'll get an error message. You can use :view-submissions to check what you've submitted.
-
-In most cases, you can submit multiple times and only the most-recent submission will be used for grading. Be sure to consult your course syllabus or instructor about this however.
-"""
   },
-}
-
-TOPICS = {
-  "assignment": {
-    "name": "assignment",
-    "desc": "The format for specifying an assignment.",
-    "help": """\
-Help for topic:
-  assignment
-
-Usage examples:
-    map{
-      name : quiz-1
-      type : quiz
-      value : 1.0
-      flags : list{ shuffle-problems }
-      publish : 2019-1-25T00:00:00
-      due : 2019-1-30T23:59:59
-      late-after : 2019-1-31T04:00:00
-      reject-after : 2019-2-8T00:00:00
-      problems : list{
-        ...
-      }
-    }
-
-    The create-assignment command requires an assignment map as an argument. The meaning of assignment keys is as follows:
-
-  'name'
-    Specifies the name of the assignment. This must be unique within a course, and is used by students when submitting the assignment, so it should be short and simple.
-
-  'type'
-    The assignment type. See ':help assignment-types' for details.
-
-  'value'
-    The value of the assignment. Course grades are computed by summing the value of each assignment multiplied by the percentage score on that assignment, and are reported out of the total value of all assignments for a course.
-
-  'flags'
-    This key is optional, and specifies special properties of the assignment. The following flags are recognized:
-      'grade-immediately' -- Makes grade feedback available to students even before the submission deadline. Note that a student could look at feedback and then resubmit.
-      'grade-late-immediately' -- Makes grade feedback available to students after the submission deadline but before the assignment actually closes. Students could look at feedback and then resubmit (although any new submission would be late).
-      <NOT YET> 'shuffle-problems' -- The problems will be presented in a different order for each student.
-
-  'publish'
-    The date/time at which to publish the assignment. Times are given as YYYY-MM-DDTHH:MM:SS (see ':help time'). Before this time it won't be available to students.
-
-  'due'
-    The public date/time that the assignment is due as displayed to students.
-
-  'late-after'
-    The actual date/time after which submissions will be marked as late. It's often a good idea to set this time several hours after the display deadline so that you don't have to field complaints and excuses about last-minute submissions.
-
-  'reject-after'
-    The date/time after which even late submissions won't be accepted. It's a good idea to be liberal with this, because making exceptions to this deadline is a pain (the bot won't accept or keep track of assignments past the reject-after time). You can set up your late policy for a given assignment type to include a 0-credit deadline before this hard reject-after deadline.
-
-  'problems'
-    The value for this key must be a list of 'problem' maps (see ':help list', ':help map', and ':help problem').
-
-Note that any valid command will cut off the arguments of ':create-assignment', so commands cannot be included anywhere in assignment or problem definitions.
-"""
-  },
-  "problem": {
-    "name": "problem",
-    "desc": "The format for specifying a problem within an assignment.",
-    "help": """\
-Help for topic:
-  problem
-
-Usage examples:
-  map{
-    name : text{ Problem 1 }
-    type : multiple-choice
-    flags : list{ number-answers shuffle-answers }
-    prompt : text{ What is your favorite color? }
-    answers : map{
-      1 : Blue
-      2 : Green
-      3 : Grue
-      4 : text { I don't have a favorite color. }
-    }
-    solution : 3
-  }
-
-The  'assignment' map format (see ':help assignment') includes a list of problems. Each problem is defined using a 'map{' block (see ':help map') that must include the following keys/values:
-
-  'name'
-    This key should have a 'text{' or single-word value that defines the name of the problem. Single-word values are preferable because students need to use this name as part of their assignment submissions.
-
-  'type'
-    This key defines the problem type. See ':help problem-types' for a list of recognized problem types.
-
-  'flags'
-    This key is optional, and defines special properties of the problem. The following flags are recognized:
-      <NOT YET> 'number-answers' -- Use numbers instead of the given answer keys when presenting the answers.
-      <NOT YET> 'shuffle-answers' -- When presenting the problem, the order of the answers will be different for each student.
-
-  'prompt'
-    This key should have a 'text{' value that describes the problem and asks a question. This content will be shown before the list of answers.
-
-  'answers'
-    The value of the 'type' key dictates what the 'answer' key should hold. See ':help problem-types'.
-
-  'solution'
-    The meaning of this field is also controlled by the 'type' value, but it generally indicates which answer is correct.
-"""
-  },
-  "assignment-types": {
-    "name": "assignment-types",
-    "desc": "The valid assignment types and how they work.",
-    "help": """\
-Help for topic:
-  assignment-types
-
-Usage examples:
-  :create-assignment
-    example-college/test-course/spring/2019
-    quiz-1
-    quiz
-    ...
-
-The type argument to the ':create-assignment' command (see ':help create-assignment') specifies how the assignment is presented and managed. Valid types are:
-
-  'quiz'
-    A 'quiz' assignment just has a list of problems.
-"""
+  "submit-batch": {
+    "name": "submit-batch",
+    "run" : cmd_submit_batch,
+    "priority": 10,
+    "argdesc": "<course> <submissions>",
+    "desc": "(requires auth) Submits several assignments at once.",
   },
-  "problem-types": {
-    "name": "problem-types",
-    "desc": "The valid problem types and how they work.",
-    "help": """\
-Help for topic:
-  problem-types
-
-Usage examples:
-  map{
-    ...
-    type : multiple-choice
-    ...
-  }
-
-The 'type' field of the 'problem' format specifies how the 'answers' and 'solution' fields are interpreted (see ':help problem'). Valid problem types are:
-
-  'multiple-choice'
-    A 'multiple-choice' type problem uses a 'map{' for its 'answers' value, where each value represents an exclusive choice, and there is a single correct answer. Accordingly, it's 'solution' value should be a single token which matches one of the keys of the 'answers' map and specifies which value is correct.
-"""
+  "stats": {
+    "name": "stats",
+    "run" : cmd_stats,
+    "priority": 10,
+    "argdesc": "[prefix]",
+    "desc": "(admin only) Reports call counts and latencies for commands and storage functions.",
   },
-  "time": {
-    "name": "time",
-    "desc": "The format for specifying time values.",
-    "help": """\
-Help for topic:
-  time
-
-Usage examples:
-  1970-1-1T00:00:00
-
-  2016-08-30T18:00:00
-
-  2042-12-30T23:59:59
-
-  476-1-1T3:5:0
-
-When a time value needs to be specified, such as the due date for an assignment, it takes the format: YYYY-MM-DDTHH:MM:SS, where the 'T' is a literal 'T' character but the rest of the letters stand for the year, month, day, hour, minute, and second of the specified time. Where a value would begin with a 0 it may omit the 0, although this is only recommended for month and day values.
-
-Note that times are *always* understood in UTC, so you will have to figure out how your timezone and potentially daylight savings time differs from UTC. For example, a time given as:
-
-  2016-8-30T18:00:00
-
-would be eqivalent to 11:00 a.m. in Pacific Daylight Time, whereas
-
-  2016-11-30T18:00:00
+}
 
-is still 11:00 a.m. PDT, but is also 10:00 a.m. Pacific Standard Time (which would be wall-clock time on the west coast of North America in November as opposed to August).
+for c in COMMANDS.values():
+  c["run"] = stats.instrument("command." + c["name"], c["run"])
 
-Allowing courses to specify a timezone (and daylight savings rules) is a feature in development.
-"""
-    # TODO: Get timzeone stuff working.
-  },
-}
@@ -4,6 +4,34 @@ IMAP_PORT = 993
 SMTP_HOST = "smtp.pomona.edu"
 SMTP_PORT = 587
 
+# Whether to use IMAP over SSL and SMTP with STARTTLS (only turned off for
+# local testing; see loopback.py)
+IMAP_SSL = True
+SMTP_STARTTLS = True
+
+# Maximum number of messages fetched per IMAP round trip
+IMAP_FETCH_BATCH = 50
+
+# Only this many bytes of each incoming message are downloaded
+IMAP_MAX_MESSAGE_BYTES = 1024 * 1024
+
+# Incoming messages are parsed in chunks of this many bytes, and parsing
+# stops after the first non-empty text/plain part, of which only
+# MAX_BODY_CHARS characters are kept.
+PARSE_CHUNK_BYTES = 64 * 1024
+MAX_BODY_CHARS = 256 * 1024
+
+# The IMAP session is kept open between checks; if it has been idle this many
+# seconds it is checked with a NOOP (and reconnected if that fails).
+IMAP_NOOP_INTERVAL = 60 * 5
+
+# How often (in seconds) to check for shutdown while waiting in IMAP IDLE
+IDLE_CHECK_INTERVAL = 1
+
+# The SMTP session is also kept open between cycles; before sending, it is
+# checked with a NOOP if it has been idle this many seconds.
+SMTP_NOOP_INTERVAL = 30
+
 # Bot's name
 NAME = "CS Coursebot"
 
@@ -13,18 +41,166 @@ IMAP_USERNAME = "CSCourseBot"
 SMTP_USERNAME = "CSCourseBot"
 PASSWORD = None # input by user
 
-# Seconds between mailbox checks
+# Longest time (in seconds) to wait between mailbox checks. The server wakes
+# up sooner when a channel reports new messages or when a grading deadline or
+# token expiry comes up.
 INTERVAL = 5
 
+# Channels return at most this many messages per poll. When a poll comes back
+# full, the server starts its next cycle right away instead of waiting.
+POLL_BATCH = 200
+
+# Channels are polled and flushed concurrently on a pool of this many
+# threads. A channel that takes longer than CHANNEL_TIMEOUT seconds is left
+# running in the background and its results are collected in a later cycle.
+CHANNEL_WORKERS = 8
+CHANNEL_TIMEOUT = 30
+
+# Messages are processed on this many worker threads (each sender's messages
+# always go to the same worker, in order). Each cycle waits up to
+# DISPATCH_WAIT seconds for its messages to be processed before flushing
+# replies; anything slower is flushed in a later cycle.
+WORKERS = 4
+DISPATCH_WAIT = 30
+
+# On SIGTERM or SIGINT the server stops checking for messages and spends up to
+# SHUTDOWN_TIMEOUT seconds finishing the messages it has already received and
+# sending their replies. Anything left unfinished is redone on the next start
+# (a second signal stops right away).
+SHUTDOWN_TIMEOUT = 30
+
+# Each cycle processes at most ADMISSION_BUDGET messages; the rest wait for
+# later cycles, and channels aren't polled while more than
+# ADMISSION_MAX_PENDING messages are waiting. Waiting messages are taken by
+# priority class (lowest first): class 0 for messages from
+# ADMISSION_STAFF_ROLES that include one of ADMISSION_URGENT_COMMANDS, 1 for
+# other staff messages, 3 for messages that include one of
+# ADMISSION_BULK_COMMANDS, and 2 for everything else. A message moves up one
+# class for every ADMISSION_AGING seconds it waits, so nothing waits
+# forever, and a sender's messages are always processed in order.
+ADMISSION_BUDGET = 200
+ADMISSION_MAX_PENDING = 2000
+ADMISSION_AGING = 60
+ADMISSION_STAFF_ROLES = ("admin", "instructor")
+ADMISSION_URGENT_COMMANDS = (
+  "create-course",
+  "add-instructor",
+  "create-assignment",
+  "expect",
+  "grant",
+  "block",
+  "unblock",
+)
+ADMISSION_BULK_COMMANDS = ("submit", "submit-batch")
+
+# Timeout (in seconds) for blocking IMAP and SMTP socket operations
+MAIL_TIMEOUT = 60
+
+# How often (in seconds) file-backed channels check their source for changes
+# while waiting (see maildir.py)
+MAILBOX_CHECK_INTERVAL = 0.5
+
+# Only this many bytes of each message read by a file-backed channel are kept
+MAILBOX_MAX_MESSAGE_BYTES = 1024 * 1024
+
+# Per-sender rate limits, by role. Each sender gets a bucket holding up to
+# 'burst' messages which refills at 'per_hour' messages per hour; messages
+# arriving while the bucket is empty are dropped. A value of None means that
+# role isn't limited.
+RATE_LIMITS = {
+  "admin": None,
+  "instructor": { "burst": 60, "per_hour": 240 },
+  "default": { "burst": 20, "per_hour": 60 },
+  "non-user": { "burst": 5, "per_hour": 20 },
+}
+
+# Seconds between rate limiter checkpoints to the database
+RATE_LIMIT_CHECKPOINT = 60
+
 # How long temporary authentication tokens last (in seconds)
 TEMP_AUTH_INTERVAL = 60 * 30
 
 # Storage config
 DATABASE = "academibot.db"
+
+# Seconds a thread waits for another thread's database write to finish
+DB_BUSY_TIMEOUT = 30
 SUBMISSIONS_DIR = "submissions"
 
+# When the late deadline of an assignment in one of a sender's courses is less
+# than SURGE_WINDOW seconds away, their messages that only submit assignments
+# are appended to a log in SUBMISSIONS_DIR and answered with a receipt
+# straight away. A background
+# thread processes them as of the time they were received and replies with
+# the results, checking the log at least every SURGE_DRAIN_INTERVAL seconds.
+# None turns this off (see surge.py).
+SURGE_WINDOW = 60 * 15
+SURGE_DRAIN_INTERVAL = 5
+
+# Outgoing replies are stored in the database until sent. Failed sends are
+# retried after OUTBOX_BACKOFF seconds, doubling each time up to
+# OUTBOX_MAX_BACKOFF, and abandoned after OUTBOX_MAX_ATTEMPTS. Records of sent
+# replies are kept for OUTBOX_RETENTION seconds to prevent duplicates.
+OUTBOX_BACKOFF = 30
+OUTBOX_MAX_BACKOFF = 60 * 60
+OUTBOX_MAX_ATTEMPTS = 10
+OUTBOX_RETENTION = 60 * 60 * 24 * 7
+
+# The Message-Id and body hash of each processed message are remembered for
+# LEDGER_RETENTION seconds, and a message that arrives again in that time
+# (for example because the server restarted before marking it as seen) is
+# skipped.
+LEDGER_RETENTION = 60 * 60 * 24 * 30
+
+# Replies to the same recipient that are due at the same time are combined
+# into a single email (one per thread if COALESCE_BY_THREAD is set).
+COALESCE_REPLIES = True
+COALESCE_BY_THREAD = False
+
+# Submissions are graded by a separate worker process (see grader.py) that
+# takes them from a queue in the database, so that replies never wait on
+# grading. It claims up to GRADING_BATCH submissions at a time, checks the
+# queue every GRADING_POLL_INTERVAL seconds when idle, and looks for
+# submissions that have become due for grading every GRADING_SCAN_INTERVAL
+# seconds. Claims older than GRADING_CLAIM_TIMEOUT seconds are assumed to
+# belong to a crashed worker and are retried; a submission that fails to grade
+# GRADING_MAX_ATTEMPTS times is given up on. With GRADING_WORKER off,
+# submissions are graded inline by the server instead.
+GRADING_WORKER = True
+GRADING_BATCH = 20
+GRADING_POLL_INTERVAL = 0.5
+GRADING_SCAN_INTERVAL = 10
+GRADING_CLAIM_TIMEOUT = 60 * 10
+GRADING_MAX_ATTEMPTS = 3
+
 # Logging config
 LOGFILE = "academibot-trace.log"
 
+# The log is written by a background thread. If LOG_QUEUE_SIZE lines are
+# already waiting to be written, further lines are dropped (and counted)
+# rather than holding up the server (0 for no limit).
+LOG_QUEUE_SIZE = 10000
+
+# The log is rotated once it reaches LOG_MAX_BYTES bytes or has been written
+# to for LOG_ROTATE_INTERVAL seconds (None to disable either), keeping
+# LOG_BACKUPS old logs (gzipped if LOG_COMPRESS is set).
+LOG_MAX_BYTES = 50 * 1024 * 1024
+LOG_ROTATE_INTERVAL = 60 * 60 * 24
+LOG_BACKUPS = 7
+LOG_COMPRESS = True
+
+# Message bodies and responses are cut to this many characters in the log
+# (None for no limit).
+LOG_BODY_CHARS = 2000
+
+# Statistics are periodically written to this file (None to disable)
+STATS_FILE = "academibot-stats.txt"
+STATS_INTERVAL = 300 # seconds
+
+# If set, statistics are also served in the Prometheus text format over HTTP
+# on this port (see metrics.py). Only listens on METRICS_HOST.
+METRICS_PORT = None
+METRICS_HOST = "127.0.0.1"
+
 # Line length for wrapping format unparse:
 LINE_LENGTH = 80
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+grader.py
+The grading worker: a separate process that finds submissions which are due
+to be graded, takes them from the grading queue in the database (see
+storage.request_grading), grades them, and writes the results back, so that
+the server never waits on grading. Progress is reported through a heartbeat
+in the database's workers table, along with the worker's timings (see
+metrics.py).
+
+Usage: grader.py [DATABASE]
+"""
+
+import os
+import sys
+import time
+import traceback
+import multiprocessing
+
+import config
+import stats
+import storage
+
+WORKER_NAME = "grader"
+
+def run_worker(db_name, stop=None, name=WORKER_NAME):
+  """
+  Grades queued submissions until the given multiprocessing/threading Event
+  is set (or forever if there isn't one).
+  """
+  storage.setup(db_name)
+  pid = os.getpid()
+  started = storage.now_ts()
+  processed = 0
+  failed = 0
+  last_scan = None
+  while not (stop and stop.is_set()):
+    now = storage.now_ts()
+    claimed = []
+    try:
+      if last_scan == None or now - last_scan >= config.GRADING_SCAN_INTERVAL:
+        storage.maintain_grade_info(last_scan or 0, now)
+        last_scan = now
+      claimed = storage.claim_grading(name, now, config.GRADING_BATCH)
+      for sid in claimed:
+        success, msg = storage.set_grade_info(sid)
+        storage.grading_done(sid, success, None if success else msg)
+        processed += 1
+        if not success:
+          failed += 1
+          print(msg, file=sys.stderr)
+      storage.worker_heartbeat(
+        name,
+        pid,
+        started,
+        storage.now_ts(),
+        processed,
+        failed,
+        stats.summary()
+      )
+    except Exception:
+      traceback.print_exc()
+      sys.stderr.flush()
+    if not claimed:
+      if stop:
+        stop.wait(config.GRADING_POLL_INTERVAL)
+      else:
+        time.sleep(config.GRADING_POLL_INTERVAL)
+  storage.close_db()
+
+class GraderProcess:
+  """
+  Runs run_worker in a child process. The child is started fresh (not
+  forked) so that it doesn't inherit the server's threads or database
+  connections.
+  """
+  def __init__(self, db_name):
+    self.db_name = db_name
+    self.context = multiprocessing.get_context("spawn")
+    self.stop_event = None
+    self.process = None
+
+  def start(self):
+    self.stop_event = self.context.Event()
+    self.process = self.context.Process(
+      target=run_worker,
+      args=(self.db_name, self.stop_event),
+      name=WORKER_NAME,
+      daemon=True
+    )
+    self.process.start()
+
+  def check(self):
+    """
+    Restarts the worker if it has exited. Returns the exit code of the old
+    process if it had to be restarted, and None otherwise.
+    """
+    if self.process.is_alive():
+      return None
+    code = self.process.exitcode
+    self.start()
+    return code
+
+  def stop(self, timeout=10):
+    """
+    Asks the worker to finish its current batch and exit, killing it if it
+    hasn't after timeout seconds.
+    """
+    if self.process == None:
+      return
+    self.stop_event.set()
+    self.process.join(timeout)
+    if self.process.is_alive():
+      self.process.terminate()
+      self.process.join()
+
+if __name__ == "__main__":
+  if len(sys.argv) > 2:
+    print(__doc__.strip())
+    exit(1)
+  run_worker(sys.argv[1] if len(sys.argv) > 1 else config.DATABASE)
@@ -0,0 +1,495 @@
+"""
+helptext.py
+Help text for academibot's commands and general help topics. This is only
+imported when help is requested (see commands.help_index).
+"""
+
+COMMAND_HELP = {
+  "help": """\
+Help for command:
+  :help
+
+Usage examples:
+  :help
+
+  :help help
+
+The help command. Replies with a general help message, or with help for a specific command if given as ":help <command>". For example you got this message because you sent a command ":help help". Note that the command name for the argument to help may not include the leading colon, or it will be interpreted as a command itself.
+""",
+  "auth": """\
+Help for command:
+  :auth
+
+Usage examples:
+  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
+
+  :auth example-college/test-course/winter/2035 cec46ec5145ab51eb92fafa418768686
+
+  :auth #register fab9df15f2f0897f0043393c45326d10
+
+Authenticates for a given purpose, enabling all commands in the same email requiring that specific privilege to function (:auth runs before other commands). You will receive an authentication token from academibot when you need one (for example, when you register you will receive a temporary token for registration, and then your permanent user token).
+    
+For user authentication, use your email as the <purpose>. To authenticate with a temporary token, use the token's purpose, preceded by a '#' sign (with no space in between). For course authentication, use either the numeric course ID, the full course tag (institution/course/term/year) or an alias that you have set up for that course.
+
+You can use the ':scramble' command to reset permanent authentication tokens if you need to; temporary tokens can generally be re-requested by re-issuing the command that generated them.
+""",
+  "user": """\
+Help for command:
+  :user
+
+Usage examples:
+  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
+  :user test@example.com
+
+Tells academibot who you are, when you are sending email from another account. For example, if you are registered as "test@example.com" but you have another account "test@gmail.com" from which you send mail to academibot, your mail from "test@gmail.com" should contain the command ":user test@example.com". Naturally, this requires the specified sender's authorization token.
+""",
+  "scramble": """\
+Help for command:
+  :scramble
+
+Usage examples:
+  :auth test@example.com 15a0e830704e89a3c80b2c2995067241
+  :scramble test@example.com
+
+  :auth example-college/test-course/winter/2035 cec46ec5145ab51eb92fafa418768686
+  :scramble example-college/test-course/winter/2035
+
+Generates a fresh authentication token for the given user or course. Requires appropriate authorization (the old auth token). :scramble isn't run until after all other commands, so :auth commands using the old token will still work for the email in which :scramble is sent.
+""",
+  "register": """\
+Help for command:
+  :register
+
+Usage examples:
+  :register
+
+  :auth #register 99dc985e08fcfb28382186ab8e3d6cc2
+  :register
+
+Registers the sender as a new user, which is required before enrolling in courses and submitting assignments. First use will generate a temporary authentication token in reply, which should be used with ':auth #register' and a second register command to actually register. Does nothing if the sender is already registered. Use :status to view role and status info.
+""",
+  "status": """\
+Help for command:
+  :status
+
+Usage examples:
+  :status
+
+Responds with information about the sender's role and status. Roles give users special permissions (like the ability to create new courses and register students). Most users have the 'default' role. Statuses indicate whether a user is 'active,' or an 'alias.'
+""",
+  "block": """\
+Help for command:
+  :block
+
+Usage examples:
+  :block
+
+Adds the sender to the 'blocking' list which prevents academibot from sending any mail to them and prevents academibot from processing their commands. The only exception to this is the ':unblock' command, which will remove them from the 'blocking' list. Commands sent in the same email as a ':block' or ':unblock' command will be processed normally and will generate responses. You can be on the 'blocking' list without being registered.
+""",
+  "unblock": """\
+Help for command:
+  :unblock
+
+Usage examples:
+  :unblock
+
+Reverses a previous ':block' command, removing the sender from the 'blocking' list. Commands sent in the same email as a ':block' or ':unblock' command will be processed normally and will generate responses. If ':block' and ':unblock' are sent in the same message, the final status of the sender depends on their order within the message, but all other commands in the message will be processed and generate responses regardless of their order in relation to the ':block' and ':unblock' commands. You can be on the 'blocking' list without being registered.
+""",
+  "expect": """\
+Help for command:
+  :expect
+
+Usage examples:
+  :auth example-college/test-course/fall/2016 99dc985e08fcfb28382186ab8e3d6cc2
+  :expect test-course test@example.com
+    more@example.com
+    with_commas@example.com,
+    this_is_fine@example.com
+
+For a user to enroll in a course, they must be expected. An instructor for the course should enter each student's email via this command before asking students to enroll in the course. Multiple emails can be entered across multiple lines, and commas are ignored. The first argument is the course in which to expect students; authorization for that course must be entered beforehand.
+""",
+  "enroll": """\
+Help for command:
+  :enroll
+
+Usage examples:
+  :enroll example-college/test-course/fall/2016
+
+Enrolls the sender in the given course. Ask your instructor for the correct course ID or tag. You won't be able to enroll unless your instructor has already added you to the course roster, so if you get an error about unexpected enrollment, ask your instructor to add you  using the ':expect' command.
+""",
+  "request": """\
+Help for command:
+  :request
+
+Usage examples:
+  :request role instructor
+
+Used to submit a request for a particular status or permission, which can then be granted by an admin using ':grant'. The ':grant' command may also happen before the ':request' command, in which case the change is pre-approved and takes place immediately.
+""",
+  "grant": """\
+Help for command:
+  :grant
+
+Usage examples:
+  :auth admin@example.com a46590b7c08591b4b1a62417c8b68fe0
+  :grant test@example.com role instructor
+
+Grants a user's request. It requires user authorization from the granting party (the sender). Use ':requests' to view outstanding requests. ':grant' may also be used preemtively, in which case when a user submits a request, it will immediately be approved. Requests are one-time transactions: if a user requires multiple requests of the same type they must be granted permission multiple times.
+""",
+  "create-course": """\
+Help for command:
+  :create-course
+
+Usage examples:
+  :auth instructor@example.com c3ed3ab84e43f0c74a35b206ec43149a
+  :create-course example-college test-course spring 1948
+
+Creates a new course and assigns the creator as an instructor. It requires user authentication for the creator (the sender) who must be have either the 'admin' or 'instructor' role system-wide (this is different from being an instructor on a course). Note that none of the course elements may contain the '@' or '/' symbols.
+
+The response to this command will include an authentication token for the new course, which the creator should keep track of.
+""",
+  "add-instructor": """\
+Help for command:
+  :add-instructor
+
+Usage examples:
+  :auth example-college/test-course/summer/2021 7b839a93c1012d2029cbe7d048716b34
+  :add-instructor test@example.com example-college/test-course/summer/2021
+
+Adds the given user as an instructor for the given course. Course-level authentication is required.
+""",
+  "create-assignment": """\
+Help for command:
+  :create-assignment
+
+Usage examples:
+  :auth example-college/test-course/spring/2019 846fc9b98ac4b5a859d5ded801154ce6
+  :create-assignment
+    example-college/test-course/spring/2019
+    map{
+      name : quiz-1
+      type : quiz
+      value : 1.0
+      flags : list{ grade-late-immediately }
+  > This assignment will be published on January 25th at midnight (the beginning of the day, i.e., right after the end of January 24th):
+      publish : 2019-1-25T00:00:00
+  > It's due by the end of January 30th:
+      due : 2019-1-30T23:59:59
+  > But submissions won't really be marked as late until 4:00 a.m. on January 31st:
+      late-after : 2019-1-31T04:00:00
+  > Even late submissions won't be accepted after February 7th:
+      reject-after : 2019-2-8T00:00:00
+  > The 'problems' value defines individual problems. Be careful not to include a valid command (a word starting with a ':') in any of the problem definitions. The problems are parsed as a 'list{' of 'map{' blocks (see ':help list' and ':help map').
+      problems : list{
+        map{
+          name : 1
+          type : multiple-choice
+          flags : list{ randomize-order }
+          prompt : text{
+            If two trains leave New York and Boston travelling towards each other, one going 30 km/h and the other travelling at 70 km/h, which train will reach the other first? }
+          answers : map{
+            ny : text{ The New York train. }
+            bos : text{ The Boston train. }
+            same : text{ They will reach each other at the same time. }
+            sense : text{ This question doesn't make sense. }
+          }
+          solution : same
+        }
+        map{
+          name : text{ Problem 2 }
+          type : multiple-choice
+          prompt : text{ This is problem 2. Good luck. }
+          answers : map{
+            1 : text{ Um... }
+            2 : text{ what? }
+            3 : text{ This is not a good question. }
+          }
+          solution : 3
+        }
+      }
+    }
+
+
+':create-assignment' creates a new assignment in the given course. It requires two arguments: a course ID, tag, or alias, and an assignment map. For the details of the format of the assignment map, see ':help assignment'. ':help problem' gives details on the format of individual problems.
+""",
+  "list-assignments": """\
+Help for command:
+  :list-assignments
+
+Usage examples:
+  :list-assignments
+  :list-assignments -any
+  :list-assignments example-college/test-course/spring/2019
+  :list-assignments -any example-college/test-course/spring/2019
+  :list-assignments example-college/test-course/spring/2019 -any
+  :list-assignments example-college/test-course/spring/2019 example-college/other-course/spring/2019
+
+Responds with a list of all currently-open assignments. You must be enrolled in a class to view assignments. If 'any' is given as an argument, closed assignments and submitted-to assignments will also be included. The list includes an assignment's status and name, information about your last submission time, and the due date or closing date. See also ':help assignment-status' and ':help submit'. If course auth is given, the command lists submission information.
+""",
+  "assignment-status": """\
+Help for command:
+  :assignment-status
+
+Usage examples:
+  :assignment-status example-college/test-course/spring/2000 quiz-1
+
+Responds with details about the specified assignment. These include the due date (or closing date for past-due assignments), your latest submission time, and your grade if the assignment has been graded. See also ':help list-assignments', ':help submit', and ':help assignment'. If course auth is given, additional information about grades and student submissions is displayed.
+""",
+  "assignment": """\
+Help for command:
+  :assignment
+
+Usage examples:
+  :assignment example-college/test-course/spring/2000 quiz-1
+
+Responds with the requested assignment, including each problem and a solution template. See ':help submit' for how to submit answers.
+""", # TODO: require enrollment to view assignments/assignment statuses?
+  "view-submissions": """\
+Help for command:
+  :view-submissions
+
+Usage examples:
+  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
+  :view-submissions example-college/test-course/spring/2000 quiz-1
+
+  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
+  :view-submissions example-college/test-course/spring/2000 quiz-1 -all
+
+  :auth example-college/test-course/spring/2000 846fc9b98ac4b5a859d5ded801154ce6
+  :view-submissions other.user@example.com example-college/test-course/spring/2000 quiz-1 -all
+
+By default, responds with the content sender's latest submission to the given assignment in the given course. If '-all' is given, it will instead reply with all submissions to that assignment. This requires user authentication. If the assignment is past-due, both the latest-on-time and actual-latest submissions will be shown.
+
+If a user different from the sender is given, it requires course authentication for the course in question instead of user authentication.
+
+See also: ':help submit' and ':help assignment-status'.
+""",
+  "submit": """\
+Help for command:
+  :submit
+
+Usage examples:
+  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
+  :submit example-college/test-course/fall/2004 quiz-1
+  map{
+    1 : A
+    2 : B
+    problem-name : Answer-selection
+    Q : text{ A sentence as an answer }
+  }
+
+Submits answers for an assignment. Requires user authentication as the sending user. You must be enrolled in the class that you're submitting to, and the assignment must be accepting submissions (see ':help assignment-status'). When you view an assignment with ':assignment' the last part of the result will include a submission template, it is a good idea to start by copying this template and then editing it to ensure your answers are correctly formatted. If your submission is badly formatted, you'll get an error message. You can use :view-submissions to check what you've submitted.
+
+In most cases, you can submit multiple times and only the most-recent submission will be used for grading. Be sure to consult your course syllabus or instructor about this however.
+""",
+  "submit-batch": """\
+Help for command:
+  :submit-batch
+
+Usage examples:
+  :auth me@example.com c3ed3ab84e43f0c74a35b206ec43149a
+  :submit-batch example-college/test-course/fall/2004
+  map{
+    quiz-1 : map{
+      1 : A
+      2 : B
+    }
+    quiz-2 : map{
+      1 : C
+      text{ Problem 2 } : A
+    }
+  }
+
+Submits answers for several assignments in the same course at once. The second argument is a map from assignment names to answers maps, where each answers map has the same format used by ':submit'. Each submission is checked separately: valid submissions are added even if others in the batch have errors, and the reply includes a line for each assignment saying whether it was accepted. The same requirements as for ':submit' apply (see ':help submit').
+""",
+  "stats": """\
+Help for command:
+  :stats
+
+Usage examples:
+  :auth admin@example.com a46590b7c08591b4b1a62417c8b68fe0
+  :stats
+
+  :auth admin@example.com a46590b7c08591b4b1a62417c8b68fe0
+  :stats command.
+
+Reports statistics gathered since academibot started: for each command and storage function, the number of calls and errors, the total time spent, the mean and percentile latencies (in milliseconds, over recent calls), and the number of database rows changed. If a prefix is given, only entries whose names start with it are included (for example 'command.' or 'storage.'). Requires user authentication as an admin.
+""",
+}
+
+TOPICS = {
+  "assignment": {
+    "name": "assignment",
+    "desc": "The format for specifying an assignment.",
+    "help": """\
+Help for topic:
+  assignment
+
+Usage examples:
+    map{
+      name : quiz-1
+      type : quiz
+      value : 1.0
+      flags : list{ shuffle-problems }
+      publish : 2019-1-25T00:00:00
+      due : 2019-1-30T23:59:59
+      late-after : 2019-1-31T04:00:00
+      reject-after : 2019-2-8T00:00:00
+      problems : list{
+        ...
+      }
+    }
+
+    The create-assignment command requires an assignment map as an argument. The meaning of assignment keys is as follows:
+
+  'name'
+    Specifies the name of the assignment. This must be unique within a course, and is used by students when submitting the assignment, so it should be short and simple.
+
+  'type'
+    The assignment type. See ':help assignment-types' for details.
+
+  'value'
+    The value of the assignment. Course grades are computed by summing the value of each assignment multiplied by the percentage score on that assignment, and are reported out of the total value of all assignments for a course.
+
+  'flags'
+    This key is optional, and specifies special properties of the assignment. The following flags are recognized:
+      'grade-immediately' -- Makes grade feedback available to students even before the submission deadline. Note that a student could look at feedback and then resubmit.
+      'grade-late-immediately' -- Makes grade feedback available to students after the submission deadline but before the assignment actually closes. Students could look at feedback and then resubmit (although any new submission would be late).
+      <NOT YET> 'shuffle-problems' -- The problems will be presented in a different order for each student.
+
+  'publish'
+    The date/time at which to publish the assignment. Times are given as YYYY-MM-DDTHH:MM:SS (see ':help time'). Before this time it won't be available to students.
+
+  'due'
+    The public date/time that the assignment is due as displayed to students.
+
+  'late-after'
+    The actual date/time after which submissions will be marked as late. It's often a good idea to set this time several hours after the display deadline so that you don't have to field complaints and excuses about last-minute submissions.
+
+  'reject-after'
+    The date/time after which even late submissions won't be accepted. It's a good idea to be liberal with this, because making exceptions to this deadline is a pain (the bot won't accept or keep track of assignments past the reject-after time). You can set up your late policy for a given assignment type to include a 0-credit deadline before this hard reject-after deadline.
+
+  'problems'
+    The value for this key must be a list of 'problem' maps (see ':help list', ':help map', and ':help problem').
+
+Note that any valid command will cut off the arguments of ':create-assignment', so commands cannot be included anywhere in assignment or problem definitions.
+"""
+  },
+  "problem": {
+    "name": "problem",
+    "desc": "The format for specifying a problem within an assignment.",
+    "help": """\
+Help for topic:
+  problem
+
+Usage examples:
+  map{
+    name : text{ Problem 1 }
+    type : multiple-choice
+    flags : list{ number-answers shuffle-answers }
+    prompt : text{ What is your favorite color? }
+    answers : map{
+      1 : Blue
+      2 : Green
+      3 : Grue
+      4 : text { I don't have a favorite color. }
+    }
+    solution : 3
+  }
+
+The  'assignment' map format (see ':help assignment') includes a list of problems. Each problem is defined using a 'map{' block (see ':help map') that must include the following keys/values:
+
+  'name'
+    This key should have a 'text{' or single-word value that defines the name of the problem. Single-word values are preferable because students need to use this name as part of their assignment submissions.
+
+  'type'
+    This key defines the problem type. See ':help problem-types' for a list of recognized problem types.
+
+  'flags'
+    This key is optional, and defines special properties of the problem. The following flags are recognized:
+      <NOT YET> 'number-answers' -- Use numbers instead of the given answer keys when presenting the answers.
+      <NOT YET> 'shuffle-answers' -- When presenting the problem, the order of the answers will be different for each student.
+
+  'prompt'
+    This key should have a 'text{' value that describes the problem and asks a question. This content will be shown before the list of answers.
+
+  'answers'
+    The value of the 'type' key dictates what the 'answer' key should hold. See ':help problem-types'.
+
+  'solution'
+    The meaning of this field is also controlled by the 'type' value, but it generally indicates which answer is correct.
+"""
+  },
+  "assignment-types": {
+    "name": "assignment-types",
+    "desc": "The valid assignment types and how they work.",
+    "help": """\
+Help for topic:
+  assignment-types
+
+Usage examples:
+  :create-assignment
+    example-college/test-course/spring/2019
+    quiz-1
+    quiz
+    ...
+
+The type argument to the ':create-assignment' command (see ':help create-assignment') specifies how the assignment is presented and managed. Valid types are:
+
+  'quiz'
+    A 'quiz' assignment just has a list of problems.
+"""
+  },
+  "problem-types": {
+    "name": "problem-types",
+    "desc": "The valid problem types and how they work.",
+    "help": """\
+Help for topic:
+  problem-types
+
+Usage examples:
+  map{
+    ...
+    type : multiple-choice
+    ...
+  }
+
+The 'type' field of the 'problem' format specifies how the 'answers' and 'solution' fields are interpreted (see ':help problem'). Valid problem types are:
+
+  'multiple-choice'
+    A 'multiple-choice' type problem uses a 'map{' for its 'answers' value, where each value represents an exclusive choice, and there is a single correct answer. Accordingly, it's 'solution' value should be a single token which matches one of the keys of the 'answers' map and specifies which value is correct.
+"""
+  },
+  "time": {
+    "name": "time",
+    "desc": "The format for specifying time values.",
+    "help": """\
+Help for topic:
+  time
+
+Usage examples:
+  1970-1-1T00:00:00
+
+  2016-08-30T18:00:00
+
+  2042-12-30T23:59:59
+
+  476-1-1T3:5:0
+
+When a time value needs to be specified, such as the due date for an assignment, it takes the format: YYYY-MM-DDTHH:MM:SS, where the 'T' is a literal 'T' character but the rest of the letters stand for the year, month, day, hour, minute, and second of the specified time. Where a value would begin with a 0 it may omit the 0, although this is only recommended for month and day values.
+
+Note that times are *always* understood in UTC, so you will have to figure out how your timezone and potentially daylight savings time differs from UTC. For example, a time given as:
+
+  2016-8-30T18:00:00
+
+would be eqivalent to 11:00 a.m. in Pacific Daylight Time, whereas
+
+  2016-11-30T18:00:00
+
+is still 11:00 a.m. PDT, but is also 10:00 a.m. Pacific Standard Time (which would be wall-clock time on the west coast of North America in November as opposed to August).
+
+Allowing courses to specify a timezone (and daylight savings rules) is a feature in development.
+"""
+    # TODO: Get timzeone stuff working.
+  },
+}
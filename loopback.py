@@ -0,0 +1,377 @@
+"""
+loopback.py
+A minimal IMAP4/SMTP stand-in server that runs on localhost, so that the mail
+channels can be tested and benchmarked end-to-end without a network or a real
+mail server. Only the commands that academibot uses are supported, without
+authentication checks or TLS.
+"""
+
+import asyncio
+import threading
+import collections
+import time
+import email.utils
+
+import config
+
+CAPABILITIES = b"IMAP4rev1 IDLE"
+
+def compose(sender, body, subject="test", mid=None, to="bot@test.test"):
+  """
+  Returns the raw bytes of a simple plain-text email.
+  """
+  return (
+    "From: {sender}\r\n"
+    "To: {to}\r\n"
+    "Subject: {subject}\r\n"
+    "Date: {date}\r\n"
+    "Message-Id: {mid}\r\n"
+    "\r\n"
+    "{body}\r\n"
+  ).format(
+    sender=sender,
+    to=to,
+    subject=subject,
+    date=email.utils.formatdate(),
+    mid=mid or email.utils.make_msgid(domain="loopback"),
+    body=body.replace("\n", "\r\n")
+  ).encode()
+
+def parse_uid_set(text, max_uid):
+  """
+  Parses an IMAP sequence set like '1,3:5,7:*' into a set of UIDs.
+  """
+  result = set()
+  for part in text.split(","):
+    if ":" in part:
+      lo, hi = part.split(":")
+      lo = max_uid if lo == "*" else int(lo)
+      hi = max_uid if hi == "*" else int(hi)
+      result.update(range(min(lo, hi), max(lo, hi) + 1))
+    else:
+      result.add(max_uid if part == "*" else int(part))
+  return result
+
+class LoopbackServer:
+  """
+  Serves a single INBOX over IMAP and accepts mail over SMTP, on ephemeral
+  localhost ports, from an event loop running in a background thread. Use
+  deliver to add messages to the INBOX; mail sent to the server is recorded
+  in 'sent' as (sender, recipients, raw) tuples, and 'commands' counts the
+  commands received. Used as a context manager, it also points config at
+  itself (restoring the old settings on exit).
+  """
+  def __init__(self, host="127.0.0.1"):
+    self.host = host
+    self.imap_port = None
+    self.smtp_port = None
+    self.lock = threading.Lock()
+    self.mailbox = [] # [uid, raw, seen] lists
+    self.next_uid = 1
+    self.uidvalidity = int(time.time())
+    self.sent = []
+    self.commands = collections.Counter()
+    self.idlers = set()
+    self.writers = set()
+    self.loop = None
+    self.thread = None
+    self.saved_config = None
+
+  def start(self):
+    ready = threading.Event()
+    def run():
+      self.loop = asyncio.new_event_loop()
+      asyncio.set_event_loop(self.loop)
+      servers = [
+        self.loop.run_until_complete(
+          asyncio.start_server(handler, self.host, 0)
+        )
+        for handler in (self.imap_session, self.smtp_session)
+      ]
+      self.imap_port = servers[0].sockets[0].getsockname()[1]
+      self.smtp_port = servers[1].sockets[0].getsockname()[1]
+      ready.set()
+      self.loop.run_forever()
+      for s in servers:
+        s.close()
+      for w in list(self.writers):
+        w.close()
+      tasks = asyncio.all_tasks(self.loop)
+      if tasks:
+        self.loop.run_until_complete(asyncio.wait(tasks))
+      self.loop.close()
+    self.thread = threading.Thread(target=run, daemon=True)
+    self.thread.start()
+    ready.wait()
+    return self
+
+  def stop(self):
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+
+  def configure(self):
+    """
+    Points config at this server, saving the old settings.
+    """
+    names = [
+      "IMAP_HOST", "IMAP_PORT", "SMTP_HOST", "SMTP_PORT", "IMAP_SSL",
+      "SMTP_STARTTLS"
+    ]
+    self.saved_config = { n: getattr(config, n) for n in names }
+    config.IMAP_HOST = self.host
+    config.IMAP_PORT = self.imap_port
+    config.SMTP_HOST = self.host
+    config.SMTP_PORT = self.smtp_port
+    config.IMAP_SSL = False
+    config.SMTP_STARTTLS = False
+
+  def restore(self):
+    for n, v in self.saved_config.items():
+      setattr(config, n, v)
+
+  def __enter__(self):
+    self.start()
+    self.configure()
+    return self
+
+  def __exit__(self, *exc):
+    self.restore()
+    self.stop()
+
+  def deliver(self, raw):
+    """
+    Adds a message (raw bytes) to the INBOX, waking up any IDLE sessions.
+    Safe to call from any thread. Returns the new message's UID.
+    """
+    with self.lock:
+      uid = self.next_uid
+      self.next_uid += 1
+      self.mailbox.append([uid, raw, False])
+    if self.loop:
+      for event in list(self.idlers):
+        self.loop.call_soon_threadsafe(event.set)
+    return uid
+
+  def unseen(self):
+    with self.lock:
+      return len([m for m in self.mailbox if not m[2]])
+
+  async def imap_session(self, reader, writer):
+    self.writers.add(writer)
+    writer.write(b"* OK loopback IMAP4rev1 ready\r\n")
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        parts = line.decode().rstrip("\r\n").split(" ", 2)
+        if len(parts) < 2:
+          writer.write(b"* BAD empty command\r\n")
+          continue
+        tag = parts[0].encode()
+        command = parts[1].upper()
+        args = parts[2] if len(parts) > 2 else ""
+        if command == "UID":
+          command, args = (args.split(" ", 1) + [""])[:2]
+          command = "UID " + command.upper()
+        self.commands[command] += 1
+        if command == "IDLE":
+          await self.imap_idle(tag, reader, writer)
+        elif command == "LOGOUT":
+          writer.write(b"* BYE loopback logging out\r\n")
+          writer.write(tag + b" OK LOGOUT completed\r\n")
+          await writer.drain()
+          break
+        else:
+          writer.write(self.imap_command(tag, command, args))
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self.writers.discard(writer)
+      writer.close()
+
+  def imap_command(self, tag, command, args):
+    """
+    Returns the response to a single (non-IDLE) IMAP command.
+    """
+    ok = tag + b" OK " + command.encode() + b" completed\r\n"
+    if command == "CAPABILITY":
+      return b"* CAPABILITY " + CAPABILITIES + b"\r\n" + ok
+    elif command in ("LOGIN", "NOOP", "CLOSE", "EXPUNGE"):
+      return ok
+    elif command in ("SELECT", "EXAMINE"):
+      with self.lock:
+        exists = len(self.mailbox)
+        uidnext = self.next_uid
+      return (
+        b"* %d EXISTS\r\n" % exists
+      + b"* 0 RECENT\r\n"
+      + b"* FLAGS (\\Seen)\r\n"
+      + b"* OK [UIDVALIDITY %d] UIDs valid\r\n" % self.uidvalidity
+      + b"* OK [UIDNEXT %d] predicted next UID\r\n" % uidnext
+      + tag + b" OK [READ-WRITE] SELECT completed\r\n"
+      )
+    elif command == "UID SEARCH":
+      return (
+        b"* SEARCH"
+      + b"".join(b" %d" % uid for uid in self.search(args.split()))
+      + b"\r\n"
+      + ok
+      )
+    elif command == "UID FETCH":
+      uid_set, items = args.split(" ", 1)
+      limit = None
+      if "<0." in items:
+        limit = int(items.split("<0.")[1].split(">")[0])
+      response = b""
+      for seq, (uid, raw, seen) in self.select_uids(uid_set):
+        body = raw[:limit] if limit else raw
+        response += (
+          b"* %d FETCH (UID %d BODY[]%s {%d}\r\n" % (
+            seq,
+            uid,
+            b"<0>" if limit else b"",
+            len(body)
+          )
+        + body
+        + b")\r\n"
+        )
+      return response + ok
+    elif command == "UID STORE":
+      uid_set, action, flags = args.split(" ", 2)
+      response = b""
+      for seq, message in self.select_uids(uid_set):
+        if "\\Seen" in flags:
+          message[2] = not action.startswith("-")
+        response += b"* %d FETCH (UID %d FLAGS (%s))\r\n" % (
+          seq,
+          message[0],
+          b"\\Seen" if message[2] else b""
+        )
+      return response + ok
+    else:
+      return tag + b" BAD unsupported command\r\n"
+
+  def search(self, criteria):
+    """
+    Returns the UIDs matching a list of search criteria (only ALL, SEEN,
+    UNSEEN, and UID <set> are supported).
+    """
+    with self.lock:
+      matches = list(self.mailbox)
+      max_uid = self.next_uid - 1
+    i = 0
+    while i < len(criteria):
+      c = criteria[i].upper()
+      if c == "UNSEEN":
+        matches = [m for m in matches if not m[2]]
+      elif c == "SEEN":
+        matches = [m for m in matches if m[2]]
+      elif c == "UID":
+        i += 1
+        uids = parse_uid_set(criteria[i], max_uid)
+        matches = [m for m in matches if m[0] in uids]
+      i += 1
+    return [m[0] for m in matches]
+
+  def select_uids(self, uid_set):
+    """
+    Returns (sequence number, message) pairs for the messages in the given
+    UID set.
+    """
+    with self.lock:
+      uids = parse_uid_set(uid_set, self.next_uid - 1)
+      return [
+        (seq + 1, m) for seq, m in enumerate(self.mailbox) if m[0] in uids
+      ]
+
+  async def imap_idle(self, tag, reader, writer):
+    """
+    Handles an IDLE command, reporting new messages until the client sends
+    DONE.
+    """
+    event = asyncio.Event()
+    self.idlers.add(event)
+    with self.lock:
+      known = len(self.mailbox)
+    writer.write(b"+ idling\r\n")
+    await writer.drain()
+    done = asyncio.ensure_future(reader.readline())
+    try:
+      while True:
+        with self.lock:
+          exists = len(self.mailbox)
+        if exists > known:
+          known = exists
+          writer.write(b"* %d EXISTS\r\n" % exists)
+          await writer.drain()
+        waiter = asyncio.ensure_future(event.wait())
+        finished, pending = await asyncio.wait(
+          [done, waiter],
+          return_when=asyncio.FIRST_COMPLETED
+        )
+        if done in finished:
+          waiter.cancel()
+          break
+        event.clear()
+    finally:
+      self.idlers.discard(event)
+    if done.result().strip().upper() == b"DONE":
+      writer.write(tag + b" OK IDLE terminated\r\n")
+    else:
+      writer.write(tag + b" BAD expected DONE\r\n")
+
+  async def smtp_session(self, reader, writer):
+    self.writers.add(writer)
+    writer.write(b"220 loopback ESMTP ready\r\n")
+    sender = None
+    recipients = []
+    try:
+      while True:
+        line = await reader.readline()
+        if not line:
+          break
+        command = line.decode().rstrip("\r\n")
+        verb = command.split(" ", 1)[0].upper()
+        self.commands["SMTP " + verb] += 1
+        if verb == "EHLO":
+          writer.write(b"250-loopback\r\n250-AUTH PLAIN\r\n250 8BITMIME\r\n")
+        elif verb == "HELO":
+          writer.write(b"250 loopback\r\n")
+        elif verb == "AUTH":
+          writer.write(b"235 2.7.0 authentication successful\r\n")
+        elif verb == "MAIL":
+          sender = email.utils.parseaddr(command.split(":", 1)[1])[1]
+          recipients = []
+          writer.write(b"250 OK\r\n")
+        elif verb == "RCPT":
+          recipients.append(email.utils.parseaddr(command.split(":", 1)[1])[1])
+          writer.write(b"250 OK\r\n")
+        elif verb == "DATA":
+          writer.write(b"354 end data with <CR><LF>.<CR><LF>\r\n")
+          await writer.drain()
+          lines = []
+          while True:
+            data = await reader.readline()
+            if not data or data == b".\r\n":
+              break
+            if data.startswith(b".."):
+              data = data[1:]
+            lines.append(data)
+          self.sent.append((sender, recipients, b"".join(lines)))
+          writer.write(b"250 OK queued\r\n")
+        elif verb in ("NOOP", "RSET"):
+          writer.write(b"250 OK\r\n")
+        elif verb == "QUIT":
+          writer.write(b"221 bye\r\n")
+          await writer.drain()
+          break
+        else:
+          writer.write(b"502 unsupported command\r\n")
+        await writer.drain()
+    except ConnectionError:
+      pass
+    finally:
+      self.writers.discard(writer)
+      writer.close()
@@ -2,15 +2,27 @@
 import smtplib
 import imaplib
 import email
+import email.parser
+import email.message
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 import os
 import mimetypes
 import getpass
 import html.parser
+import re
+import select
+import ssl
+import time
+import hashlib
+import json
+import asyncio
+import concurrent.futures
 
 import config
 import channel
+import storage
+import stats
 
 """
 mail.py
@@ -23,6 +35,187 @@ https://github.com/jayrambhia/Basic-Gmail-API/blob/master/Basic-gmail.py
 class ConnectionError(RuntimeError):
   pass
 
+UID_RE = re.compile(rb"UID (\d+)")
+
+def parse_fetch_response(data):
+  """
+  Takes the data returned by a UID FETCH for message bodies and yields (uid,
+  raw) pairs one at a time. imaplib returns a list mixing (header, literal)
+  tuples with plain byte strings; the UID may be reported either before the
+  literal (in the header) or after it (in the following byte string).
+  """
+  raw = None
+  for item in data:
+    if isinstance(item, tuple):
+      header, raw = item
+      match = UID_RE.search(header)
+      if match:
+        yield (match.group(1), raw)
+        raw = None
+    else:
+      if raw != None and item:
+        match = UID_RE.search(item)
+        if match:
+          yield (match.group(1), raw)
+      raw = None
+
+def has_buffered_data(server):
+  """
+  Returns True if there's data from the given imaplib server waiting to be
+  read, without blocking. select can't see data that imaplib has already
+  read into its buffered file (like a response sent along with the one
+  before it) or that SSL has already decrypted, so this peeks at that file
+  with the socket briefly made non-blocking, which also reads anything
+  waiting on the socket into it.
+  """
+  sock = server.socket()
+  timeout = sock.gettimeout()
+  sock.setblocking(False)
+  try:
+    return len(server.file.peek(1)) > 0
+  except (BlockingIOError, ssl.SSLWantReadError):
+    return False
+  finally:
+    sock.settimeout(timeout)
+
+class TextOnlyMessage(email.message.Message):
+  """
+  A Message that throws away the payload of every part except text/plain
+  ones as soon as the parser produces it, so that attachments aren't kept
+  in memory while the rest of a message is parsed. The first text/plain
+  part with a non-empty payload is added to the 'found' list, if there is
+  one.
+  """
+  found = None
+
+  def set_payload(self, payload, charset=None):
+    if (
+      self.get_content_type() != "text/plain"
+  and self.get_content_maintype() not in ("multipart", "message")
+    ):
+      payload = ""
+    email.message.Message.set_payload(self, payload, charset)
+    if (
+      self.found == []
+  and self.get_content_type() == "text/plain"
+  and self.get_payload(decode=True)
+    ):
+      self.found.append(self)
+
+class MessageParser:
+  """
+  Feeds an incoming message to a BytesFeedParser as it's read, building
+  TextOnlyMessage parts. Once the first non-empty text/plain part (the only
+  one get_body uses) has been parsed, 'done' is set and further input is
+  ignored, so the rest of the message is neither parsed nor buffered.
+  """
+  def __init__(self):
+    self.found = []
+    self.parser = email.parser.BytesFeedParser(_factory=self.new_part)
+
+  def new_part(self, **kwargs):
+    part = TextOnlyMessage(**kwargs)
+    part.found = self.found
+    return part
+
+  @property
+  def done(self):
+    return len(self.found) > 0
+
+  def feed(self, data):
+    if not self.done:
+      self.parser.feed(data)
+
+  def close(self):
+    return self.parser.close()
+
+def parse_message(source):
+  """
+  Parses an incoming message given either as raw bytes, which are fed to a
+  MessageParser in chunks of config.PARSE_CHUNK_BYTES, or as an iterable of
+  byte chunks, which is only read as far as the parser needs.
+  """
+  chunks = source
+  if isinstance(source, bytes):
+    chunks = (
+      source[i:i + config.PARSE_CHUNK_BYTES]
+      for i in range(0, len(source), config.PARSE_CHUNK_BYTES)
+    )
+  parser = MessageParser()
+  for chunk in chunks:
+    parser.feed(chunk)
+    if parser.done:
+      break
+  return parser.close()
+
+def get_body(message):
+  """
+  Returns the decoded text of the first non-empty text/plain part of the
+  given message, truncated to config.MAX_BODY_CHARS characters.
+  """
+  for part in message.walk():
+    if part.get_content_type() != "text/plain" or part.is_multipart():
+      continue
+    payload = part.get_payload(decode=True)
+    if not payload:
+      continue
+    charset = part.get_content_charset() or "utf-8"
+    try:
+      text = payload.decode(charset, errors="replace")
+    except LookupError: # unknown charset
+      text = payload.decode("utf-8", errors="replace")
+    return text[:config.MAX_BODY_CHARS]
+  return ""
+
+def message_info(msg):
+  """
+  Turns a parsed incoming message (see parse_message) into a dictionary with
+  'mid', 'from', 'subject', 'references', and 'body' entries.
+  """
+  return {
+    'mid': msg["Message-Id"] if "Message-Id" in msg else "?",
+    'from': email.utils.parseaddr(msg["From"])[1],
+    'subject': msg["Subject"],
+    'references': msg["References"],
+    'body': get_body(msg),
+  }
+
+def build_message(
+  name,
+  address,
+  to,
+  subject,
+  body,
+  references = "",
+  attachments = None,
+  message_id = None
+):
+  """
+  Builds an outgoing message from the bot (see Connection.send_message).
+  """
+  attachments = attachments or []
+  msg = MIMEMultipart()
+  msg["From"] = address
+  msg["To"] = email.utils.COMMASPACE.join(to)
+  msg["Subject"] = "{" + name + "} " + subject
+  msg["References"] = references
+  if message_id:
+    msg["Message-Id"] = message_id
+  if body:
+    msg.attach(MIMEText(body))
+  for a in attachments:
+    msg.attach(a)
+  msg.attach(
+    MIMEText(
+      """
+This is an automated message sent by {address}.
+
+To halt all further messages from {address}, reply with the text ":block"
+""".format(address = address)
+    )
+  )
+  return msg
+
 class Connection:
   def __init__(
     self,
@@ -41,32 +234,185 @@ class Connection:
     self.smtp_password = smtp_password
     self.smtp_server = None
     self.imap_server = None
+    self.imap_selected = False
+    self.imap_last_used = 0
+    self.smtp_last_used = 0
+    self.uidvalidity = None
+    self.uidnext = None
+    # (uidvalidity, last_uid) of the newest message fetched so far
+    self.position = None
 
   def connect_smtp(self):
     if (self.smtp_server != None):
       raise ConnectionError("Attempt to connect SMTP while already connected.")
-    self.smtp_server = smtplib.SMTP()
-    self.smtp_server.connect(config.SMTP_HOST, config.SMTP_PORT)
-    self.smtp_server.ehlo()
-    self.smtp_server.starttls()
-    self.smtp_server.ehlo()
-    self.smtp_server.login(self.smtp_username, self.smtp_password)
+    self.smtp_server = smtplib.SMTP(timeout=config.MAIL_TIMEOUT)
+    with stats.timed("smtp.connect"):
+      self.smtp_server.connect(config.SMTP_HOST, config.SMTP_PORT)
+      self.smtp_server.ehlo()
+      if config.SMTP_STARTTLS:
+        self.smtp_server.starttls()
+        self.smtp_server.ehlo()
+      self.smtp_server.login(self.smtp_username, self.smtp_password)
+    self.smtp_last_used = time.monotonic()
 
   def disconnect_smtp(self):
     self.smtp_server.quit()
     self.smtp_server = None
 
+  def drop_smtp(self):
+    """
+    Abandons the SMTP connection (for example after an error), ignoring any
+    errors while closing it. The next prepare_send will reconnect.
+    """
+    if self.smtp_server != None:
+      try:
+        self.smtp_server.close()
+      except OSError:
+        pass
+    self.smtp_server = None
+
+  def smtp_alive(self):
+    """
+    Checks a long-lived SMTP session with a NOOP if it hasn't been used for
+    config.SMTP_NOOP_INTERVAL seconds. Returns False if the session is dead.
+    """
+    if time.monotonic() - self.smtp_last_used < config.SMTP_NOOP_INTERVAL:
+      return True
+    try:
+      with stats.timed("smtp.noop"):
+        code, msg = self.smtp_server.noop()
+    except OSError: # includes smtplib.SMTPException
+      return False
+    self.smtp_last_used = time.monotonic()
+    return code == 250
+
   def connect_imap(self):
     if (self.imap_server != None):
       raise ConnectionError("Attempt to connect IMAP while already connected.")
-    self.imap_server = imaplib.IMAP4_SSL(config.IMAP_HOST, config.IMAP_PORT)
-    self.imap_server.login(self.imap_username, self.imap_password)
+    with stats.timed("imap.connect"):
+      if config.IMAP_SSL:
+        self.imap_server = imaplib.IMAP4_SSL(
+          config.IMAP_HOST,
+          config.IMAP_PORT,
+          timeout=config.MAIL_TIMEOUT
+        )
+      else:
+        self.imap_server = imaplib.IMAP4(
+          config.IMAP_HOST,
+          config.IMAP_PORT,
+          timeout=config.MAIL_TIMEOUT
+        )
+      self.imap_server.login(self.imap_username, self.imap_password)
+    self.imap_selected = False
+    self.imap_last_used = time.monotonic()
 
   def disconnect_imap(self):
     self.imap_server.logout()
     self.imap_server = None
+    self.imap_selected = False
+
+  def drop_imap(self):
+    """
+    Abandons the IMAP connection (for example after an error), ignoring any
+    errors while closing it. The next prepare_receive will reconnect.
+    """
+    if self.imap_server != None:
+      try:
+        self.imap_server.shutdown()
+      except (imaplib.IMAP4.error, OSError):
+        pass
+    self.imap_server = None
+    self.imap_selected = False
+
+  def imap_alive(self):
+    """
+    Checks a long-lived IMAP session with a NOOP if it hasn't been used for
+    config.IMAP_NOOP_INTERVAL seconds. Returns False if the session is dead.
+    """
+    if time.monotonic() - self.imap_last_used < config.IMAP_NOOP_INTERVAL:
+      return True
+    try:
+      with stats.timed("imap.noop"):
+        status, data = self.imap_server.noop()
+    except (imaplib.IMAP4.error, OSError):
+      return False
+    self.imap_last_used = time.monotonic()
+    return status == "OK"
+
+  def select_inbox(self):
+    if self.imap_selected:
+      return
+    with stats.timed("imap.select"):
+      status, mcount = self.imap_server.select("INBOX")
+    if status != "OK":
+      raise ConnectionError("IMAP select() returned bad status '%s'" % status)
+    self.uidvalidity = self.select_code("UIDVALIDITY")
+    self.uidnext = self.select_code("UIDNEXT")
+    self.imap_selected = True
+
+  def select_code(self, code):
+    """
+    Returns the integer value of a response code (like UIDVALIDITY) from the
+    last SELECT, or None if the server didn't send it.
+    """
+    typ, data = self.imap_server.response(code)
+    if data and data[-1]:
+      return int(data[-1])
+    return None
+
+  def can_idle(self):
+    return "IDLE" in self.imap_server.capabilities
+
+  def idle(self, timeout, stop=None):
+    """
+    Issues an IMAP IDLE command and waits until the server reports new mail,
+    the timeout (in seconds) expires, or the given threading.Event is set.
+    Returns True if new mail was reported. imaplib has no IDLE support, so
+    this talks to the server directly (the INBOX must already be selected).
+    """
+    server = self.imap_server
+    tag = server._new_tag()
+    server.send(tag + b" IDLE\r\n")
+    response = server.readline()
+    if not response.startswith(b"+"):
+      raise ConnectionError("IMAP IDLE was refused: %r" % response)
+    sock = server.socket()
+    deadline = time.monotonic() + timeout
+    woke = False
+    try:
+      while not woke and not (stop and stop.is_set()):
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+          break
+        if not has_buffered_data(server):
+          select.select(
+            [sock],
+            [],
+            [],
+            min(remaining, config.IDLE_CHECK_INTERVAL)
+          )
+          if not has_buffered_data(server):
+            continue
+        line = server.readline()
+        if not line:
+          raise ConnectionError("IMAP server closed the connection during IDLE.")
+        if line.startswith(b"*") and (b"EXISTS" in line or b"RECENT" in line):
+          woke = True
+    finally:
+      server.send(b"DONE\r\n")
+      while True:
+        line = server.readline()
+        if not line:
+          raise ConnectionError("IMAP server closed the connection during IDLE.")
+        if line.startswith(tag):
+          break
+      server.tagged_commands.pop(tag, None)
+      self.imap_last_used = time.monotonic()
+    return woke
 
   def prepare_send(self):
+    if self.smtp_server != None and not self.smtp_alive():
+      self.drop_smtp()
     if self.smtp_server == None:
       self.connect_smtp()
 
@@ -75,6 +421,8 @@ class Connection:
       self.disconnect_smtp()
 
   def prepare_receive(self):
+    if self.imap_server != None and not self.imap_alive():
+      self.drop_imap()
     if self.imap_server == None:
       self.connect_imap()
 
@@ -88,94 +436,208 @@ class Connection:
     subject = "ERROR",
     body = "ERROR -- send_message didn't get a 'body' argument.",
     references = "",
-    attachments = None
+    attachments = None,
+    message_id = None
   ):
     if to == None:
       raise ConnectionError(
         "Connection.send_message didn't get a list of recipients."
       )
 
-    attachments = attachments or []
-    msg = MIMEMultipart()
-    msg["From"] = self.address
-    msg["To"] = email.utils.COMMASPACE.join(to)
-    msg["Subject"] = "{" + self.name + "} " + subject
-    msg["References"] = references
-    if body:
-      msg.attach(MIMEText(body))
-    for a in attachments:
-      msg.attach(a)
-    msg.attach(
-      MIMEText(
-        """
-This is an automated message sent by {address}.
-
-To halt all further messages from {address}, reply with the text ":block"
-""".format(address = self.address)
-      )
+    msg = build_message(
+      self.name,
+      self.address,
+      to,
+      subject,
+      body,
+      references,
+      attachments,
+      message_id
     )
-    self.smtp_server.sendmail(self.address, to, msg.as_string())
+    text = msg.as_string()
+    with stats.timed("smtp.send"):
+      self.smtp_server.sendmail(self.address, to, text)
+    self.smtp_last_used = time.monotonic()
 
   def check_mail(self):
+    """
+    Returns a list of new messages. After the first check only messages with
+    UIDs above the last one fetched are requested (see self.position), so
+    the cost doesn't grow with the size of the mailbox and doesn't depend on
+    \\Seen flags; all unseen messages are fetched on the first check or if
+    the mailbox's UIDVALIDITY changes. At most config.POLL_BATCH messages are
+    returned.
+    """
     #status, boxnames = self.imap_server.list()
     #if status != "OK":
     #  raise ConnectionError("IMAP list() returned bad status '%s'" % status)
     #boxes = [bn.split('"')[-2] for bn in boxnames]
-    status, mcount = self.imap_server.select("INBOX")
-    if status != "OK":
-      raise ConnectionError("IMAP select() returned bad status '%s'" % status)
-    status, data = self.imap_server.uid("search", None, "UNSEEN")
+    fresh = not self.imap_selected
+    self.select_inbox()
+    incremental = (
+      self.position != None
+  and self.uidvalidity != None
+  and self.position[0] == self.uidvalidity
+    )
+    if incremental:
+      # Incremental sync: only ask for UIDs above the last one fetched. The
+      # server always includes the highest UID in the range, even if it's
+      # below the start, so the results are filtered.
+      last = self.position[1]
+      with stats.timed("imap.search"):
+        status, data = self.imap_server.uid(
+          "search",
+          None,
+          "UID",
+          "{}:*".format(last + 1)
+        )
+    else:
+      # Full resync (first run, or the mailbox's UIDs were invalidated):
+      # fetch all unseen messages, using a fresh SELECT's UIDNEXT to know
+      # where the next incremental sync should start.
+      if not fresh:
+        self.imap_selected = False
+        self.select_inbox()
+      last = (self.uidnext or 1) - 1
+      with stats.timed("imap.search"):
+        status, data = self.imap_server.uid("search", None, "UNSEEN")
     if status != "OK":
       raise ConnectionError(
         "IMAP uid('search') returned bad status '%s'" % status
       )
-    uid_list = data[0].split()
-    messages = []
-    for uid in uid_list:
-      status, data = self.imap_server.uid('fetch', uid, "(RFC822)")
+    uid_list = sorted(data[0].split(), key=int)
+    if incremental:
+      uid_list = [ u for u in uid_list if int(u) > last ]
+    # At most config.POLL_BATCH messages are fetched per check. If a resync
+    # is cut short, the position isn't set, so the next check resyncs again
+    # (skipping the messages just marked as seen).
+    capped = len(uid_list) > config.POLL_BATCH
+    uid_list = uid_list[:config.POLL_BATCH]
+    messages = list(self.fetch_messages(uid_list))
+    if self.uidvalidity != None and (incremental or not capped):
+      self.position = (
+        self.uidvalidity,
+        max([last] + [ int(u) for u in uid_list ])
+      )
+    self.imap_last_used = time.monotonic()
+    return messages
+
+  def fetch_messages(self, uid_list):
+    """
+    Fetches the given messages in batches of config.IMAP_FETCH_BATCH using a
+    single UID FETCH round trip per batch, yielding parsed messages as each
+    batch arrives. Only the first config.IMAP_MAX_MESSAGE_BYTES of each
+    message are fetched. Fetched messages are marked as seen.
+    """
+    for i in range(0, len(uid_list), config.IMAP_FETCH_BATCH):
+      batch = uid_list[i:i + config.IMAP_FETCH_BATCH]
+      uid_set = b",".join(batch)
+      with stats.timed("imap.fetch"):
+        status, data = self.imap_server.uid(
+          "fetch",
+          uid_set,
+          "(UID BODY.PEEK[]<0.{}>)".format(config.IMAP_MAX_MESSAGE_BYTES)
+        )
       if status != "OK":
         raise ConnectionError(
           "IMAP uid('fetch') returned bad status '%s'" % status
         )
-      raw = data[0][1]
-      msg = email.message_from_bytes(raw)
-      messages.append(
-        {
-          'uid': uid,
-          'mid': msg["Message-Id"] if "Message-Id" in msg else "?",
-          'from': email.utils.parseaddr(msg["From"])[1],
-          'subject': msg["Subject"],
-          'references': msg["References"],
-          'body': self.get_body(msg),
-        }
-      )
-    self.imap_server.close()
-    return messages
+      for uid, raw in parse_fetch_response(data):
+        info = message_info(parse_message(raw))
+        info['uid'] = uid
+        yield info
+      with stats.timed("imap.store"):
+        status, data = self.imap_server.uid(
+          "store",
+          uid_set,
+          "+FLAGS",
+          "(\\Seen)"
+        )
+      if status != "OK":
+        raise ConnectionError(
+          "IMAP uid('store') returned bad status '%s'" % status
+        )
+
+def new_key():
+  return ''.join("%02x" % b for b in os.urandom(16))
 
-  def get_body(self, message):
-    body = ""
-    for part in message.walk():
-      content_type = part.get_content_type()
-      if content_type == "text/plain":
-        payload = part.get_payload()
-        if payload:
-          body += payload
-      #elif content_type == "text/html":
-      #  payload = part.get_payload()
-      #  if payload:
-      #    body += payload
-    return body
+def coalesce(due, by_thread=False):
+  """
+  Takes a list of storage.OUT_F tuples and groups replies with the same
+  recipients (and, if by_thread is given, the same thread) into combined
+  replies. Returns a list of (ids, reply, key) tuples, in order of each
+  group's oldest reply. A combined reply has one section per original reply
+  and a References header that merges theirs.
+  """
+  groups = {}
+  order = []
+  for o in due:
+    group = tuple(sorted(a.lower() for a in o.reply["to"]))
+    if by_thread:
+      refs = o.reply.get("references", "").split()
+      group += (refs[0] if refs else o.key,)
+    if group not in groups:
+      groups[group] = []
+      order.append(group)
+    groups[group].append(o)
+
+  result = []
+  for group in order:
+    members = groups[group]
+    if len(members) == 1:
+      result.append(([members[0].id], members[0].reply, members[0].key))
+      continue
+    references = []
+    for o in members:
+      for ref in o.reply.get("references", "").split():
+        if ref not in references:
+          references.append(ref)
+    sections = [
+      "===== {} =====\n\n{}".format(o.reply["subject"], o.reply["body"])
+        for o in members
+    ]
+    reply = {
+      "to": members[0].reply["to"],
+      "subject": "{} (and {} more)".format(
+        members[0].reply["subject"],
+        len(members) - 1
+      ),
+      "body": "Academibot has {} replies for you:\n\n{}".format(
+        len(members),
+        "\n\n".join(sections)
+      ),
+      "references": " ".join(references),
+    }
+    key = hashlib.sha256(
+      "\n".join(o.key for o in members).encode()
+    ).hexdigest()
+    result.append(([o.id for o in members], reply, key))
+  return result
 
 class AsyncEmailChannel(channel.Channel):
-  def __init__(self, name, myaddr, imap_username, smtp_username, samepass=True):
+  """
+  A channel that keeps a long-lived IMAP session open and uses IMAP IDLE to
+  wait for new mail (falling back to polling if the server doesn't support
+  IDLE), and replies via SMTP. If a password is given it's used for both IMAP
+  and SMTP instead of prompting for one during setup.
+  """
+  def __init__(
+    self,
+    name,
+    myaddr,
+    imap_username,
+    smtp_username,
+    samepass=True,
+    password=None
+  ):
     self.name = name
     self.addr = myaddr
     self.imap_username = imap_username
     self.smtp_username = smtp_username
-    self.imap_password = None
-    self.smtp_password = None
+    self.imap_password = password
+    self.smtp_password = password
     self.connection = None
-    self.outbound = []
+    self.saved_position = None
     self.samepass = samepass
 
   def __str__(self):
@@ -183,7 +645,9 @@ class AsyncEmailChannel(channel.Channel):
 
   def setup(self):
     # TODO: don't store password even in RAM? (in Connection as well)
-    if self.samepass:
+    if self.imap_password != None:
+      pass
+    elif self.samepass:
       self.imap_password = getpass.getpass(
         "Enter password for user '{}':".format(self.imap_username)
       )
@@ -195,59 +659,283 @@ class AsyncEmailChannel(channel.Channel):
       self.smtp_password = getpass.getpass(
         "Enter password for SMTP user '{}':".format(self.smtp_username)
       )
-    self.connection = Connection(
-      self.name,
-      self.addr,
-      self.imap_username,
-      self.smtp_username,
-      self.imap_password,
-      self.smtp_password
-    )
+    self.connect()
+    self.load_position()
+
+  def connect(self):
+    if not self.connection:
+      self.connection = Connection(
+        self.name,
+        self.addr,
+        self.imap_username,
+        self.smtp_username,
+        self.imap_password,
+        self.smtp_password
+      )
+
+  def position_name(self):
+    return "imap-position:" + self.addr
+
+  def load_position(self):
+    """
+    Restores the mailbox position (UIDVALIDITY and last fetched UID) saved
+    by save_position, so that only newer messages are fetched.
+    """
+    saved = storage.get_checkpoint(self.position_name())
+    if saved:
+      self.connection.position = tuple(json.loads(saved))
+    self.saved_position = self.connection.position
+
+  def save_position(self, now):
+    """
+    Saves the mailbox position if it has moved. This is done by checkpoint,
+    once the fetched messages have been processed and their replies queued.
+    """
+    position = self.connection.position if self.connection else None
+    if position != None and position != self.saved_position:
+      storage.set_checkpoint(self.position_name(), json.dumps(position), now)
+      self.saved_position = position
+
+  def receive(self):
+    """
+    Fetches new messages over the IMAP session (reconnecting if necessary),
+    returning a list of message dictionaries (see Connection.check_mail).
+    """
+    try:
+      self.connection.prepare_receive()
+      return self.connection.check_mail()
+    except (imaplib.IMAP4.error, OSError, ConnectionError):
+      self.connection.drop_imap() # reconnect next time
+      raise
 
   def poll(self):
-    self.connection.prepare_receive()
-    messages = self.connection.check_mail()
-    self.connection.done_receiving()
     return [
       (
         m["from"], # TODO: Better sender authentication!
         m["body"],
         self.respond_function_for(m)
       )
-      for m in messages
+      for m in self.receive()
     ]
 
+  def wait(self, timeout, stop=None):
+    try:
+      self.connection.prepare_receive()
+      if self.connection.can_idle():
+        self.connection.select_inbox()
+        return self.connection.idle(timeout, stop)
+    except (imaplib.IMAP4.error, OSError, ConnectionError):
+      self.connection.drop_imap()
+    return channel.Channel.wait(self, timeout, stop)
+
+  def reply_key(self, message, n):
+    return reply_key(self.addr, message, n)
+
   def respond_function_for(self, message):
+    """
+    Returns a function that queues replies to the given message in the
+    outbox. The function's 'message_id' attribute is the message's
+    Message-Id (see academibot.process_async), and its 'route' attribute
+    records where replies go, so that later replies can be queued with
+    route_reply (for example after a restart).
+    """
+    count = [0]
     def rf(response_text):
-      reply = {
-        "to": [message["from"]],
-        "subject": "Re: " + message["subject"],
-        "body": response_text,
-        "references": "{}{}".format(
-          message["references"] + " " if message["references"] else "",
-          message["mid"],
-        ),
-      }
-      self.outbound.append(reply)
+      count[0] += 1
+      queue_reply(self.addr, message, count[0], response_text)
+    rf.message_id = message["mid"]
+    rf.route = {
+      "channel": self.addr,
+      "message": {
+        k: message[k] for k in ("from", "subject", "mid", "references")
+      },
+    }
     return rf
 
+  def send_reply(self, reply, key):
+    """
+    Sends a single reply, using its outbox key as the Message-Id so that
+    recipients can discard duplicates. If the SMTP session turns out to have
+    been closed by the server, it is reopened and the reply is retried once.
+    """
+    message_id = "<{}@{}>".format(key, self.addr.split("@")[-1])
+    try:
+      self.connection.send_message(message_id=message_id, **reply)
+    except smtplib.SMTPServerDisconnected:
+      self.connection.drop_smtp()
+      self.connection.prepare_send()
+      self.connection.send_message(message_id=message_id, **reply)
+
+  def batches(self, due):
+    """
+    Turns a list of due outbox entries into (ids, reply, key) batches to be
+    sent, combining them if config.COALESCE_REPLIES is set.
+    """
+    if config.COALESCE_REPLIES:
+      return coalesce(due, config.COALESCE_BY_THREAD)
+    return [ ([o.id], o.reply, o.key) for o in due ]
+
+  def send_batches(self, batches):
+    """
+    Sends the given batches over the SMTP session without touching the
+    database, returning a list of (ids, error) pairs where error is None for
+    batches that were sent. Raises an error if the session can't be opened.
+    """
+    self.connect()
+    try:
+      self.connection.prepare_send()
+    except OSError: # includes smtplib.SMTPException
+      self.connection.drop_smtp()
+      raise
+    results = []
+    for ids, reply, key in batches:
+      try:
+        self.send_reply(reply, key)
+      except OSError as e:
+        results.append((ids, str(e)))
+      else:
+        results.append((ids, None))
+    return results
+
   def flush(self):
-    if len(self.outbound) == 0:
+    """
+    Sends replies that are due from the outbox back-to-back over the
+    channel's long-lived SMTP session, which is left open for the next cycle.
+    Replies to the same recipient are combined (see coalesce). Replies that
+    can't be sent are rescheduled with backoff.
+    """
+    now = storage.now_ts()
+    due = storage.due_outbound(self.addr, now)
+    if not due:
       return
+    try:
+      results = self.send_batches(self.batches(due))
+    except OSError as e:
+      storage.outbound_failed([o.id for o in due], now, str(e))
+      raise
+    record_results(results, now)
 
-    if not self.connection:
-      self.connection = Connection(
-        self.addr,
-        self.imap_username,
-        self.smtp_username,
-        self.imap_password,
-        self.smtp_password
+  def checkpoint(self):
+    self.save_position(storage.now_ts())
+
+def reply_key(addr, message, n):
+  """
+  Returns an idempotency key for the nth reply to the given message from the
+  given address, so that re-processing a message doesn't queue its replies
+  twice. Messages without a Message-Id get a random key.
+  """
+  if message["mid"] == "?":
+    return new_key()
+  return hashlib.sha256(
+    "{}\n{}\n{}".format(addr, message["mid"], n).encode()
+  ).hexdigest()
+
+def queue_reply(addr, message, n, response_text):
+  """
+  Queues the nth reply to the given message in the outbox of the email
+  channel with the given address.
+  """
+  reply = {
+    "to": [message["from"]],
+    "subject": "Re: " + (message["subject"] or ""),
+    "body": response_text,
+    "references": "{}{}".format(
+      message["references"] + " " if message["references"] else "",
+      message["mid"],
+    ),
+  }
+  storage.queue_outbound(
+    addr,
+    reply_key(addr, message, n),
+    reply,
+    storage.now_ts()
+  )
+
+def route_reply(route, n, response_text):
+  """
+  Queues the nth reply along a route recorded from a respond function (see
+  AsyncEmailChannel.respond_function_for).
+  """
+  queue_reply(route["channel"], route["message"], n, response_text)
+
+def record_results(results, now):
+  """
+  Records the (ids, error) results of sending outbox batches.
+  """
+  for ids, error in results:
+    if error == None:
+      storage.outbound_sent(ids, now)
+    else:
+      storage.outbound_failed(ids, now, error)
+
+class AsyncioEmailChannel(channel.AsyncChannel):
+  """
+  An asyncio version of AsyncEmailChannel. The blocking IMAP and SMTP calls
+  run on two single-threaded executors (one per session), so that receiving
+  and sending can overlap with each other and with message processing, while
+  all database access stays on the event loop's thread.
+  """
+  def __init__(self, *args, **kwargs):
+    self.mail = AsyncEmailChannel(*args, **kwargs)
+    self.addr = self.mail.addr
+    self.imap_pool = concurrent.futures.ThreadPoolExecutor(1, "imap")
+    self.smtp_pool = concurrent.futures.ThreadPoolExecutor(1, "smtp")
+
+  def __str__(self):
+    return "an asyncio email channel via {}".format(self.addr)
+
+  async def run(self, pool, function, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+      pool,
+      function,
+      *args
+    )
+
+  async def setup(self):
+    self.mail.setup()
+
+  async def poll(self):
+    for m in await self.run(self.imap_pool, self.mail.receive):
+      yield (m["from"], m["body"], self.mail.respond_function_for(m))
+
+  async def wait(self, timeout, stop=None):
+    return await self.run(self.imap_pool, self.mail.wait, timeout, stop)
+
+  async def send(self, reply, key=None):
+    results = await self.run(
+      self.smtp_pool,
+      self.mail.send_batches,
+      [ (None, reply, key or new_key()) ]
+    )
+    if results[0][1] != None:
+      raise ConnectionError(results[0][1])
+
+  async def flush(self):
+    now = storage.now_ts()
+    due = storage.due_outbound(self.addr, now)
+    if not due:
+      return
+    try:
+      results = await self.run(
+        self.smtp_pool,
+        self.mail.send_batches,
+        self.mail.batches(due)
       )
+    except OSError as e:
+      storage.outbound_failed([o.id for o in due], now, str(e))
+      raise
+    record_results(results, now)
+
+  async def checkpoint(self):
+    self.mail.save_position(storage.now_ts())
 
-    self.connection.prepare_send()
-    while len(self.outbound) > 0:
-      self.connection.send_message(**self.outbound.pop())
-    self.connection.done_sending()
+  async def close(self):
+    connection = self.mail.connection
+    if connection:
+      await self.run(self.imap_pool, connection.drop_imap)
+      await self.run(self.smtp_pool, connection.drop_smtp)
+    self.imap_pool.shutdown()
+    self.smtp_pool.shutdown()
 
 def test_message():
   con = Connection(
@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+maildir.py
+A channel that reads messages from a local Maildir or mbox file and writes
+replies to an output Maildir, for bulk ingest and for replaying exported
+mail (for example to re-process submissions after fixing a grading bug).
+
+Usage: maildir.py [--replay] SOURCE OUTPUT
+
+With --replay, every message in the source is processed, even if it was
+processed before (see MailboxChannel).
+"""
+
+import os
+import sys
+import time
+import mailbox
+import threading
+import email.utils
+
+import config
+import channel
+import mail
+import storage
+
+def read_chunks(fin):
+  """
+  Yields the contents of the given binary file in chunks of
+  config.PARSE_CHUNK_BYTES, stopping after
+  config.MAILBOX_MAX_MESSAGE_BYTES.
+  """
+  left = config.MAILBOX_MAX_MESSAGE_BYTES
+  while left > 0:
+    chunk = fin.read(min(left, config.PARSE_CHUNK_BYTES))
+    if not chunk:
+      break
+    left -= len(chunk)
+    yield chunk
+
+class MailboxChannel(channel.Channel):
+  """
+  Reads new messages from a Maildir (the messages in its 'new' directory,
+  which are moved to 'cur' once processed) or from an mbox file (messages
+  appended after the last processed offset, which is checkpointed). Changes
+  are detected by polling modification times. Only the first
+  config.MAILBOX_MAX_MESSAGE_BYTES of each message are read. Replies are
+  written to the output Maildir instead of being sent.
+
+  With replay set (as when re-processing exported mail after fixing a
+  grading bug), the messages already in the Maildir's 'cur' directory when
+  the channel is set up are read as well, an mbox file is read from the
+  start, and messages are processed even if the processed-message ledger
+  says they've been handled already (see storage.message_processed). A
+  replay that's interrupted starts over when it's run again.
+  """
+  def __init__(
+    self,
+    name,
+    source,
+    output,
+    address="academibot@localhost",
+    replay=False
+  ):
+    self.name = name
+    self.source = source
+    self.output = output
+    self.addr = address
+    self.replay = replay
+    self.is_maildir = os.path.isdir(source)
+    self.outbox = None
+    self.last_stamp = None
+    # Replies are added by the dispatcher's threads, possibly during a flush.
+    self.replies = []
+    self.replies_lock = threading.Lock()
+    # returned Maildir filenames, or the mbox offset after the returned
+    # messages, to be committed by the next checkpoint
+    self.processed = []
+    self.offset = 0
+    self.next_offset = None
+    # 'cur' filenames still to be read when replaying
+    self.replaying = []
+
+  def __str__(self):
+    return "a {} channel reading {}".format(
+      "Maildir" if self.is_maildir else "mbox",
+      self.source
+    )
+
+  def setup(self):
+    self.outbox = mailbox.Maildir(self.output, create=True)
+    if self.is_maildir and self.replay:
+      self.replaying = sorted(
+        f for f in os.listdir(os.path.join(self.source, "cur"))
+          if not f.startswith(".")
+      )
+    elif not self.is_maildir and not self.replay:
+      saved = storage.get_checkpoint(self.checkpoint_name())
+      if saved:
+        self.offset = int(saved)
+
+  def checkpoint_name(self):
+    return "mbox-offset:" + os.path.abspath(self.source)
+
+  def stamp(self):
+    """
+    Returns a value that changes whenever new messages might have arrived:
+    the modification time and size of the Maildir's 'new' directory or of
+    the mbox file.
+    """
+    path = self.source
+    if self.is_maildir:
+      path = os.path.join(self.source, "new")
+    try:
+      st = os.stat(path)
+    except FileNotFoundError:
+      return None
+    return (st.st_mtime_ns, st.st_size)
+
+  def poll(self):
+    stamp = self.stamp()
+    if (stamp == None or stamp == self.last_stamp) and not self.replaying:
+      return []
+    if self.is_maildir:
+      messages = self.read_maildir()
+    else:
+      messages = self.read_mbox()
+    if len(messages) < config.POLL_BATCH:
+      # Otherwise, there may be more to read next time.
+      self.last_stamp = stamp
+    result = []
+    for message in messages:
+      m = mail.message_info(message)
+      result.append((m["from"], m["body"], self.respond_function_for(m)))
+    return result
+
+  def read_maildir(self):
+    """
+    Returns up to config.POLL_BATCH parsed messages from the Maildir's 'new'
+    directory (after any from 'cur' still to be replayed), oldest first
+    (Maildir names start with a timestamp).
+    """
+    messages = []
+    while self.replaying and len(messages) < config.POLL_BATCH:
+      message = self.read_file(os.path.join("cur", self.replaying.pop(0)))
+      if message != None:
+        messages.append(message)
+    for filename in sorted(os.listdir(os.path.join(self.source, "new"))):
+      if filename.startswith(".") or filename in self.processed:
+        continue
+      if len(messages) >= config.POLL_BATCH:
+        break
+      message = self.read_file(os.path.join("new", filename))
+      if message != None:
+        messages.append(message)
+        self.processed.append(filename)
+    return messages
+
+  def read_file(self, name):
+    """
+    Parses the given file in the Maildir, reading it a chunk at a time and
+    no further than the parser needs or config.MAILBOX_MAX_MESSAGE_BYTES.
+    Returns None if the file is gone.
+    """
+    try:
+      with open(os.path.join(self.source, name), 'rb') as fin:
+        return mail.parse_message(read_chunks(fin))
+    except FileNotFoundError: # moved by someone else
+      return None
+
+  def read_mbox(self):
+    """
+    Returns up to config.POLL_BATCH parsed messages after the current
+    offset in the mbox file, reading no further than it needs to. Each line
+    is fed to the message's parser as it's read (see mail.MessageParser). A
+    final message that doesn't end with a newline may still be being
+    written, so it's left for the next poll.
+    """
+    offset = self.next_offset if self.next_offset != None else self.offset
+    limit = config.MAILBOX_MAX_MESSAGE_BYTES
+    messages = []
+    current = None
+    size = 0
+    start = 0 # of the current message, relative to offset
+    position = 0
+    blank = True
+    with open(self.source, 'rb') as fin:
+      fin.seek(offset)
+      for line in fin:
+        if not line.endswith(b"\n"):
+          break # the rest may still be being written
+        if blank and line.startswith(b"From "):
+          if current != None:
+            messages.append(current.close())
+          current = None
+          start = position
+          if len(messages) >= config.POLL_BATCH:
+            break
+          current = mail.MessageParser()
+          size = 0
+        elif current != None and size < limit:
+          text = line
+          if text.startswith(b">") and text.lstrip(b">").startswith(b"From "):
+            # mboxrd quoting
+            text = text[1:]
+          current.feed(text[:limit - size])
+          size += len(text)
+        blank = line.strip() == b""
+        position += len(line)
+      else:
+        if current != None:
+          messages.append(current.close())
+        start = position
+    self.next_offset = offset + start
+    return messages
+
+  def respond_function_for(self, message):
+    def rf(response_text):
+      reply = {
+        "to": [message["from"]],
+        "subject": "Re: " + (message["subject"] or ""),
+        "body": response_text,
+        "references": "{}{}".format(
+          message["references"] + " " if message["references"] else "",
+          message["mid"],
+        ),
+      }
+      with self.replies_lock:
+        self.replies.append(reply)
+    if not self.replay:
+      rf.message_id = message["mid"]
+    return rf
+
+  def flush(self):
+    """
+    Writes queued replies to the output Maildir.
+    """
+    domain = self.addr.split("@")[-1]
+    with self.replies_lock:
+      replies, self.replies = self.replies, []
+    for reply in replies:
+      self.outbox.add(
+        mail.build_message(
+          self.name,
+          self.addr,
+          message_id=email.utils.make_msgid(domain=domain),
+          **reply
+        )
+      )
+
+  def checkpoint(self):
+    """
+    Marks the messages returned so far as processed: moves them to the
+    Maildir's 'cur' directory (flagged as seen), or saves the mbox offset
+    after them.
+    """
+    if self.is_maildir:
+      for filename in self.processed:
+        try:
+          os.rename(
+            os.path.join(self.source, "new", filename),
+            os.path.join(self.source, "cur", filename + ":2,S")
+          )
+        except FileNotFoundError:
+          pass
+      self.processed = []
+    elif self.next_offset != None and self.next_offset != self.offset:
+      self.offset = self.next_offset
+      storage.set_checkpoint(
+        self.checkpoint_name(),
+        str(self.offset),
+        storage.now_ts()
+      )
+
+  def wait(self, timeout, stop=None):
+    """
+    Polls the source's modification time every config.MAILBOX_CHECK_INTERVAL
+    seconds until it changes (returning True), the timeout expires, or the
+    given threading.Event is set.
+    """
+    deadline = time.monotonic() + timeout
+    while not (stop and stop.is_set()):
+      if self.stamp() != self.last_stamp or self.replaying:
+        return True
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      delay = min(remaining, config.MAILBOX_CHECK_INTERVAL)
+      if stop:
+        stop.wait(delay)
+      else:
+        time.sleep(delay)
+    return False
+
+if __name__ == "__main__":
+  import academibot
+  args = sys.argv[1:]
+  replay = "--replay" in args
+  if replay:
+    args.remove("--replay")
+  if len(args) != 2:
+    print(__doc__.strip())
+    exit(1)
+  # Replayed mail would otherwise trip the per-sender rate limits.
+  config.RATE_LIMITS = {}
+  academibot.run_server(
+    [
+      MailboxChannel(config.NAME, args[0], args[1], config.MYADDR, replay)
+    ],
+    config.DATABASE,
+    interval=config.INTERVAL
+  )
@@ -0,0 +1,148 @@
+"""
+metrics.py
+An optional HTTP endpoint (enabled by setting config.METRICS_PORT) that
+serves the statistics gathered by stats.py (including those published by
+the grading worker), plus the outbox and grading queue status, in the
+Prometheus text format so that they can be scraped by monitoring.
+"""
+
+import threading
+import http.server
+
+import config
+import grader
+import stats
+import storage
+
+PREFIX = "academibot_"
+
+def label(value):
+  return '"{}"'.format(
+    str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+  )
+
+def metric(lines, name, value, labels=None):
+  if labels:
+    name += "{" + ",".join(
+      "{}={}".format(k, label(v)) for k, v in labels.items()
+    ) + "}"
+  lines.append("{}{} {}".format(PREFIX, name, value))
+
+def render(now=None):
+  """
+  Returns the current metrics in the Prometheus text format.
+  """
+  now = now if now != None else storage.now_ts()
+  lines = []
+  # Timings from this process, then those published by worker processes
+  # (like the grading worker's maintain_grade_info), labelled by worker.
+  summary = [
+    ({ "name": name }, timings)
+      for name, timings in sorted(stats.summary().items())
+  ]
+  for worker, worker_summary in storage.worker_timings().items():
+    summary.extend(
+      ({ "name": name, "worker": worker }, timings)
+        for name, timings in sorted(worker_summary.items())
+    )
+  lines.append("# TYPE {}latency_seconds histogram".format(PREFIX))
+  for labels, (calls, errors, total, rows, samples, buckets) in summary:
+    running = 0
+    for bound, n in zip(stats.BUCKETS, buckets):
+      running += n
+      metric(
+        lines,
+        "latency_seconds_bucket",
+        running,
+        dict(labels, le=bound)
+      )
+    metric(
+      lines,
+      "latency_seconds_bucket",
+      calls,
+      dict(labels, le="+Inf")
+    )
+    metric(lines, "latency_seconds_sum", total, labels)
+    metric(lines, "latency_seconds_count", calls, labels)
+  lines.append("# TYPE {}errors_total counter".format(PREFIX))
+  for labels, (calls, errors, total, rows, samples, buckets) in summary:
+    metric(lines, "errors_total", errors, labels)
+  lines.append("# TYPE {}rows_total counter".format(PREFIX))
+  for labels, (calls, errors, total, rows, samples, buckets) in summary:
+    metric(lines, "rows_total", rows, labels)
+  lines.append("# TYPE {}events_total counter".format(PREFIX))
+  for name, n in sorted(stats.counts().items()):
+    metric(lines, "events_total", n, { "name": name })
+  lines.append("# TYPE {}gauge gauge".format(PREFIX))
+  lines.append("# TYPE {}gauge_max gauge".format(PREFIX))
+  for name, (latest, highest) in sorted(list(stats.GAUGES.items())):
+    metric(lines, "gauge", latest, { "name": name })
+    metric(lines, "gauge_max", highest, { "name": name })
+
+  for queue_name, status in (
+    ("outbox", storage.outbox_status(now)),
+    ("grading", storage.grading_status(now)),
+  ):
+    queued, oldest, failed = status
+    lines.append("# TYPE {}{}_queued gauge".format(PREFIX, queue_name))
+    metric(lines, queue_name + "_queued", queued)
+    lines.append("# TYPE {}{}_oldest_seconds gauge".format(PREFIX, queue_name))
+    metric(lines, queue_name + "_oldest_seconds", oldest)
+    lines.append("# TYPE {}{}_failed gauge".format(PREFIX, queue_name))
+    metric(lines, queue_name + "_failed", failed)
+
+  worker = storage.worker_status(grader.WORKER_NAME)
+  if worker:
+    lines.append("# TYPE {}grader_heartbeat_age_seconds gauge".format(PREFIX))
+    metric(lines, "grader_heartbeat_age_seconds", now - worker["heartbeat"])
+    lines.append("# TYPE {}grader_processed_total counter".format(PREFIX))
+    metric(lines, "grader_processed_total", worker["processed"])
+    lines.append("# TYPE {}grader_failed_total counter".format(PREFIX))
+    metric(lines, "grader_failed_total", worker["failed"])
+  return "\n".join(lines) + "\n"
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split("?")[0] not in ("/", "/metrics"):
+      self.send_error(404)
+      return
+    try:
+      body = render().encode()
+    except Exception as e:
+      self.send_error(500, str(e))
+      return
+    self.send_response(200)
+    self.send_header("Content-Type", "text/plain; version=0.0.4")
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass # scrapes would otherwise flood stderr
+
+def start(port=None, host=None):
+  """
+  Starts serving metrics on a background thread, returning the server (see
+  stop). By default it listens on config.METRICS_HOST and
+  config.METRICS_PORT; port 0 picks a free port, which is available as
+  server.server_port.
+  """
+  server = http.server.ThreadingHTTPServer(
+    (
+      host or config.METRICS_HOST,
+      port if port != None else config.METRICS_PORT
+    ),
+    MetricsHandler
+  )
+  server.daemon_threads = True
+  thread = threading.Thread(
+    target=server.serve_forever,
+    name="metrics",
+    daemon=True
+  )
+  thread.start()
+  return server
+
+def stop(server):
+  server.shutdown()
+  server.server_close()
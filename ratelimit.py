@@ -0,0 +1,136 @@
+"""
+ratelimit.py
+Per-sender token-bucket rate limiting for incoming messages.
+"""
+
+import json
+
+import config
+import storage
+
+CHECKPOINT_NAME = "rate-limits"
+
+OVER_LIMIT_REPLY = """\
+Academibot has received too many messages from you recently, so your message
+was ignored (along with any further messages you send in the next {wait}
+minutes). Please wait a while before sending more commands.
+
+If you are receiving this message in reply to an automatic response (like an
+out-of-office notice), please turn off automatic responses for academibot's
+address.
+"""
+
+class RateLimiter:
+  """
+  Keeps a token bucket for each sender. Each admitted message uses up one
+  token, and tokens are refilled at a steady rate up to a maximum, both of
+  which depend on the sender's role (see config.RATE_LIMITS). Buckets are
+  stored as the number of tokens used, so that a sender whose role changes
+  immediately gets the new role's budget. The buckets live in memory but can
+  be checkpointed to (and loaded from) the database.
+  """
+  def __init__(self, limits=None):
+    self.limits = limits or config.RATE_LIMITS
+    # maps senders to [used, last_update, notified] lists
+    self.buckets = {}
+    self.last_checkpoint = None
+
+  def limit_for(self, sender):
+    """
+    Returns the limit dictionary for the given sender, or None if they aren't
+    limited.
+    """
+    role = storage.role(sender)
+    if role in self.limits:
+      return self.limits[role]
+    return self.limits.get("default")
+
+  def used(self, sender, limit, now):
+    """
+    Returns the number of tokens from the given sender's bucket that are
+    still in use at the given time.
+    """
+    if sender not in self.buckets:
+      return 0
+    used, last, notified = self.buckets[sender]
+    return max(0, used - (now - last) * limit["per_hour"] / 3600.0)
+
+  def admit(self, sender, now):
+    """
+    Returns "ok" if a message from the given sender should be processed,
+    "notify" if it should be dropped but the sender should be told about it,
+    or "drop" if it should be dropped silently (because the sender has
+    already been told).
+    """
+    limit = self.limit_for(sender)
+    if limit == None:
+      return "ok"
+    used = self.used(sender, limit, now)
+    if used + 1 <= limit["burst"]:
+      self.buckets[sender] = [used + 1, now, False]
+      return "ok"
+    notified = self.buckets.get(sender, [0, now, False])[2]
+    self.buckets[sender] = [used, now, True]
+    if notified:
+      return "drop"
+    return "notify"
+
+  def wait_for(self, sender, now):
+    """
+    Returns the number of minutes until the given sender will be able to send
+    another message.
+    """
+    limit = self.limit_for(sender)
+    if limit == None:
+      return 0
+    excess = self.used(sender, limit, now) + 1 - limit["burst"]
+    return int(max(0, excess) * 3600.0 / limit["per_hour"] // 60) + 1
+
+  def filter(self, messages, now):
+    """
+    Takes a list of (sender, body, reply_function) tuples and returns a list
+    of just the ones that should be processed. Senders who have exceeded their
+    limit are sent a single summary reply while they remain over it.
+    """
+    result = []
+    for m in messages:
+      sender = m[0].lower()
+      verdict = self.admit(sender, now)
+      if verdict == "ok":
+        result.append(m)
+      elif verdict == "notify":
+        m[2](OVER_LIMIT_REPLY.format(wait=self.wait_for(sender, now)))
+    return result
+
+  def prune(self, now):
+    """
+    Forgets buckets that have refilled completely, since they're equivalent
+    to not having a bucket at all.
+    """
+    for sender in list(self.buckets):
+      limit = self.limit_for(sender)
+      if limit == None or self.used(sender, limit, now) == 0:
+        del self.buckets[sender]
+
+  def load(self):
+    """
+    Restores bucket state from the database checkpoint, if there is one.
+    """
+    saved = storage.get_checkpoint(CHECKPOINT_NAME)
+    if saved:
+      self.buckets = json.loads(saved)
+
+  def checkpoint(self, now, force=False):
+    """
+    Saves bucket state to the database if config.RATE_LIMIT_CHECKPOINT
+    seconds have passed since the last checkpoint (or if force is given).
+    """
+    if (
+      not force
+  and self.last_checkpoint != None
+  and now - self.last_checkpoint < config.RATE_LIMIT_CHECKPOINT
+    ):
+      return
+    self.prune(now)
+    storage.set_checkpoint(CHECKPOINT_NAME, json.dumps(self.buckets), now)
+    self.last_checkpoint = now
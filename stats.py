@@ -0,0 +1,335 @@
+"""
+stats.py
+In-process call-count and latency statistics for commands and storage
+functions.
+"""
+
+import time
+import threading
+import inspect
+import bisect
+import collections
+import os
+import contextlib
+
+import config
+
+# How many recent latency samples to keep per function (per thread) for
+# computing percentiles.
+SAMPLES = 1024
+
+# Upper bounds (in seconds) of the latency histogram buckets kept for each
+# function (see metrics.py); there's an implicit final bucket for anything
+# slower.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Each thread records into its own registry, so that recording never needs a
+# lock; registries are only merged when a report is requested. Holds
+# (thread, registry) pairs.
+LOCAL = threading.local()
+REGISTRIES = []
+
+# Per-thread Counters for count, merged the same way; (thread, Counter) pairs.
+COUNTS = []
+
+# Once their threads have finished, registries and Counters are folded into
+# these totals (see retire) so that short-lived threads (like metrics scrapes)
+# don't leave one behind each.
+RETIRED = {}
+RETIRED_COUNTS = collections.Counter()
+RETIRE_LOCK = threading.Lock()
+
+# Gauges record the latest and highest values of a quantity (like a queue
+# depth) rather than call timings. Maps names to [latest, highest] lists.
+GAUGES = {}
+
+LAST_DUMP = None
+
+class Stat:
+  """
+  Statistics for a single instrumented function within a single thread (or
+  within all finished threads; see retire).
+  """
+  def __init__(self):
+    self.calls = 0
+    self.errors = 0
+    self.total = 0.0
+    self.rows = 0
+    self.samples = collections.deque(maxlen=SAMPLES)
+    self.buckets = [0] * (len(BUCKETS) + 1)
+
+def registry():
+  """
+  Returns the current thread's registry, creating it if necessary.
+  """
+  reg = getattr(LOCAL, "registry", None)
+  if reg == None:
+    retire()
+    reg = {}
+    LOCAL.registry = reg
+    REGISTRIES.append((threading.current_thread(), reg)) # atomic
+  return reg
+
+def retire():
+  """
+  Folds the registries and Counters of finished threads into RETIRED and
+  RETIRED_COUNTS, removing them from REGISTRIES and COUNTS.
+  """
+  with RETIRE_LOCK:
+    for entry in [ e for e in REGISTRIES if not e[0].is_alive() ]:
+      for name, stat in entry[1].items():
+        total = RETIRED.get(name)
+        if total == None:
+          total = Stat()
+          RETIRED[name] = total
+        total.calls += stat.calls
+        total.errors += stat.errors
+        total.total += stat.total
+        total.rows += stat.rows
+        total.samples.extend(stat.samples)
+        total.buckets = [ a + b for a, b in zip(total.buckets, stat.buckets) ]
+      REGISTRIES.remove(entry)
+    for entry in [ e for e in COUNTS if not e[0].is_alive() ]:
+      RETIRED_COUNTS.update(dict(entry[1]))
+      COUNTS.remove(entry)
+
+def record(name, elapsed, rows=0, error=False):
+  """
+  Records a single call to the named function which took the given number of
+  seconds and touched the given number of database rows.
+  """
+  reg = registry()
+  stat = reg.get(name)
+  if stat == None:
+    stat = Stat()
+    reg[name] = stat
+  stat.calls += 1
+  stat.total += elapsed
+  stat.rows += rows
+  if error:
+    stat.errors += 1
+  stat.samples.append(elapsed)
+  stat.buckets[bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+def count(name, n=1):
+  """
+  Adds n to the named counter (for things like database statements that are
+  too frequent or too small to time individually).
+  """
+  local = getattr(LOCAL, "counts", None)
+  if local == None:
+    retire()
+    local = collections.Counter()
+    LOCAL.counts = local
+    COUNTS.append((threading.current_thread(), local)) # list.append is atomic
+  local[name] += n
+
+def counts():
+  """
+  Returns a Counter merging every thread's counters.
+  """
+  retire()
+  with RETIRE_LOCK:
+    result = collections.Counter(RETIRED_COUNTS)
+  for thread, c in list(COUNTS):
+    result.update(dict(c))
+  return result
+
+@contextlib.contextmanager
+def timed(name):
+  """
+  A context manager that records the time spent in its body under the given
+  name, like a call to an instrumented function.
+  """
+  start = time.perf_counter()
+  error = True
+  try:
+    yield
+    error = False
+  finally:
+    record(name, time.perf_counter() - start, error=error)
+
+def instrument(name, function, rows=None):
+  """
+  Returns a wrapped version of the given function which records its calls
+  under the given name. Coroutine functions are wrapped as coroutine
+  functions and timed until they finish. If given, 'rows' should be a
+  function that returns a running count of database rows touched; the
+  difference between its values before and after each call is recorded.
+  """
+  if inspect.iscoroutinefunction(function):
+    async def instrumented(*args, **kwargs):
+      before = rows() if rows else 0
+      start = time.perf_counter()
+      error = True
+      try:
+        result = await function(*args, **kwargs)
+        error = False
+        return result
+      finally:
+        record(
+          name,
+          time.perf_counter() - start,
+          (rows() - before) if rows else 0,
+          error
+        )
+  else:
+    def instrumented(*args, **kwargs):
+      before = rows() if rows else 0
+      start = time.perf_counter()
+      error = True
+      try:
+        result = function(*args, **kwargs)
+        error = False
+        return result
+      finally:
+        record(
+          name,
+          time.perf_counter() - start,
+          (rows() - before) if rows else 0,
+          error
+        )
+  instrumented.__name__ = function.__name__
+  instrumented.__doc__ = function.__doc__
+  instrumented.__wrapped__ = function
+  return instrumented
+
+def instrument_module(namespace, prefix, rows=None):
+  """
+  Instruments every public function defined in the module whose globals()
+  dictionary is given, replacing them in place. Names are recorded as
+  <prefix>.<function name>.
+  """
+  module = namespace["__name__"]
+  for name, value in list(namespace.items()):
+    if (
+      callable(value)
+  and not isinstance(value, type)
+  and not name.startswith("_")
+  and getattr(value, "__module__", None) == module
+  and not hasattr(value, "__wrapped__")
+    ):
+      namespace[name] = instrument(prefix + "." + name, value, rows)
+
+def gauge(name, value):
+  """
+  Records the current value of the named gauge.
+  """
+  g = GAUGES.get(name)
+  if g == None:
+    GAUGES[name] = [value, value]
+  else:
+    g[0] = value
+    g[1] = max(g[1], value)
+
+def summary():
+  """
+  Merges all thread registries, returning a dictionary mapping names to
+  (calls, errors, total, rows, samples, buckets) tuples, where samples is a
+  sorted list of recent latencies and buckets counts all calls by latency
+  (see BUCKETS).
+  """
+  merged = {}
+  retire()
+  with RETIRE_LOCK: # keeps registries from being retired while merging
+    for reg in [ RETIRED ] + [ reg for thread, reg in REGISTRIES ]:
+      for name, stat in list(reg.items()):
+        calls, errors, total, rows, samples, buckets = merged.get(
+          name,
+          (0, 0, 0.0, 0, [], [0] * (len(BUCKETS) + 1))
+        )
+        merged[name] = (
+          calls + stat.calls,
+          errors + stat.errors,
+          total + stat.total,
+          rows + stat.rows,
+          samples + list(stat.samples),
+          [ a + b for a, b in zip(buckets, stat.buckets) ]
+        )
+  return {
+    name: (calls, errors, total, rows, sorted(samples), buckets)
+      for name, (calls, errors, total, rows, samples, buckets)
+        in merged.items()
+  }
+
+def percentile(samples, p):
+  """
+  Returns the p-th percentile (0-100) of a sorted list of samples.
+  """
+  if not samples:
+    return 0.0
+  index = min(len(samples) - 1, int(len(samples) * p / 100.0))
+  return samples[index]
+
+def report(prefix=""):
+  """
+  Returns a text table describing all recorded statistics whose names start
+  with the given prefix, sorted by total time spent.
+  """
+  rows = sorted(
+    (
+      (name, s) for name, s in summary().items()
+        if name.startswith(prefix)
+    ),
+    key=lambda r: -r[1][2]
+  )
+  gauges = sorted(
+    (name, g) for name, g in list(GAUGES.items()) if name.startswith(prefix)
+  )
+  gauge_lines = [
+    "{}  now {}, max {}".format(name, latest, highest)
+      for name, (latest, highest) in gauges
+  ] + [
+    "{}  total {}".format(name, n)
+      for name, n in sorted(counts().items()) if name.startswith(prefix)
+  ]
+  if not rows and not gauge_lines:
+    return "<no statistics recorded>\n"
+  if not rows:
+    return "\n".join(gauge_lines) + "\n"
+  width = max(len(name) for name, s in rows)
+  lines = [
+    "{}  {:>7} {:>5} {:>9} {:>8} {:>8} {:>8} {:>8} {:>7}".format(
+      "name".ljust(width),
+      "calls", "errs", "total-s", "mean-ms", "p50-ms", "p90-ms", "p99-ms",
+      "rows"
+    )
+  ]
+  for name, (calls, errors, total, nrows, samples, buckets) in rows:
+    lines.append(
+      "{}  {:7d} {:5d} {:9.3f} {:8.2f} {:8.2f} {:8.2f} {:8.2f} {:7d}".format(
+        name.ljust(width),
+        calls,
+        errors,
+        total,
+        1000 * total / calls if calls else 0.0,
+        1000 * percentile(samples, 50),
+        1000 * percentile(samples, 90),
+        1000 * percentile(samples, 99),
+        nrows
+      )
+    )
+  return "\n".join(lines + gauge_lines) + "\n"
+
+def dump(filename=None):
+  """
+  Writes the full statistics report to the given file (config.STATS_FILE by
+  default), replacing it atomically.
+  """
+  filename = filename or config.STATS_FILE
+  tmp = filename + ".tmp"
+  with open(tmp, 'w') as fout:
+    fout.write(report())
+  os.replace(tmp, filename)
+
+def maybe_dump(now):
+  """
+  Dumps statistics if config.STATS_INTERVAL seconds have passed since the
+  last dump.
+  """
+  global LAST_DUMP
+  if not config.STATS_FILE:
+    return
+  if LAST_DUMP == None or now - LAST_DUMP >= config.STATS_INTERVAL:
+    dump()
+    LAST_DUMP = now
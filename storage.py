@@ -11,11 +11,18 @@ import stat
 import datetime
 import collections
 import sys
+import json
+import copy
+import contextlib
+import contextvars
+import threading
+import hashlib
 
 import config
 
 import formats
 import grading
+import stats
 
 REQ_F = collections.namedtuple(
   "request",
@@ -32,10 +39,23 @@ SUB_F = collections.namedtuple(
   ["id", "assignment_id", "user", "timestamp", "content", "feedback", "grade"]
 )
 
-DBCON = None
+# Each thread gets its own connection to the database (see _db), so that
+# channels can use storage from worker threads.
+DB_NAME = None
+LOCAL = threading.local()
+
+# The transaction (see transaction) that storage functions in the current
+# context (thread or asyncio task) belong to, if any. Each one has its own
+# connection, so messages interleaving on one event loop don't share one.
+TRANSACTION = contextvars.ContextVar("transaction", default=None)
 
 LINE_LENGTH = 80
 
+# Parsed assignment content by assignment id (see get_assignment_content).
+# Assignments can't be edited once created, so entries only need to be
+# dropped when setup is called again.
+ASSIGNMENT_CONTENT = {}
+
 ##########################
 # Convenience functions: #
 ##########################
@@ -54,129 +74,297 @@ def opj(*args):
 ####################
 
 def connect_db(db_name):
-  global DBCON
-  if DBCON == None:
+  global DB_NAME
+  if DB_NAME == None:
     chmod = False
     if not os.path.exists(db_name):
       chmod = True
-    DBCON = sqlite3.connect(db_name)
-    DBCON.row_factory = sqlite3.Row
+    DB_NAME = db_name
+    # WAL mode lets threads read while another thread writes.
+    _db().execute("PRAGMA journal_mode=WAL;")
     if chmod:
       os.chmod(
         db_name,
         stat.S_IRWXU # 0700
       )
 
+def _db():
+  """
+  Returns the current transaction's database connection (see transaction),
+  or else the current thread's, opening it if necessary. Writers wait up to
+  config.DB_BUSY_TIMEOUT seconds for each other. Every statement executed is counted as 'sqlite.statements'.
+  """
+  tx = TRANSACTION.get()
+  if tx != None:
+    return tx.con
+  con = getattr(LOCAL, "con", None)
+  if con == None:
+    con = _connect()
+    LOCAL.con = con
+  return con
+
+def _connect():
+  # Connections used by a transaction may be passed to another thread while
+  # the one that opened them waits (see commands.run_sync).
+  con = sqlite3.connect(
+    DB_NAME,
+    timeout=config.DB_BUSY_TIMEOUT,
+    check_same_thread=False
+  )
+  con.row_factory = sqlite3.Row
+  con.set_trace_callback(_count_statement)
+  return con
+
+def _count_statement(statement):
+  stats.count("sqlite.statements")
+
 def close_db():
   # Note: non-committed changes will be lost!
-  if DBCON != None:
-    DBCON.rollback()
-    DBCON.close()
+  con = getattr(LOCAL, "con", None)
+  if con != None:
+    con.rollback()
+    con.close()
+    LOCAL.con = None
+  spare = getattr(LOCAL, "spare", None)
+  if spare != None:
+    spare.close()
+    LOCAL.spare = None
+
+def _commit():
+  """
+  Commits the current changes, unless they're part of a transaction (see
+  transaction), which commits them at its end instead.
+  """
+  if TRANSACTION.get() == None:
+    _db().commit()
+
+class Transaction:
+  """
+  A transaction's connection, plus the functions to call once it commits
+  (see after_commit).
+  """
+  def __init__(self, con):
+    self.con = con
+    self.after = []
+
+@contextlib.contextmanager
+def transaction():
+  """
+  A context manager that makes everything written to the database within it
+  (in the current thread or asyncio task) a single transaction, on a
+  connection of its own: storage functions don't commit their own changes,
+  and everything is committed when the block finishes, or rolled back if it
+  raises an error. A nested block joins the transaction it's in. Note that
+  the transaction holds SQLite's write lock from its first write until it
+  ends, so slow work should happen before that or after it (see
+  after_commit).
+  """
+  if TRANSACTION.get() != None:
+    yield
+    return
+  con = getattr(LOCAL, "spare", None) or _connect()
+  LOCAL.spare = None
+  tx = Transaction(con)
+  token = TRANSACTION.set(tx)
+  try:
+    yield
+    con.commit()
+  except BaseException:
+    con.rollback()
+    raise
+  finally:
+    TRANSACTION.reset(token)
+    if getattr(LOCAL, "spare", None) == None:
+      LOCAL.spare = con # reused by the thread's next transaction
+    else:
+      con.close()
+  for function in tx.after:
+    function()
+
+def after_commit(function):
+  """
+  Calls function() once the current transaction (see transaction) commits,
+  or right away if there isn't one. It's not called if the transaction is
+  rolled back.
+  """
+  tx = TRANSACTION.get()
+  if tx == None:
+    function()
+  else:
+    tx.after.append(function)
+
+# Tables and indices, created by init_db.
+SCHEMA = [
+  """
+  CREATE TABLE IF NOT EXISTS users(
+    addr TEXT PRIMARY KEY NOT NULL,
+    role TEXT NOT NULL,
+    status TEXT NOT NULL,
+    auth TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS blocking(
+    addr TEXT PRIMARY KEY NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS tokens(
+    user TEXT NOT NULL,
+    token TEXT NOT NULL,
+    purpose TEXT NOT NULL,
+    start REAL NOT NULL,
+    end REAL NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS courses(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    institution TEXT NOT NULL,
+    name TEXT NOT NULL,
+    term TEXT NOT NULL,
+    year INTEGER NOT NULL,
+    auth TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS aliases(
+    user TEXT NOT NULL,
+    course_id INTEGER NOT NULL,
+    alias TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS enrollment(
+    user TEXT NOT NULL,
+    course_id INTEGER NOT NULL,
+    status TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS requests(
+    user TEXT NOT NULL,
+    type TEXT NOT NULL,
+    value TEXT NOT NULL,
+    status TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS assignments(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    course_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    flags TEXT NOT NULL,
+    publish_at REAL NOT NULL,
+    due_at REAL NOT NULL,
+    late_after REAL,
+    reject_after REAL,
+    content TEXT NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS submissions(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user TEXT NOT NULL,
+    assignment_id INTEGER NOT NULL,
+    timestamp REAL NOT NULL,
+    content TEXT NOT NULL,
+    feedback TEXT NOT NULL,
+    grade REAL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS checkpoints(
+    name TEXT PRIMARY KEY NOT NULL,
+    value TEXT NOT NULL,
+    updated REAL NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS outbox(
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    channel TEXT NOT NULL,
+    key TEXT UNIQUE NOT NULL,
+    content TEXT NOT NULL,
+    status TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    next_attempt REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    last_error TEXT
+  );
+  """,
+  """
+  CREATE INDEX IF NOT EXISTS outbox_due
+    ON outbox(channel, status, next_attempt);
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS processed_messages(
+    message_id TEXT NOT NULL,
+    body_hash TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    processed_at REAL NOT NULL,
+    PRIMARY KEY (message_id, body_hash)
+  );
+  """,
+  """
+  CREATE INDEX IF NOT EXISTS processed_messages_age
+    ON processed_messages(processed_at);
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS grading_queue(
+    submission_id INTEGER PRIMARY KEY NOT NULL,
+    status TEXT NOT NULL,
+    queued_at REAL NOT NULL,
+    attempts INTEGER NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    last_error TEXT
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS workers(
+    name TEXT PRIMARY KEY NOT NULL,
+    pid INTEGER NOT NULL,
+    started REAL NOT NULL,
+    heartbeat REAL NOT NULL,
+    processed INTEGER NOT NULL,
+    failed INTEGER NOT NULL
+  );
+  """,
+  """
+  CREATE TABLE IF NOT EXISTS worker_timings(
+    name TEXT PRIMARY KEY NOT NULL,
+    timings TEXT NOT NULL
+  );
+  """,
+]
+
+# The database's user_version is set to this fingerprint of SCHEMA once the
+# schema has been created, so that later startups can skip the DDL.
+SCHEMA_VERSION = int(
+  hashlib.sha256("".join(SCHEMA).encode()).hexdigest()[:7],
+  16
+)
 
 def init_db():
-  cur = DBCON.cursor()
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS users(
-      addr TEXT PRIMARY KEY NOT NULL,
-      role TEXT NOT NULL,
-      status TEXT NOT NULL,
-      auth TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS blocking(
-      addr TEXT PRIMARY KEY NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS tokens(
-      user TEXT NOT NULL,
-      token TEXT NOT NULL,
-      purpose TEXT NOT NULL,
-      start REAL NOT NULL,
-      end REAL NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS courses(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      institution TEXT NOT NULL,
-      name TEXT NOT NULL,
-      term TEXT NOT NULL,
-      year INTEGER NOT NULL,
-      auth TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS aliases(
-      user TEXT NOT NULL,
-      course_id INTEGER NOT NULL,
-      alias TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS enrollment(
-      user TEXT NOT NULL,
-      course_id INTEGER NOT NULL,
-      status TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS requests(
-      user TEXT NOT NULL,
-      type TEXT NOT NULL,
-      value TEXT NOT NULL,
-      status TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS assignments(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      course_id INTEGER NOT NULL,
-      name TEXT NOT NULL,
-      flags TEXT NOT NULL,
-      publish_at REAL NOT NULL,
-      due_at REAL NOT NULL,
-      late_after REAL,
-      reject_after REAL,
-      content TEXT NOT NULL
-    );
-    """
-  )
-  cur.execute(
-    """
-    CREATE TABLE IF NOT EXISTS submissions(
-      id INTEGER PRIMARY KEY AUTOINCREMENT,
-      user TEXT NOT NULL,
-      assignment_id INTEGER NOT NULL,
-      timestamp REAL NOT NULL,
-      content TEXT NOT NULL,
-      feedback TEXT NOT NULL,
-      grade REAL
-    );
-    """
-  )
-  DBCON.commit()
+  """
+  Creates any missing tables and indices, unless the database's
+  user_version shows that it already has the current schema.
+  """
+  if _db().execute("PRAGMA user_version;").fetchone()[0] == SCHEMA_VERSION:
+    return
+  cur = _db().cursor()
+  for statement in SCHEMA:
+    cur.execute(statement)
+  cur.execute("PRAGMA user_version = {};".format(SCHEMA_VERSION))
+  _db().commit()
 
 def init_submisisons():
-  mkdir_p(config.SUBMISSIONS_DIR)
+  if not os.path.isdir(config.SUBMISSIONS_DIR):
+    mkdir_p(config.SUBMISSIONS_DIR)
 
 def setup(db_name):
+  ASSIGNMENT_CONTENT.clear()
   connect_db(db_name)
   init_db()
   init_submisisons()
@@ -228,7 +416,7 @@ def check_auth(submitted, against):
   return submitted == against
 
 def auth_user(user, auth):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT auth FROM users WHERE addr = ?;", (user,))
   against = unique_result_single(cur.fetchall(), "user '{}'".format(user))
   if against:
@@ -237,7 +425,7 @@ def auth_user(user, auth):
     return against
 
 def auth_course(course_id, auth):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT auth FROM courses WHERE id = ?;", (course_id,))
   against = unique_result_single(cur.fetchall(), "course #{}".format(course_id))
   if against:
@@ -246,7 +434,7 @@ def auth_course(course_id, auth):
     return against
 
 def auth_token(now, user, purpose, auth):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT token, start, end FROM tokens WHERE user = ? AND purpose = ?;",
     (user, purpose,)
@@ -268,7 +456,7 @@ def create_token(
   start="now",
   duration=config.TEMP_AUTH_INTERVAL
 ):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   if start == "now":
     start = now
   end = start + duration
@@ -277,35 +465,45 @@ def create_token(
    "INSERT INTO tokens(user, token, purpose, start, end) values(?, ?, ?, ?, ?);",
     (user, token, purpose, start, end)
   )
+  _commit()
   return token
 
 def clean_tokens():
   """
   Removes expired temporary authentication tokens from the database.
   """
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   ts = now_ts()
   cur.execute("DELETE FROM tokens WHERE end < ?;", (ts,))
-  DBCON.commit()
+  _commit()
+
+def next_token_expiry(now):
+  """
+  Returns the timestamp at which the next temporary authentication token
+  expires, or None if there are no unexpired tokens.
+  """
+  cur = _db().cursor()
+  cur.execute("SELECT MIN(end) FROM tokens WHERE end >= ?;", (now,))
+  return cur.fetchone()[0]
 
 def scramble_user(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT addr FROM users WHERE addr = ?;", (user,))
   if len(cur.fetchall()) > 0:
     token = new_auth()
     cur.execute("UPDATE users SET auth = ? WHERE addr = ?;", (token, user))
-    DBCON.commit()
+    _commit()
     return token
   else:
     return None
 
 def scramble_course(course_id):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT id FROM courses WHERE id = ?;", (course_id,))
   if len(cur.fetchall()) > 0:
     token = new_auth()
     cur.execute("UPDATE courses SET auth = ? WHERE id = ?;", (token, course_id))
-    DBCON.commit()
+    _commit()
     return token
   else:
     return None
@@ -319,7 +517,7 @@ def get_course_id(user, id_or_tag_or_alias, id_cache = {}):
     return int(id_or_tag_or_alias)
   except ValueError:
     spl = id_or_tag_or_alias.split("/")
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     if len(spl) == 4:
       cur.execute(
         "SELECT id FROM courses WHERE institution = ? AND name = ? AND term = ? AND year = ?;",
@@ -348,7 +546,7 @@ def course_tag(course_id, tag_cache = {}):
   # TODO: course renaming...
   if course_id in tag_cache:
     return tag_cache[course_id]
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT institution, name, term, year FROM courses WHERE id = ?;",
     (course_id,)
@@ -362,7 +560,7 @@ def course_tag(course_id, tag_cache = {}):
     return "<unknown course #{}>".format(course_id)
 
 def aliases_for(user, course_id):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT alias FROM aliases WHERE user = ? AND course_id = ?;",
     (user, course_id)
@@ -370,7 +568,7 @@ def aliases_for(user, course_id):
   return [row[0] for row in cur.fetchall()]
 
 def courses_enrolled(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT course_id, status FROM enrollment WHERE user = ?;",
     (user,)
@@ -378,7 +576,7 @@ def courses_enrolled(user):
   return cur.fetchall()
 
 def add_user(addr, role="default", status="active"):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT addr FROM users WHERE addr = ?;", (addr,))
   existing = unique_result_single(cur.fetchall(), "user '{}'".format(addr))
   if existing or existing == False:
@@ -392,15 +590,190 @@ def add_user(addr, role="default", status="active"):
       "INSERT INTO users(addr, role, status, auth) values(?, ?, ?, ?);",
       (addr, role, status, auth)
     )
-  DBCON.commit()
+  _commit()
   return auth
 
+#########################
+# Checkpoint functions: #
+#########################
+
+def get_checkpoint(name):
+  """
+  Returns the value of the named checkpoint (a string), or None if it has
+  never been set.
+  """
+  cur = _db().cursor()
+  cur.execute("SELECT value FROM checkpoints WHERE name = ?;", (name,))
+  return unique_result_single(cur.fetchall(), "checkpoint '{}'".format(name))
+
+def set_checkpoint(name, value, now):
+  """
+  Records a string value under the given checkpoint name, replacing any
+  previous value.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "INSERT OR REPLACE INTO checkpoints(name, value, updated) values(?, ?, ?);",
+    (name, value, now)
+  )
+  _commit()
+
+#####################
+# Outbox functions: #
+#####################
+
+OUT_F = collections.namedtuple(
+  "outbound",
+  ["id", "key", "reply", "attempts"]
+)
+
+def queue_outbound(channel, key, reply, now):
+  """
+  Durably queues a reply (a JSON-serializable dictionary) for sending by the
+  given channel. The key identifies the reply: queueing a second reply with
+  the same key (for example when a message is re-processed) does nothing.
+  Returns True if the reply was queued.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "INSERT OR IGNORE INTO outbox(channel, key, content, status, queued_at, next_attempt, attempts) values(?, ?, ?, ?, ?, ?, ?);",
+    (channel, key, json.dumps(reply), "queued", now, now, 0)
+  )
+  _commit()
+  return cur.rowcount > 0
+
+def due_outbound(channel, now, limit=None):
+  """
+  Returns a list of OUT_F tuples for queued replies for the given channel
+  that are due to be (re-)sent, oldest first.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT id, key, content, attempts FROM outbox WHERE channel = ? AND status = ? AND next_attempt <= ? ORDER BY id LIMIT ?;",
+    (channel, "queued", now, limit or -1)
+  )
+  return [
+    OUT_F(row["id"], row["key"], json.loads(row["content"]), row["attempts"])
+      for row in cur.fetchall()
+  ]
+
+def outbound_sent(ids, now):
+  """
+  Marks the given queued replies as sent. Sent replies are kept (without
+  their content) for config.OUTBOX_RETENTION seconds so that their keys still
+  prevent duplicates.
+  """
+  cur = _db().cursor()
+  cur.executemany(
+    "UPDATE outbox SET status = ?, content = ?, next_attempt = ? WHERE id = ?;",
+    [ ("sent", "{}", now, i) for i in ids ]
+  )
+  _commit()
+
+def outbound_failed(ids, now, error):
+  """
+  Records a failed attempt to send the given queued replies, scheduling
+  another attempt with exponential backoff. After config.OUTBOX_MAX_ATTEMPTS
+  attempts a reply is marked as 'failed' and no longer retried.
+  """
+  cur = _db().cursor()
+  for i in ids:
+    cur.execute("SELECT attempts FROM outbox WHERE id = ?;", (i,))
+    row = unique_result(cur.fetchall(), "outbox #{}".format(i))
+    if not row:
+      continue
+    attempts = row[0] + 1
+    delay = min(
+      config.OUTBOX_MAX_BACKOFF,
+      config.OUTBOX_BACKOFF * 2 ** (attempts - 1)
+    )
+    cur.execute(
+      "UPDATE outbox SET status = ?, attempts = ?, next_attempt = ?, last_error = ? WHERE id = ?;",
+      (
+        "failed" if attempts >= config.OUTBOX_MAX_ATTEMPTS else "queued",
+        attempts,
+        now + delay,
+        error,
+        i
+      )
+    )
+  _commit()
+
+def outbox_status(now):
+  """
+  Returns a (queued, oldest_age, failed) tuple describing the outbox: the
+  number of replies waiting to be sent, the age in seconds of the oldest of
+  them (0 if there are none), and the number that have been given up on.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT COUNT(*), MIN(queued_at) FROM outbox WHERE status = ?;",
+    ("queued",)
+  )
+  queued, oldest = cur.fetchone()
+  cur.execute("SELECT COUNT(*) FROM outbox WHERE status = ?;", ("failed",))
+  failed = cur.fetchone()[0]
+  return (queued, now - oldest if oldest != None else 0, failed)
+
+def clean_outbox(now):
+  """
+  Removes sent replies older than config.OUTBOX_RETENTION seconds.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "DELETE FROM outbox WHERE status = ? AND next_attempt < ?;",
+    ("sent", now - config.OUTBOX_RETENTION)
+  )
+  _commit()
+
+#####################
+# Ledger functions: #
+#####################
+
+def message_processed(message_id, body_hash):
+  """
+  Returns True if a message with the given Message-Id and body hash has
+  already been processed (within config.LEDGER_RETENTION seconds).
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT 1 FROM processed_messages WHERE message_id = ? AND body_hash = ?;",
+    (message_id, body_hash)
+  )
+  return cur.fetchone() != None
+
+def record_processed(message_id, body_hash, sender, now):
+  """
+  Records that a message has been processed, so that it's skipped if it's
+  received again (see message_processed).
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    INSERT OR IGNORE INTO processed_messages(message_id, body_hash, sender, processed_at)
+      VALUES (?, ?, ?, ?);
+    """,
+    (message_id, body_hash, sender, now)
+  )
+  _commit()
+
+def clean_processed(now):
+  """
+  Forgets processed messages older than config.LEDGER_RETENTION seconds.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "DELETE FROM processed_messages WHERE processed_at < ?;",
+    (now - config.LEDGER_RETENTION,)
+  )
+  _commit()
+
 #####################
 # Status functions: #
 #####################
 
 def is_registered(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT addr FROM users WHERE addr = ?;", (user,))
   result = unique_result_single(cur.fetchall(), "user '{}'".format(user))
   if result == None:
@@ -409,19 +782,19 @@ def is_registered(user):
     return True
 
 def set_block(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT addr FROM blocking WHERE addr = ?;", (user,))
   if len(cur.fetchall()) == 0:
     cur.execute("INSERT INTO blocking(addr) values(?);", (user,))
-    DBCON.commit()
+    _commit()
 
 def remove_block(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("DELETE FROM blocking WHERE addr = ?;", (user,))
-  DBCON.commit()
+  _commit()
 
 def status(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT status FROM users WHERE addr = ?;", (user,))
   result = unique_result_single(cur.fetchall(), "user '{}'".format(user))
   if result == None:
@@ -434,15 +807,15 @@ def status(user):
 def set_status(user, status):
   if not is_registered(user):
     add_user(user)
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "UPDATE users SET status = ? WHERE addr = ?;",
     status, user
   )
-  DBCON.commit()
+  _commit()
 
 def role(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT role FROM users WHERE addr = ?;", (user,))
   result = unique_result_single(cur.fetchall(), "user '{}'".format(user))
   if not result:
@@ -453,15 +826,15 @@ def role(user):
 def set_role(user, role):
   if not is_registered(user):
     add_user(user)
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "UPDATE users SET role = ? WHERE addr = ?;",
     (role, user)
   )
-  DBCON.commit()
+  _commit()
 
 def enrollment_status(user, course_id):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT status FROM enrollment WHERE user = ? AND course_id = ?;",
     (user, course_id)
@@ -476,7 +849,7 @@ def enrollment_status(user, course_id):
   return result or "none"
 
 def all_enrollments(user):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT course_id, user, status FROM enrollment WHERE user = ?;",
     (user,)
@@ -484,7 +857,7 @@ def all_enrollments(user):
   return [ ENR_F(*r) for r in cur.fetchall() ]
 
 def enrolled_users(course_id):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT course_id, user, status FROM enrollment WHERE course_id = ?;",
     (course_id,)
@@ -496,7 +869,7 @@ def enrolled_users(course_id):
 ######################
 
 def process_request(user, typ, value):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   if typ == "role":
     cur.execute(
       "SELECT addr FROM users WHERE addr = ?;",
@@ -508,14 +881,14 @@ def process_request(user, typ, value):
       "UPDATE users SET role = ? WHERE addr = ?;",
       (value, user)
     )
-    DBCON.commit()
+    _commit()
     return (True, "Set role to {} for user '{}'.\n".format(value, user))
   else:
     return (False, "Unknown permission type {}.\n".format(typ))
 
 
 def outstanding_requests(user=None):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   if user:
     cur.execute("SELECT typ, value, status FROM requests;")
   else:
@@ -526,7 +899,7 @@ def outstanding_requests(user=None):
   [REQ_F(*row) for row in cur.fetchall()]
 
 def submit_request(user, typ, value):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT status FROM requests WHERE user = ? AND type = ? AND value = ?;",
     (user, typ, value)
@@ -550,7 +923,7 @@ def submit_request(user, typ, value):
       "DELETE FROM requests WHERE user = ? AND type = ? AND value = ?;",
       (user, typ, value)
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       """
@@ -568,7 +941,7 @@ Request {}/{} pre-authorized for user '{}'.
     "INSERT INTO requests(user, type, value, status) values(?, ?, ?, ?);",
     (user, typ, value, "requested")
   )
-  DBCON.commit()
+  _commit()
   return (
     True,
     """\
@@ -583,7 +956,7 @@ to approve this request.
   )
 
 def grant_request(user, typ, value):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT status FROM requests WHERE user = ? AND type = ? AND value = ?;"
     (user, typ, value)
@@ -601,7 +974,7 @@ def grant_request(user, typ, value):
       "DELETE FROM requests WHERE user = ? AND type = ? AND value = ?;",
       (user, typ, value)
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       """
@@ -627,7 +1000,7 @@ Granted requested permission {}/{} for user '{}'.
     "INSERT INTO requests(user, type, value, status) values(?, ?, ?, ?);",
     (user, typ, value, "granted")
   )
-  DBCON.commit()
+  _commit()
   return (
     True,
     """\
@@ -646,7 +1019,7 @@ to do so.
 ################################
 
 def create_course(user, institution, name, term, year):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT id FROM courses WHERE institution = ? AND name = ? AND term = ? AND year = ?;",
     (institution, name, term, year)
@@ -671,7 +1044,7 @@ def create_course(user, institution, name, term, year):
     (institution, name, term, year)
   )
   course_id = cur.fetchall()[0][0]
-  DBCON.commit()
+  _commit()
   add_instructor(course_id, user)
   return (
     True,
@@ -707,12 +1080,12 @@ Students can then enroll in the course by sending:
 def add_instructor(course_id, user):
   enr = enrollment_status(user, course_id)
   if enr == "none":
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     cur.execute(
       "INSERT INTO enrollment(user, course_id, status) values(?, ?, ?);",
       (user, course_id, "instructor")
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       "Set user '{}' to be an instructor for course {}".format(
@@ -721,12 +1094,12 @@ def add_instructor(course_id, user):
       )
     )
   else:
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     cur.execute(
       "UPDATE enrollment set status = ? WHERE user = ? AND course_id = ?;",
       ("instructor", user, course_id)
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       "Added user '{}' as an instructor for course {}".format(
@@ -762,12 +1135,12 @@ def expect_student(course_id, user):
       )
     )
   elif enr != "none":
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     cur.execute(
       "UPDATE enrollment set status = ? WHERE user = ? AND course_id = ?;",
       ("expected", user, course_id)
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       "Set enrollment status to 'expected' for user '{}' in course {}".format(
@@ -776,12 +1149,12 @@ def expect_student(course_id, user):
       )
     )
   else:
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     cur.execute(
       "INSERT INTO enrollment(user, course_id, status) values(?, ?, ?);",
       (user, course_id, "expected")
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       "Added user '{}' as an 'expected' student for course {}".format(
@@ -793,12 +1166,12 @@ def expect_student(course_id, user):
 def enroll_student(course_id, user):
   enr = enrollment_status(user, course_id)
   if enr == "expected":
-    cur = DBCON.cursor()
+    cur = _db().cursor()
     cur.execute(
       "UPDATE enrollment set status = ? WHERE user = ? AND course_id = ?;",
       ("enrolled", user, course_id)
     )
-    DBCON.commit()
+    _commit()
     return (
       True,
       "Enrolled expected user '{}' in course {}.".format(
@@ -835,7 +1208,7 @@ def create_assignment(course_id, assignment):
   raw = formats.unparse(assignment)
 
   # Check that the course exists:
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute("SELECT id FROM courses WHERE id = ?;",(course_id,))
   valid = unique_result_single(cur.fetchall(), "course #{}".format(course_id))
   if not valid:
@@ -873,7 +1246,7 @@ def create_assignment(course_id, assignment):
       raw
     )
   )
-  DBCON.commit()
+  _commit()
   return (
     True,
     "Successfully created assignment '{}' for course {}.".format(
@@ -884,7 +1257,7 @@ def create_assignment(course_id, assignment):
 
 def get_assignment_id(course_id, name):
   tag = course_tag(course_id)
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT id FROM assignments WHERE course_id = ? AND name = ?;",
     (course_id, name)
@@ -894,8 +1267,34 @@ def get_assignment_id(course_id, name):
     "course #{} / assignment '{}'".format(course_id, name)
   )
 
+def get_assignment_ids(course_id, names):
+  """
+  Returns a dictionary mapping each of the given assignment names to its ID
+  within the given course, using a single query. Names that don't match an
+  assignment are left out.
+  """
+  names = list(names)
+  if not names:
+    return {}
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT id, name FROM assignments WHERE course_id = ? AND name IN ({});"\
+      .format(", ".join("?" for n in names)),
+    [course_id] + names
+  )
+  return { row["name"]: row["id"] for row in cur.fetchall() }
+
 def get_assignment_content(aid):
-  cur = DBCON.cursor()
+  """
+  Returns the parsed content of an assignment (a fresh copy, which callers
+  may modify) and a message, or None and an error message.
+  """
+  if aid in ASSIGNMENT_CONTENT:
+    return (
+      copy.deepcopy(ASSIGNMENT_CONTENT[aid]),
+      "Fetched assignment #{}.".format(aid)
+    )
+  cur = _db().cursor()
   cur.execute(
     "SELECT content FROM assignments WHERE id = ?;",
     (aid,)
@@ -907,10 +1306,11 @@ def get_assignment_content(aid):
   valid, err = formats.process_assignment(result)
   if not valid:
     return (None, err)
-  return (result, "Fetched assignment #{}.".format(aid))
+  ASSIGNMENT_CONTENT[aid] = result
+  return (copy.deepcopy(result), "Fetched assignment #{}.".format(aid))
 
 def get_assignment_info(aid):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT name, flags, publish_at, due_at, late_after, reject_after FROM assignments WHERE id = ?;",
     (aid,)
@@ -918,7 +1318,7 @@ def get_assignment_info(aid):
   return unique_result(cur.fetchall(), "assignment #{}".format(aid))
 
 def assignments_for(course_id, now, mode="all"):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   if mode == "current":
     cur.execute(
       "SELECT id FROM assignments WHERE course_id = ? AND publish_at <= ? AND reject_after >= ?;",
@@ -952,12 +1352,12 @@ def submit_assignment(user, aid, now, submission):
   if err:
     return (False, err)
   raw = formats.unparse(submission)
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "INSERT INTO submissions(user, assignment_id, timestamp, content, feedback, grade) values(?, ?, ?, ?, ?, ?);",
     (user, aid, now, raw, "", None)
   )
-  DBCON.commit()
+  _commit()
   return (
     True,
     "Added new submission for assignment '{}' from user {}.".format(
@@ -966,8 +1366,38 @@ def submit_assignment(user, aid, now, submission):
     )
   )
 
+def submit_assignments(user, now, submissions):
+  """
+  Submits several assignments at once. Takes a list of (name, aid,
+  submission) tuples and validates each against its (cached) assignment
+  definition, inserting all valid submissions using a single executemany and
+  a single commit. Returns a list of (name, success, message) tuples in the
+  same order as the input.
+  """
+  results = []
+  rows = []
+  for name, aid, submission in submissions:
+    assignment, msg = get_assignment_content(aid)
+    if not assignment:
+      results.append((name, False, msg))
+      continue
+    valid, err = formats.check_submission(assignment, submission)
+    if err:
+      results.append((name, False, err))
+      continue
+    rows.append((user, aid, now, formats.unparse(submission), "", None))
+    results.append((name, True, "submission added"))
+  if rows:
+    cur = _db().cursor()
+    cur.executemany(
+      "INSERT INTO submissions(user, assignment_id, timestamp, content, feedback, grade) values(?, ?, ?, ?, ?, ?);",
+      rows
+    )
+    _commit()
+  return results
+
 def get_all_submissions_to(aid):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT id, assignment_id, user, timestamp, content, feedback, grade FROM submissions WHERE assignment_id = ?;",
     (aid,)
@@ -975,7 +1405,7 @@ def get_all_submissions_to(aid):
   return [SUB_F(*row) for row in cur.fetchall()]
 
 def get_submissions_for(user, aid):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT id, assignment_id, user, timestamp, content, feedback, grade FROM submissions WHERE user = ? AND assignment_id = ?;",
     (user, aid)
@@ -984,7 +1414,7 @@ def get_submissions_for(user, aid):
 
 
 def get_rep_submissions_for(user, aid, now, finalized=True, any_late=False):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT late_after, reject_after FROM assignments WHERE id = ?;",
     (aid,)
@@ -1004,7 +1434,7 @@ def get_rep_submissions_for(user, aid, now, finalized=True, any_late=False):
     if err:
       print(err, file=sys.stderr)
     elif should:
-      success, msg = set_grade_info(sub[0])
+      success, msg = request_grading(sub[0], now)
       if not success:
         print(msg, file=sys.stderr)
 
@@ -1034,7 +1464,7 @@ def get_rep_submissions_for(user, aid, now, finalized=True, any_late=False):
 ######################
 
 def grade_for(user, aid, now):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT late_after, content FROM assignments WHERE id = ?;",
     (aid,)
@@ -1086,7 +1516,7 @@ def grade_for(user, aid, now):
   return ("", (grade, feedback))
 
 def set_grade_info(sid):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
     "SELECT user, assignment_id, content FROM submissions WHERE id = ?;",
     (sid,)
@@ -1107,23 +1537,22 @@ def set_grade_info(sid):
     "UPDATE submissions SET grade = ?, feedback = ? WHERE id = ?;",
     (grade, feedback, sid)
   )
-  DBCON.commit()
+  _commit()
   return (True, "Updated grade info for submission #{}.".format(sid))
 
 def should_be_graded(submission, now):
-  cur = DBCON.cursor()
+  cur = _db().cursor()
   cur.execute(
-    "SELECT id, flags, late_after, reject_after, content FROM assignments WHERE id = ?;",
+    "SELECT id, flags, late_after, reject_after FROM assignments WHERE id = ?;",
     (submission.assignment_id,)
   );
   row = unique_result(
     cur.fetchall(),
     "assignment #{}".format(submission.assignment_id)
   )
-  aid, flags, late_after, reject_after, content = row
-  assignment = formats.parse_text(content)[0]
-  valid, err = formats.process_assignment(assignment)
-  if err:
+  aid, flags, late_after, reject_after = row
+  assignment, err = get_assignment_content(aid) # checks that it's valid
+  if assignment == None:
     return (False, "Error checking assignment status: " + err)
 
   status = "unknown"
@@ -1162,18 +1591,32 @@ and (
   return (False, "")
 
 def maintain_grade_info(last_ts, now):
-  cur = DBCON.cursor()
+  """
+  Requests grading for every ungraded submission that should be graded by
+  now (see should_be_graded). Only submissions to assignments whose late
+  deadline has passed or which have a grade-immediately flag are checked,
+  and not ones already in the grading queue.
+  """
+  cur = _db().cursor()
   cur.execute(
-    "SELECT id, assignment_id, user, timestamp, content, feedback, grade FROM submissions WHERE grade == ?;",
-    (None,)
+    """
+    SELECT
+      submissions.id, assignment_id, user, timestamp, submissions.content,
+      feedback, grade
+    FROM submissions JOIN assignments ON assignment_id = assignments.id
+    WHERE grade IS NULL
+      AND (late_after <= ? OR flags LIKE '%immediately%')
+      AND submissions.id NOT IN (SELECT submission_id FROM grading_queue);
+    """,
+    (now,)
   )
   errors = []
   for row in cur.fetchall():
-    should, err = should_be_graded(row, now)
+    should, err = should_be_graded(SUB_F(*row), now)
     if err:
       errors.append(err)
     elif should:
-      success, msg = set_grade_info(row[0])
+      success, msg = request_grading(row[0], now)
       if not success:
         errors.append(
           "Error setting grade info for submission #{}:\n  {}".format(
@@ -1187,3 +1630,224 @@ def maintain_grade_info(last_ts, now):
     for e in errors:
       print("  " + e, file=sys.stderr)
   return None
+
+def next_grading_deadline(now):
+  """
+  Returns the timestamp of the next late or reject deadline after now for
+  an assignment that has ungraded submissions, or None if there isn't one.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    SELECT MIN(deadline) FROM (
+      SELECT late_after AS deadline FROM assignments
+        WHERE id IN (SELECT assignment_id FROM submissions WHERE grade IS NULL)
+      UNION ALL
+      SELECT reject_after AS deadline FROM assignments
+        WHERE id IN (SELECT assignment_id FROM submissions WHERE grade IS NULL)
+    ) WHERE deadline > ?;
+    """,
+    (now,)
+  )
+  return cur.fetchone()[0]
+
+def late_deadline_within(user, now, window):
+  """
+  Returns True if the late deadline of some assignment in a course the given
+  user is enrolled in (or expected in) falls within the next window seconds.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    SELECT 1 FROM assignments JOIN enrollment
+      ON assignments.course_id = enrollment.course_id
+    WHERE enrollment.user = ? AND assignments.late_after BETWEEN ? AND ?
+    LIMIT 1;
+    """,
+    (user, now, now + window)
+  )
+  return cur.fetchone() != None
+
+############################
+# Grading queue functions: #
+############################
+
+def request_grading(sid, now):
+  """
+  Arranges for a submission to be graded: immediately if
+  config.GRADING_WORKER is off, and otherwise by adding it to the grading
+  queue for the grading worker (see grader.py). Returns a (success, message)
+  tuple.
+  """
+  if not config.GRADING_WORKER:
+    return set_grade_info(sid)
+  # Queued after the current transaction commits, so that a command that
+  # requests grading before doing slow work (like rendering every student's
+  # submissions) doesn't hold the write lock meanwhile. If that never
+  # happens, maintain_grade_info requests grading again later.
+  after_commit(lambda: queue_grading(sid, now))
+  return (True, "Queued submission #{} for grading.".format(sid))
+
+def queue_grading(sid, now):
+  """
+  Adds a submission to the grading queue. Returns False if it was already
+  queued (or has been given up on).
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    INSERT OR IGNORE INTO grading_queue(submission_id, status, queued_at, attempts)
+      VALUES (?, ?, ?, 0);
+    """,
+    (sid, "queued", now)
+  )
+  _commit()
+  return cur.rowcount > 0
+
+def claim_grading(worker, now, limit):
+  """
+  Claims up to limit queued submissions (oldest first) for the given
+  worker, along with any whose claim is more than
+  config.GRADING_CLAIM_TIMEOUT seconds old. Returns the claimed submission
+  IDs.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    UPDATE grading_queue
+      SET status = ?, claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+      WHERE submission_id IN (
+        SELECT submission_id FROM grading_queue
+          WHERE status = ? OR (status = ? AND claimed_at < ?)
+          ORDER BY queued_at
+          LIMIT ?
+      );
+    """,
+    (
+      "working", worker, now,
+      "queued", "working", now - config.GRADING_CLAIM_TIMEOUT,
+      limit
+    )
+  )
+  _commit()
+  cur.execute(
+    """
+    SELECT submission_id FROM grading_queue
+      WHERE status = ? AND claimed_by = ? AND claimed_at = ?
+      ORDER BY queued_at;
+    """,
+    ("working", worker, now)
+  )
+  return [ row[0] for row in cur.fetchall() ]
+
+def grading_done(sid, success, error=None):
+  """
+  Records the result of grading a claimed submission: it's removed from the
+  queue if grading succeeded, and otherwise queued again, or marked as failed
+  once it has been tried config.GRADING_MAX_ATTEMPTS times.
+  """
+  cur = _db().cursor()
+  if success:
+    cur.execute(
+      "DELETE FROM grading_queue WHERE submission_id = ?;",
+      (sid,)
+    )
+  else:
+    cur.execute(
+      """
+      UPDATE grading_queue
+        SET status = CASE WHEN attempts >= ? THEN ? ELSE ? END,
+            claimed_by = NULL, claimed_at = NULL, last_error = ?
+        WHERE submission_id = ?;
+      """,
+      (config.GRADING_MAX_ATTEMPTS, "failed", "queued", error, sid)
+    )
+  _commit()
+
+def worker_heartbeat(name, pid, started, now, processed, failed, timings=None):
+  """
+  Records that the named worker process is alive, along with how many items
+  it has processed and how many of those failed since it started. If given,
+  timings (a stats.summary() from the worker process) are recorded too, so
+  that the server can report them (see worker_timings).
+  """
+  cur = _db().cursor()
+  cur.execute(
+    """
+    INSERT OR REPLACE INTO workers(name, pid, started, heartbeat, processed, failed)
+      VALUES (?, ?, ?, ?, ?, ?);
+    """,
+    (name, pid, started, now, processed, failed)
+  )
+  if timings != None:
+    cur.execute(
+      "INSERT OR REPLACE INTO worker_timings(name, timings) VALUES (?, ?);",
+      (
+        name,
+        json.dumps({
+          n: [calls, errors, total, rows, buckets]
+            for n, (calls, errors, total, rows, samples, buckets)
+              in timings.items()
+        })
+      )
+    )
+  _commit()
+
+def worker_timings():
+  """
+  Returns the timings last recorded by each worker process (see
+  worker_heartbeat), as a dictionary mapping worker names to dictionaries
+  like stats.summary() returns (without samples).
+  """
+  cur = _db().cursor()
+  cur.execute("SELECT name, timings FROM worker_timings ORDER BY name;")
+  return {
+    row["name"]: {
+      n: (calls, errors, total, rows, [], buckets)
+        for n, (calls, errors, total, rows, buckets)
+          in json.loads(row["timings"]).items()
+    }
+    for row in cur.fetchall()
+  }
+
+def worker_status(name):
+  """
+  Returns the last heartbeat recorded by the named worker as a row with
+  pid, started, heartbeat, processed, and failed fields, or None if it
+  has never reported.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT pid, started, heartbeat, processed, failed FROM workers WHERE name = ?;",
+    (name,)
+  )
+  return unique_result(cur.fetchall(), "worker '{}'".format(name))
+
+def grading_status(now):
+  """
+  Returns a (queued, oldest_age, failed) tuple describing the grading queue,
+  like outbox_status.
+  """
+  cur = _db().cursor()
+  cur.execute(
+    "SELECT COUNT(*), MIN(queued_at) FROM grading_queue WHERE status != ?;",
+    ("failed",)
+  )
+  queued, oldest = cur.fetchone()
+  cur.execute(
+    "SELECT COUNT(*) FROM grading_queue WHERE status = ?;",
+    ("failed",)
+  )
+  failed = cur.fetchone()[0]
+  return (queued, now - oldest if oldest != None else 0, failed)
+
+####################
+# Instrumentation: #
+####################
+
+def _rows_touched():
+  tx = TRANSACTION.get()
+  con = tx.con if tx != None else getattr(LOCAL, "con", None)
+  return con.total_changes if con != None else 0
+
+stats.instrument_module(globals(), "storage", _rows_touched)
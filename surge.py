@@ -0,0 +1,344 @@
+"""
+surge.py
+Fast path for submissions during a deadline rush. While the late deadline
+of an assignment in one of the sender's courses is near (see
+config.SURGE_WINDOW), messages that only submit assignments aren't processed
+right away: they're appended to a log in config.SUBMISSIONS_DIR (and synced
+to disk), and the sender gets a receipt. A background thread (see Drainer)
+then processes the logged messages as of the time they were received and
+replies with the results. The sender's other messages are logged too until
+then, so that each sender's messages are still processed in order.
+"""
+
+import os
+import sys
+import json
+import collections
+import concurrent.futures
+import hashlib
+import threading
+import traceback
+
+import config
+import commands
+import formats
+import stats
+import storage
+
+SUBMIT_COMMANDS = ("submit", "submit-batch")
+AUTH_COMMANDS = ("auth", "user")
+
+RECEIPT = """\
+Academibot received your submission at {time} UTC (receipt {receipt}).
+
+Because an assignment deadline is coming up, your submission has been saved
+as-is and will be checked and recorded shortly, as of the time it was
+received. You'll get another message with the results.
+"""
+
+LOCK = threading.Lock()
+LOG = None
+
+# Respond functions for logged messages that haven't been processed yet, by
+# their offset in the log. After a restart, replies are sent using the route
+# recorded with each message instead (see mail.route_reply).
+RESPONDERS = {}
+
+# Counts each user's logged messages that haven't been processed yet (see
+# waiting).
+WAITING = collections.Counter()
+
+# Set when a message is logged, to wake up the Drainer
+WAKE = threading.Event()
+
+def log_path():
+  return os.path.join(config.SUBMISSIONS_DIR, "surge.log")
+
+def checkpoint_name():
+  return "surge-offset:" + os.path.abspath(log_path())
+
+def applies(user, body, now):
+  """
+  Returns True if a message from the given user with the given body should
+  take the fast path: it submits something, has no commands other than
+  submissions and authentication, and the late deadline of an assignment in
+  one of the user's courses is near.
+  """
+  if not config.SURGE_WINDOW:
+    return False
+  names = commands.command_names(body)
+  if not any(n in SUBMIT_COMMANDS for n in names):
+    return False
+  if not all(n in SUBMIT_COMMANDS or n in AUTH_COMMANDS for n in names):
+    return False
+  return storage.late_deadline_within(user, now, config.SURGE_WINDOW)
+
+def waiting(user):
+  """
+  Returns True if the given user has logged messages that haven't been
+  processed yet, in which case their next message must be logged too.
+  """
+  with LOCK:
+    return WAITING[user] > 0
+
+def start_offset(path):
+  """
+  Returns the offset of the first unprocessed message in the log.
+  """
+  offset = int(storage.get_checkpoint(checkpoint_name()) or 0)
+  if offset > os.path.getsize(path):
+    offset = 0 # the log was emptied before the checkpoint was reset
+  return offset
+
+def load():
+  """
+  Counts the unprocessed messages in the log by user (see WAITING), as
+  after a restart.
+  """
+  path = log_path()
+  counts = collections.Counter()
+  if os.path.exists(path):
+    with open(path, 'rb') as fin:
+      fin.seek(start_offset(path))
+      for line in fin:
+        if not line.endswith(b"\n"):
+          break
+        counts[json.loads(line)["user"]] += 1
+  with LOCK:
+    WAITING.clear()
+    WAITING.update(counts)
+
+def append(user, body, received, rf, receipt=True):
+  """
+  Appends a message to the log, returning once it's on disk. Returns a
+  receipt code for it; receipt says whether that will be sent as the first
+  reply. The message's Message-Id (if rf has one) is logged with it, so that
+  a second copy is skipped (see process_entry).
+  """
+  global LOG
+  mid = getattr(rf, "message_id", None)
+  line = (
+    json.dumps({
+      "user": user,
+      "body": body,
+      "received": received,
+      "route": getattr(rf, "route", None),
+      "receipt": receipt,
+      "mid": mid if mid != "?" else None,
+    })
+  + "\n"
+  ).encode()
+  with LOCK:
+    if LOG == None:
+      LOG = open(log_path(), 'ab')
+    offset = LOG.seek(0, os.SEEK_END)
+    LOG.write(line)
+    LOG.flush()
+    os.fsync(LOG.fileno())
+    RESPONDERS[offset] = rf
+    WAITING[user] += 1
+  stats.count("surge.logged")
+  WAKE.set()
+  return hashlib.sha256(line).hexdigest()[:12]
+
+def defer(user, body, received, rf, receipt=True):
+  """
+  Logs a message for later processing and, if receipt is True, replies with
+  a receipt.
+  """
+  code = append(user, body, received, rf, receipt)
+  if not receipt:
+    return
+  rf(
+    RECEIPT.format(
+      time=formats.date_string(formats.date_for(received)),
+      receipt=code
+    )
+  )
+
+def close():
+  global LOG
+  with LOCK:
+    if LOG != None:
+      LOG.close()
+      LOG = None
+
+def process_entry(entry, respond):
+  """
+  Processes a logged message as of the time it was received, passing the
+  response to respond (if there is one). The commands' effects and the
+  reply are committed together (see storage.transaction), along with a
+  ledger entry for the message if it has a Message-Id. A message can be
+  logged twice if the transaction that logged it was rolled back and it was
+  processed again, and it can be processed twice if the server stops before
+  its offset is checkpointed; the ledger entry means it's only processed
+  once.
+  """
+  try:
+    with storage.transaction():
+      digest = "surge:" + hashlib.sha256(entry["body"].encode()).hexdigest()
+      if entry.get("mid") and storage.message_processed(entry["mid"], digest):
+        stats.count("surge.duplicates")
+        return
+      cmds = commands.parse(entry["body"])
+      response = commands.run_sync(
+        commands.handle_commands_async(
+          entry["user"],
+          entry["body"],
+          cmds,
+          entry["received"]
+        )
+      )
+      send_response(entry, respond, response)
+      if entry.get("mid"):
+        storage.record_processed(
+          entry["mid"],
+          digest,
+          entry["user"],
+          entry["received"]
+        )
+  except Exception:
+    traceback.print_exc()
+    sys.stderr.flush()
+    send_response(
+      entry,
+      respond,
+      """\
+Academibot encountered an error while processing a submission you sent
+earlier, so it was not recorded. Please re-send it, or contact an instructor
+if the deadline has passed.
+
+The message you sent was:
+
+{}
+""".format(entry["body"])
+    )
+
+def send_response(entry, respond, response):
+  if respond:
+    respond(response)
+  else:
+    print(
+      "No way to reply to {} about a logged submission:\n{}".format(
+        entry["user"],
+        response
+      ),
+      file=sys.stderr
+    )
+
+def drain(now, limit=None, dispatcher=None):
+  """
+  Processes up to limit logged messages (all of them by default),
+  checkpointing the log offset as they finish. Once everything has been
+  processed, the log is emptied. Given a dispatcher (see
+  academibot.Dispatcher), each message is processed on its sender's worker,
+  so each sender's messages are still processed in order while different
+  senders' run in parallel; up to config.POLL_BATCH messages are handed out
+  at a time. The checkpoint only moves past a message once it and every
+  message before it have finished. Returns the number of messages processed.
+  """
+  path = log_path()
+  if not os.path.exists(path):
+    return 0
+  offset = start_offset(path)
+  position = offset # of the next line to read
+  processed = 0
+  pending = collections.deque() # (future, offset after the message)
+  with open(path, 'rb') as fin:
+    fin.seek(offset)
+    for line in fin:
+      if not line.endswith(b"\n") or (limit != None and processed >= limit):
+        break
+      entry = json.loads(line)
+      with LOCK:
+        respond = RESPONDERS.pop(position, None)
+      if respond == None and entry["route"]:
+        import mail
+        respond = lambda text, route=entry["route"]: mail.route_reply(
+          route,
+          2 if entry.get("receipt", True) else 1, # after the receipt
+          text
+        )
+      run = lambda entry=entry, respond=respond: finish_entry(entry, respond)
+      if dispatcher:
+        future = dispatcher.call(entry["user"], run)
+      else:
+        future = concurrent.futures.Future()
+        future.set_result(run())
+      position += len(line)
+      pending.append((future, position))
+      processed += 1
+      while pending and (
+        pending[0][0].done()
+     or len(pending) >= config.POLL_BATCH
+      ):
+        offset = checkpoint(pending, now)
+  while pending:
+    offset = checkpoint(pending, now)
+  with LOCK:
+    if offset > 0 and offset == os.path.getsize(path):
+      os.truncate(path, 0)
+      storage.set_checkpoint(checkpoint_name(), "0", now)
+  stats.count("surge.processed", processed)
+  return processed
+
+def finish_entry(entry, respond):
+  """
+  Processes a logged message (see process_entry) and counts it as no longer
+  waiting.
+  """
+  process_entry(entry, respond)
+  with LOCK:
+    WAITING[entry["user"]] -= 1
+    if WAITING[entry["user"]] <= 0:
+      del WAITING[entry["user"]]
+
+def checkpoint(pending, now):
+  """
+  Waits for the first of the pending messages in drain to finish, then
+  checkpoints the offset after it and returns that offset.
+  """
+  future, offset = pending.popleft()
+  future.result()
+  storage.set_checkpoint(checkpoint_name(), str(offset), now)
+  return offset
+
+class Drainer:
+  """
+  Runs drain on a background thread whenever a message is logged, and at
+  least every config.SURGE_DRAIN_INTERVAL seconds, processing messages on
+  the given dispatcher's workers if there is one.
+  """
+  def __init__(self, dispatcher=None):
+    self.dispatcher = dispatcher
+    self.stop_event = threading.Event()
+    self.thread = None
+
+  def start(self):
+    load()
+    self.thread = threading.Thread(target=self.run, name="surge", daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      WAKE.wait(config.SURGE_DRAIN_INTERVAL)
+      WAKE.clear()
+      try:
+        drain(storage.now_ts(), dispatcher=self.dispatcher)
+      except Exception:
+        traceback.print_exc()
+        sys.stderr.flush()
+      if self.stop_event.is_set():
+        break
+    storage.close_db()
+
+  def stop(self, timeout=None):
+    """
+    Processes anything still in the log, then stops the thread. If that takes
+    more than timeout seconds, the thread is left to finish in the
+    background; whatever it doesn't get to is processed on the next start.
+    """
+    self.stop_event.set()
+    WAKE.set()
+    self.thread.join(timeout)
+    close()
@@ -7,11 +7,34 @@ instead of actually using email input/output. Tests are run sequentially.
 
 import sys
 import os
+import smtplib
+import threading
+import socket
+import signal
+import asyncio
+import time
+import datetime
+import tempfile
+import mailbox
+import gzip
+import urllib.request
 
 import academibot
 import config
 import channel
 import storage
+import ratelimit
+import mail
+import loopback
+import maildir
+import grader
+import tracelog
+import metrics
+import stats
+import admission
+import surge
+import commands
+import formats
 
 TEST_INSTRUCTOR = "instructor@test.test"
 TEST_STUDENTS = [
@@ -464,6 +487,29 @@ Submissions summary ({stcount} students):
       ],
     )
   ),
+  (
+    TEST_STUDENTS[2],
+    """
+    {uauth}
+    :submit-batch {tag}
+      map{{
+        quiz-1 : map{{
+          1 : maybe
+          text{{ Problem 2 }} : B
+        }}
+        quiz-9 : map{{
+          1 : same
+        }}
+      }}
+    """,
+    check_and_chain(
+      [
+        "Submitted 0/2 assignments in course {tag} for user {uname}.",
+        "*** quiz-1 -- Problem '1' has no answer 'maybe'.",
+        "*** quiz-9 -- no assignment 'quiz-9' in course {tag}",
+      ],
+    )
+  ),
 ]
 
 post_enrolled_tests = [
@@ -681,6 +727,17 @@ post_reg_tests = [
 ]
 
 tests = [
+  (
+    TEST_INSTRUCTOR,
+    """
+    :stats
+    """,
+    check_and_chain(
+      [
+        "Error: you need user authorization to view statistics."
+      ]
+    )
+  ),
   (
     TEST_INSTRUCTOR,
     """
@@ -694,6 +751,19 @@ tests = [
       ]
     )
   ),
+  (
+    TEST_STUDENTS[1],
+    """
+    :help submti
+    """,
+    check_and_chain(
+      [
+        "Unknown topic 'submti'.",
+        "Did you mean:\n\n:help submit\n",
+        "To interact with academibot"
+      ]
+    )
+  ),
   (
     TEST_STUDENTS[0],
     """
@@ -724,11 +794,1781 @@ tests = [
   ),
 ]
 
+# Component tests are plain functions run before the main test sequence:
+
+def fail(msg, got=None):
+  print("Error: " + msg)
+  if got != None:
+    print("Recieved:\n{}\n".format(got))
+  exit(1)
+
+COMPONENT_ASSIGNMENT = """
+map{{
+  name : {name}
+  type : quiz
+  value : 1.0
+  publish : {publish}
+  due : {late}
+  late-after : {late}
+  reject-after : {reject}
+  problems : list{{
+    map{{
+      name : 1
+      type : multiple-choice
+      prompt : text{{ Pick one. }}
+      answers : map{{
+        a : text{{ A }}
+        b : text{{ B }}
+      }}
+      solution : a
+    }}
+  }}
+}}
+"""
+
+def local_date(timestamp):
+  """
+  Formats a timestamp as a date string in local time, which is how
+  assignment dates are read (see storage.create_assignment).
+  """
+  return formats.date_string(datetime.datetime.fromtimestamp(timestamp))
+
+def component_course(name, student, late_after, assignments=("hw",)):
+  """
+  Creates a course with the given name containing one-problem assignments
+  with the given names whose late deadline is late_after (a timestamp), and
+  registers and enrolls the given student. Returns the course's tag and the
+  student's :auth line.
+  """
+  instructor = "instructor-" + student
+  storage.add_user(instructor)
+  storage.create_course(instructor, "test", name, "fall", 2016)
+  tag = "test/{}/fall/2016".format(name)
+  course_id = storage.get_course_id(instructor, tag)
+  for assignment in assignments:
+    success, msg = storage.create_assignment(
+      course_id,
+      formats.parse_text(
+        COMPONENT_ASSIGNMENT.format(
+          name=assignment,
+          publish=local_date(late_after - 86400),
+          late=local_date(late_after),
+          reject=local_date(late_after + 86400)
+        )
+      )[0]
+    )
+    if not success:
+      fail("Couldn't create a test assignment.", msg)
+  token = storage.add_user(student)
+  storage.expect_student(course_id, student)
+  storage.enroll_student(course_id, student)
+  return tag, ":auth {} {}".format(student, token)
+
+def test_submit_batch():
+  now = storage.now_ts()
+  student = "batch@test.test"
+  tag, auth = component_course("batch", student, now + 3600, ("hw", "hw2"))
+  replies = []
+  academibot.process(
+    student,
+    """
+    {}
+    :submit-batch {}
+      map{{
+        hw : map{{ 1 : a }}
+        hw2 : map{{ 1 : z }}
+        hw3 : map{{ 1 : a }}
+      }}
+    """.format(auth, tag),
+    replies.append,
+    now
+  )
+  if len(replies) != 1:
+    fail("Batch submission didn't get one reply.", replies)
+  for expected in (
+    "Submitted 1/3 assignments in course {}".format(tag),
+    " +  hw  -- submission added",
+    "*** hw2 -- Problem '1' has no answer 'z'.",
+    "*** hw3 -- no assignment 'hw3' in course {}".format(tag),
+  ):
+    if expected not in replies[0]:
+      fail("Batch submission reply is missing '{}'.".format(expected), replies)
+  course_id = storage.get_course_id(student, tag)
+  aid = storage.get_assignment_id(course_id, "hw")
+  if len(storage.get_submissions_for(student, aid)) != 1:
+    fail("Batch submission wasn't recorded.")
+  content, msg = storage.get_assignment_content(aid)
+  content["problems"] = []
+  if not storage.get_assignment_content(aid)[0]["problems"]:
+    fail("Cached assignment content was modified by a caller.")
+
+def test_rate_limiter():
+  limiter = ratelimit.RateLimiter(
+    { "non-user": { "burst": 2, "per_hour": 3600 } }
+  )
+  replies = []
+  msgs = [ ("flood@test.test", ":help", replies.append) ] * 4
+  admitted = limiter.filter(msgs, 1000)
+  if len(admitted) != 2:
+    fail("rate limiter admitted wrong number of messages.", len(admitted))
+  if len(replies) != 1 or "too many messages" not in replies[0]:
+    fail("rate limiter didn't send exactly one summary reply.", replies)
+  if len(limiter.filter(msgs[:1], 1001.5)) != 1:
+    fail("rate limiter bucket didn't refill.")
+  limiter.checkpoint(1001.5, force=True)
+  restored = ratelimit.RateLimiter(limiter.limits)
+  restored.load()
+  if restored.filter(msgs[:1], 1001.5):
+    fail("rate limiter state wasn't restored from checkpoint.")
+  limiter.checkpoint(5000, force=True)
+  closed = ratelimit.RateLimiter({ "non-user": { "burst": 0, "per_hour": 60 } })
+  replies = []
+  if closed.filter([ ("closed@test.test", ":help", replies.append) ] * 2, 1000):
+    fail("rate limiter admitted a message with a burst of 0.")
+  if len(replies) != 1:
+    fail("rate limiter didn't notify a sender with a burst of 0.", replies)
+
+class StandInIMAP:
+  """
+  An in-process stand-in for an imaplib connection with a selected INBOX,
+  which counts the round trips made to it.
+  """
+  def __init__(self, messages):
+    self.messages = { str(i+1).encode(): m for i, m in enumerate(messages) }
+    self.seen = set()
+    self.round_trips = 0
+    self.uidvalidity = b"1"
+
+  def select(self, mailbox):
+    self.round_trips += 1
+    return ("OK", [str(len(self.messages)).encode()])
+
+  def response(self, code):
+    if code == "UIDVALIDITY":
+      return (code, [self.uidvalidity])
+    return (code, [str(len(self.messages) + 1).encode()])
+
+  def close(self):
+    self.round_trips += 1
+    return ("OK", [b""])
+
+  def uid(self, command, *args):
+    self.round_trips += 1
+    if command == "search":
+      if args[1] == "UID":
+        self.searched_range = args[2]
+        start = int(args[2].split(":")[0])
+        return (
+          "OK",
+          [
+            b" ".join(u for u in self.messages if int(u) >= start)
+         or max(self.messages, key=int) # the highest UID is always included
+          ]
+        )
+      return (
+        "OK",
+        [ b" ".join(u for u in self.messages if u not in self.seen) ]
+      )
+    uids = args[0].split(b",")
+    if command == "store":
+      self.seen.update(uids)
+      return ("OK", [])
+    result = []
+    for n, u in enumerate(uids):
+      raw = self.messages[u]
+      if n % 2: # some servers report the UID after the body
+        result.append((b"%d (BODY[]<0> {%d}" % (n+1, len(raw)), raw))
+        result.append(b" UID " + u + b")")
+      else:
+        result.append((b"%d (UID %s BODY[]<0> {%d}" % (n+1, u, len(raw)), raw))
+        result.append(b")")
+    return ("OK", result)
+
+def test_batched_fetch():
+  raw = [
+    (
+      "From: Student {n} <s{n}@test.test>\r\n"
+      "Subject: test {n}\r\n"
+      "Message-Id: <{n}@test.test>\r\n"
+      "\r\n"
+      ":help {n}\r\n"
+    ).format(n=n).encode()
+    for n in range(120)
+  ]
+  con = mail.Connection("test", "bot@test.test", "bot", "bot", None, None)
+  con.imap_server = StandInIMAP(raw)
+  messages = con.check_mail()
+  if [m["from"] for m in messages] != [
+    "s{}@test.test".format(n) for n in range(120)
+  ]:
+    fail("batched fetch returned the wrong messages.", messages)
+  if messages[7]["body"].strip() != ":help 7":
+    fail("batched fetch returned the wrong body.", messages[7])
+  batches = (120 + config.IMAP_FETCH_BATCH - 1) // config.IMAP_FETCH_BATCH
+  if con.imap_server.round_trips != 2 + 2 * batches:
+    fail(
+      "batched fetch used too many round trips.",
+      con.imap_server.round_trips
+    )
+  if con.check_mail():
+    fail("fetched messages were fetched again.")
+  if con.imap_server.searched_range != "121:*":
+    fail("second check wasn't incremental.", con.imap_server.searched_range)
+  con.imap_server.seen = set() # someone marks everything as unread
+  if con.check_mail():
+    fail("incremental check depended on \\Seen flags.")
+  con.imap_server.messages[b"121"] = raw[0]
+  if [ m["uid"] for m in con.check_mail() ] != [b"121"]:
+    fail("incremental check didn't fetch a new message.")
+  con.imap_server.uidvalidity = b"2"
+  con.imap_selected = False
+  con.imap_server.seen = { b"121" }
+  if len(con.check_mail()) != 120 or con.position != (2, 121):
+    fail("UIDVALIDITY change didn't trigger a full resync.", con.position)
+
+class SessionIMAP(StandInIMAP):
+  """
+  A StandInIMAP that can go dead (failing NOOPs and SELECTs) and that
+  supports the raw exchange used by Connection.idle, over a socket pair
+  whose other end (self.peer) plays the server.
+  """
+  def __init__(self, messages):
+    StandInIMAP.__init__(self, messages)
+    self.alive = True
+    self.shut_down = False
+    self.capabilities = ("IMAP4REV1", "IDLE")
+    self.tagged_commands = {}
+    self.sock, self.peer = socket.socketpair()
+    self.file = self.sock.makefile('rb')
+    self.sent = []
+    # Sent in the same packet as the IDLE continuation
+    self.after_continuation = b""
+
+  def noop(self):
+    if not self.alive:
+      raise OSError("connection reset")
+    return ("OK", [b""])
+
+  def select(self, mailbox):
+    if not self.alive:
+      return ("NO", [b"session expired"])
+    return StandInIMAP.select(self, mailbox)
+
+  def shutdown(self):
+    self.shut_down = True
+    self.file.close()
+    self.sock.close()
+    self.peer.close()
+
+  def _new_tag(self):
+    tag = b"T1"
+    self.tagged_commands[tag] = None
+    return tag
+
+  def send(self, data):
+    self.sent.append(data)
+    if data.endswith(b" IDLE\r\n"):
+      self.peer.sendall(b"+ idling\r\n" + self.after_continuation)
+    elif data == b"DONE\r\n":
+      self.peer.sendall(b"T1 OK IDLE terminated\r\n")
+
+  def readline(self):
+    return self.file.readline()
+
+  def socket(self):
+    return self.sock
+
+def test_imap_session():
+  raw = loopback.compose("s@test.test", ":help")
+  ch = mail.AsyncEmailChannel("test", "bot@test.test", "bot", "bot", password="x")
+  ch.connect()
+  sessions = []
+  def connect_imap():
+    sessions.append(SessionIMAP([raw]))
+    ch.connection.imap_server = sessions[-1]
+    ch.connection.imap_selected = False
+    ch.connection.imap_last_used = time.monotonic()
+  ch.connection.connect_imap = connect_imap
+  try:
+    if len(ch.poll()) != 1 or len(sessions) != 1:
+      fail("IMAP session didn't fetch a message.", sessions)
+    sessions[0].alive = False
+    ch.connection.imap_selected = False # e.g. after a server-side timeout
+    try:
+      ch.receive()
+      fail("A bad SELECT status wasn't reported.")
+    except mail.ConnectionError:
+      pass
+    if ch.connection.imap_server != None or not sessions[0].shut_down:
+      fail("A broken IMAP session wasn't dropped.")
+    ch.receive()
+    if len(sessions) != 2:
+      fail("IMAP session wasn't reopened after being dropped.", sessions)
+    sessions[1].alive = False
+    ch.connection.imap_last_used -= config.IMAP_NOOP_INTERVAL + 1
+    ch.receive()
+    if len(sessions) != 3 or not sessions[1].shut_down:
+      fail("An idle IMAP session that failed its NOOP wasn't replaced.")
+
+    con = ch.connection
+    start = time.monotonic()
+    if con.idle(0.2):
+      fail("IDLE reported new mail that never arrived.")
+    if not 0.2 <= time.monotonic() - start < 2:
+      fail("IDLE didn't wait for its timeout.", time.monotonic() - start)
+    if sessions[2].sent[-1] != b"DONE\r\n" or sessions[2].tagged_commands:
+      fail("IDLE wasn't ended cleanly.", sessions[2].sent)
+    timer = threading.Timer(0.1, sessions[2].peer.sendall, (b"* 2 EXISTS\r\n",))
+    timer.start()
+    start = time.monotonic()
+    if not con.idle(5) or time.monotonic() - start > 2:
+      fail("IDLE didn't wake up for new mail.", time.monotonic() - start)
+    sessions[2].after_continuation = b"* 3 EXISTS\r\n"
+    start = time.monotonic()
+    if not con.idle(5) or time.monotonic() - start > 2:
+      fail(
+        "IDLE missed new mail reported along with its continuation.",
+        time.monotonic() - start
+      )
+    sessions[2].after_continuation = b""
+    stop = threading.Event()
+    threading.Timer(0.1, stop.set).start()
+    start = time.monotonic()
+    if con.idle(5, stop) or time.monotonic() - start > 2:
+      fail("IDLE didn't stop when asked to.", time.monotonic() - start)
+  finally:
+    for session in sessions:
+      if not session.shut_down:
+        session.shutdown()
+
+def test_body_extraction():
+  attachment = "A" * 76 + "\r\n"
+  raw = (
+    "From: Student <s@test.test>\r\n"
+    "Subject: submission\r\n"
+    "MIME-Version: 1.0\r\n"
+    "Content-Type: multipart/mixed; boundary=XX\r\n"
+    "\r\n"
+    "--XX\r\n"
+    "Content-Type: text/html\r\n"
+    "\r\n"
+    "<p>html</p>\r\n"
+    "--XX\r\n"
+    "Content-Type: text/plain; charset=iso-8859-1\r\n"
+    "Content-Transfer-Encoding: quoted-printable\r\n"
+    "\r\n"
+    ":help caf=E9\r\n"
+    "--XX\r\n"
+    "Content-Type: text/plain\r\n"
+    "\r\n"
+    "second part\r\n"
+    "--XX\r\n"
+    "Content-Type: application/pdf\r\n"
+    "Content-Transfer-Encoding: base64\r\n"
+    "\r\n"
+    + attachment * 1000 +
+    "--XX--\r\n"
+  ).encode("latin-1")
+  chunks = []
+  def source():
+    for i in range(0, len(raw), 64):
+      chunks.append(i)
+      yield raw[i:i + 64]
+  msg = mail.parse_message(source())
+  body = mail.get_body(msg)
+  if body.strip() != ":help caf\u00e9":
+    fail("Body wasn't decoded from the first text/plain part.", body)
+  if len(chunks) * 64 > raw.index(b"second part") + 64:
+    fail("Parsing didn't stop after the first text/plain part.", len(chunks))
+  if mail.parse_message(raw).get_payload()[0].get_payload():
+    fail("Non-text/plain payloads were kept.")
+  with tempfile.TemporaryDirectory() as tmp:
+    path = os.path.join(tmp, "message")
+    with open(path, 'wb') as fout:
+      fout.write(raw.replace(b":help", b":status", 1))
+    chunk = config.PARSE_CHUNK_BYTES
+    config.PARSE_CHUNK_BYTES = 1024
+    with open(path, 'rb') as fin:
+      parsed = mail.parse_message(maildir.read_chunks(fin))
+      read = fin.tell()
+    config.PARSE_CHUNK_BYTES = chunk
+    if read >= len(raw) // 2:
+      fail("The message file was read past its first text/plain part.", read)
+  if not mail.get_body(parsed).startswith(":status"):
+    fail("Body wasn't read from a file.", mail.get_body(parsed))
+  cap = config.MAX_BODY_CHARS
+  config.MAX_BODY_CHARS = 5
+  body = mail.get_body(msg)
+  config.MAX_BODY_CHARS = cap
+  if body != ":help":
+    fail("Body wasn't truncated.", body)
+
+class StandInSMTP:
+  """
+  An in-process stand-in for an smtplib connection which records sent mail
+  and can simulate the server dropping the connection.
+  """
+  def __init__(self, sent):
+    self.sent = sent
+    self.drop_next = False
+
+  def noop(self):
+    return (250, b"OK")
+
+  def sendmail(self, sender, to, msg):
+    if self.drop_next:
+      raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+    self.sent.append((to, msg))
+
+  def close(self):
+    pass
+
+def test_smtp_session():
+  sent = []
+  sessions = []
+  ch = mail.AsyncEmailChannel("test", "bot@test.test", "bot", "bot")
+  ch.connection = mail.Connection(
+    "test", "bot@test.test", "bot", "bot", None, None
+  )
+  def connect():
+    ch.connection.smtp_server = StandInSMTP(sent)
+    sessions.append(ch.connection.smtp_server)
+  ch.connection.connect_smtp = connect
+  def queue(n):
+    for i in range(n):
+      storage.queue_outbound(
+        ch.addr,
+        mail.new_key(),
+        { "to": ["s{}@test.test".format(i)], "subject": "Re: t", "body": "r" },
+        storage.now_ts()
+      )
+  queue(3)
+  ch.flush()
+  queue(2)
+  ch.flush()
+  if len(sent) != 5 or len(sessions) != 1:
+    fail("SMTP session wasn't reused across flushes.", (len(sent), sessions))
+  sessions[0].drop_next = True
+  queue(2)
+  ch.flush()
+  if len(sent) != 7 or len(sessions) != 2:
+    fail("SMTP session wasn't reopened after disconnecting.", len(sent))
+
+def test_outbox():
+  now = storage.now_ts()
+  reply = { "to": ["s@test.test"], "subject": "Re: test", "body": "reply" }
+  if not storage.queue_outbound("outbox-test", "k1", reply, now):
+    fail("Outbox didn't queue a reply.")
+  if storage.queue_outbound("outbox-test", "k1", reply, now):
+    fail("Outbox queued a duplicate reply.")
+  due = storage.due_outbound("outbox-test", now)
+  if len(due) != 1 or due[0].reply != reply:
+    fail("Outbox didn't return the queued reply.", due)
+  storage.outbound_failed([due[0].id], now, "test failure")
+  if storage.due_outbound("outbox-test", now):
+    fail("Outbox retried a failed reply without backing off.")
+  due = storage.due_outbound("outbox-test", now + config.OUTBOX_BACKOFF)
+  if len(due) != 1 or due[0].attempts != 1:
+    fail("Outbox didn't retry a failed reply after backing off.", due)
+  storage.outbound_sent([due[0].id], now)
+  if storage.due_outbound("outbox-test", now + config.OUTBOX_MAX_BACKOFF):
+    fail("Outbox returned a reply that was already sent.")
+  if storage.queue_outbound("outbox-test", "k1", reply, now):
+    fail("Outbox queued a reply that was already sent.")
+
+def test_coalesce():
+  def reply(to, subject, refs):
+    return { "to": [to], "subject": subject, "body": subject, "references": refs }
+  due = [
+    storage.OUT_F(1, "a", reply("s@test.test", "Re: one", "<1>"), 0),
+    storage.OUT_F(2, "b", reply("t@test.test", "Re: two", "<2>"), 0),
+    storage.OUT_F(3, "c", reply("S@test.test", "Re: three", "<1> <3>"), 0),
+  ]
+  batches = mail.coalesce(due)
+  if [ ids for ids, r, k in batches ] != [ [1, 3], [2] ]:
+    fail("Replies weren't grouped by recipient.", batches)
+  ids, combined, key = batches[0]
+  if combined["references"] != "<1> <3>":
+    fail("References weren't merged.", combined["references"])
+  if "Re: one" not in combined["body"] or "Re: three" not in combined["body"]:
+    fail("Combined reply is missing a section.", combined["body"])
+  if batches[1][1] != due[1].reply or batches[1][2] != "b":
+    fail("A lone reply was altered by coalescing.", batches[1])
+  if len(mail.coalesce(due, by_thread=True)) != 2:
+    fail("Replies in the same thread weren't grouped.")
+  due[2] = storage.OUT_F(3, "c", reply("s@test.test", "Re: three", "<3>"), 0)
+  if len(mail.coalesce(due, by_thread=True)) != 3:
+    fail("Replies in different threads were grouped.")
+
+def test_loopback():
+  with loopback.LoopbackServer() as server:
+    for n in range(3):
+      server.deliver(loopback.compose("s{}@test.test".format(n % 2), ":help"))
+    ch = mail.AsyncioEmailChannel(
+      "test", "bot@loopback.test", "bot", "bot", password="test"
+    )
+    async def scenario():
+      await ch.setup()
+      messages = await channel.collect(ch.poll())
+      if sorted(m[0] for m in messages) != [
+        "s0@test.test", "s0@test.test", "s1@test.test"
+      ]:
+        fail("Loopback poll returned the wrong messages.", messages)
+      for sender, body, rf in messages:
+        rf("reply")
+      await ch.flush()
+      if sorted(r for s, rs, raw in server.sent for r in rs) != [
+        "s0@test.test", "s1@test.test"
+      ]:
+        fail("Loopback flush sent the wrong replies.", server.sent)
+      if server.unseen() or await channel.collect(ch.poll()):
+        fail("Loopback messages weren't marked as seen.")
+      deliver = threading.Timer(
+        0.1,
+        server.deliver,
+        [loopback.compose("s2@test.test", ":help")]
+      )
+      deliver.start()
+      start = time.monotonic()
+      if not await ch.wait(5) or time.monotonic() - start > 4:
+        fail("Loopback IDLE didn't report new mail.")
+      await ch.send({ "to": ["s2@test.test"], "subject": "t", "body": "b" })
+      if len(server.sent) != 3:
+        fail("Loopback send didn't send.", server.sent)
+      await ch.close()
+    asyncio.run(scenario())
+
+def test_async_channel_send():
+  class NoSend(channel.AsyncChannel):
+    pass
+  try:
+    NoSend()
+    fail("An asyncio channel without send could be created.")
+  except TypeError:
+    pass
+
+class StandInChannel(channel.Channel):
+  """
+  A channel whose polls can be held up until released, and whose flushes
+  use storage (from whichever thread they run on).
+  """
+  def __init__(self, name, hold=False):
+    self.name = name
+    self.release = threading.Event()
+    if not hold:
+      self.release.set()
+    self.polls = 0
+    self.flushed = []
+    self.checkpoints = 0
+
+  def poll(self):
+    self.polls += 1
+    self.release.wait()
+    return [ (self.name, ":help", None) ]
+
+  def flush(self):
+    storage.set_checkpoint("pool-test", self.name, storage.now_ts())
+    self.flushed.append(storage.get_checkpoint("pool-test"))
+
+  def checkpoint(self):
+    self.checkpoints += 1
+
+  def __str__(self):
+    return "channel " + self.name
+
+def test_channel_pool():
+  fast = StandInChannel("fast")
+  slow = StandInChannel("slow", hold=True)
+  pool = academibot.ChannelPool([slow, fast], workers=2, timeout=0.2)
+  config.LOGFILE = "academibot-test.log"
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    first = pool.poll()
+    pool.checkpoint()
+    if slow.checkpoints != 0 or fast.checkpoints != 1:
+      fail("A channel was checkpointed while its poll was running.")
+    second = pool.poll()
+    slow.release.set()
+    time.sleep(0.1)
+    third = pool.poll()
+    pool.flush()
+    pool.checkpoint()
+    if slow.checkpoints != 1:
+      fail("A channel wasn't checkpointed once its poll finished.")
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    pool.shutdown()
+  if [m[0] for m in first] != ["fast"] or [m[0] for m in second] != ["fast"]:
+    fail("A slow channel held up another channel.", (first, second))
+  if sorted(m[0] for m in third) != ["fast", "slow"] or slow.polls != 1:
+    fail("A slow channel's poll wasn't collected later.", (third, slow.polls))
+  if fast.flushed != ["fast"] or slow.flushed != ["slow"]:
+    fail("Channel flushes couldn't use storage.", (fast.flushed, slow.flushed))
+
+def test_mailbox_channel():
+  with tempfile.TemporaryDirectory() as tmp:
+    source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+    for n in range(3):
+      source.add(loopback.compose("s{}@test.test".format(n), ":help"))
+    ch = maildir.MailboxChannel("test", source._path, os.path.join(tmp, "out"))
+    ch.setup()
+    messages = ch.poll()
+    if sorted(m[0] for m in messages) != [
+      "s0@test.test", "s1@test.test", "s2@test.test"
+    ]:
+      fail("Maildir channel returned the wrong messages.", messages)
+    for sender, body, rf in messages:
+      rf("reply")
+    ch.flush()
+    if len(mailbox.Maildir(ch.output)) != 3:
+      fail("Maildir channel didn't write its replies.")
+    if len(os.listdir(os.path.join(source._path, "new"))) != 3:
+      fail("Maildir channel marked messages as processed before a checkpoint.")
+    if ch.poll():
+      fail("Maildir channel returned messages again before a checkpoint.")
+    ch.checkpoint()
+    if os.listdir(os.path.join(source._path, "new")) or ch.poll():
+      fail("Maildir channel didn't mark messages as processed.")
+    if ch.wait(0.01):
+      fail("Maildir channel reported a change that didn't happen.")
+    source.add(loopback.compose("s3@test.test", ":help"))
+    if not ch.wait(1) or [m[0] for m in ch.poll()] != ["s3@test.test"]:
+      fail("Maildir channel didn't notice a new message.")
+
+    path = os.path.join(tmp, "in.mbox")
+    with open(path, 'wb') as fout:
+      for n in range(2):
+        fout.write(b"From s@test.test Mon Jan  1 00:00:00 2024\n")
+        raw = loopback.compose("s@test.test", ":help\n>From here")
+        fout.write(raw.replace(b"\r\n", b"\n"))
+        fout.write(b"\n")
+    ch = maildir.MailboxChannel("test", path, os.path.join(tmp, "out"))
+    ch.setup()
+    messages = ch.poll()
+    if len(messages) != 2 or messages[1][1].split() != [
+      ":help", "From", "here"
+    ]:
+      fail("mbox channel returned the wrong messages.", messages)
+    ch.flush()
+    ch.checkpoint()
+    with open(path, 'ab') as fout:
+      fout.write(b"From s@test.test Mon Jan  1 00:00:00 2024\n")
+      raw = loopback.compose("t@test.test", ":help")
+      fout.write(raw.replace(b"\r\n", b"\n"))
+    ch = maildir.MailboxChannel("test", path, os.path.join(tmp, "out"))
+    ch.setup()
+    if [m[0] for m in ch.poll()] != ["t@test.test"]:
+      fail("mbox channel didn't resume from its checkpoint.")
+
+def test_mailbox_replay():
+  with tempfile.TemporaryDirectory() as tmp:
+    source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+    source.add(loopback.compose("replay@test.test", ":help"))
+    now = storage.now_ts()
+    counts = []
+    for replay in (False, False, True):
+      # put the message back, as if it hadn't been processed
+      for filename in os.listdir(os.path.join(source._path, "cur")):
+        os.rename(
+          os.path.join(source._path, "cur", filename),
+          os.path.join(source._path, "new", filename.split(":")[0])
+        )
+      ch = maildir.MailboxChannel(
+        "test",
+        source._path,
+        os.path.join(tmp, "out"),
+        replay=replay
+      )
+      ch.setup()
+      for sender, body, rf in ch.poll():
+        academibot.process(sender, body, rf, now)
+      ch.flush()
+      ch.checkpoint()
+      counts.append(len(mailbox.Maildir(ch.output)))
+    if counts != [1, 1, 2]:
+      fail("Replaying a processed message didn't process it again.", counts)
+
+def test_mailbox_bulk():
+  batch = config.POLL_BATCH
+  limit = config.MAILBOX_MAX_MESSAGE_BYTES
+  config.POLL_BATCH = 2
+  config.MAILBOX_MAX_MESSAGE_BYTES = 4096
+  try:
+    with tempfile.TemporaryDirectory() as tmp:
+      source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+      for n in range(3):
+        key = source.add(loopback.compose("c{}@test.test".format(n), ":help"))
+        message = source[key]
+        message.set_subdir("cur")
+        source[key] = message
+      source.add(loopback.compose("n@test.test", ":help " + "x" * 10000))
+      ch = maildir.MailboxChannel(
+        "test",
+        source._path,
+        os.path.join(tmp, "out"),
+        replay=True
+      )
+      ch.setup()
+      senders = []
+      bodies = []
+      for n in range(4):
+        for sender, body, rf in ch.poll():
+          senders.append(sender)
+          bodies.append(body)
+        ch.checkpoint()
+      if sorted(senders) != [
+        "c0@test.test", "c1@test.test", "c2@test.test", "n@test.test"
+      ]:
+        fail("Replaying a Maildir didn't read each message once.", senders)
+      if max(len(b) for b in bodies) > 4096:
+        fail("A Maildir message wasn't cut off at the size limit.")
+
+      path = os.path.join(tmp, "in.mbox")
+      with open(path, 'wb') as fout:
+        for n in range(5):
+          fout.write(b"From s@test.test Mon Jan  1 00:00:00 2024\n")
+          raw = loopback.compose(
+            "m{}@test.test".format(n),
+            ":help\n>From here\n" + "y\n" * (3000 if n == 2 else 1)
+          )
+          fout.write(raw.replace(b"\r\n", b"\n"))
+          fout.write(b"\n")
+      ch = maildir.MailboxChannel("test", path, os.path.join(tmp, "out"))
+      ch.setup()
+      sizes = []
+      senders = []
+      for n in range(4):
+        messages = ch.poll()
+        sizes.append(len(messages))
+        senders.extend(m[0] for m in messages)
+        if any(len(m[1]) > 4096 for m in messages):
+          fail("An mbox message wasn't cut off at the size limit.")
+        ch.checkpoint()
+      if sizes != [2, 2, 1, 0] or senders != [
+        "m{}@test.test".format(n) for n in range(5)
+      ]:
+        fail("mbox channel didn't read in batches.", (sizes, senders))
+      replay = maildir.MailboxChannel(
+        "test",
+        path,
+        os.path.join(tmp, "out"),
+        replay=True
+      )
+      replay.setup()
+      if [m[0] for m in replay.poll()] != ["m0@test.test", "m1@test.test"]:
+        fail("Replaying an mbox file didn't start from the beginning.")
+  finally:
+    config.POLL_BATCH = batch
+    config.MAILBOX_MAX_MESSAGE_BYTES = limit
+
+def test_scheduler():
+  now = storage.now_ts()
+  if academibot.next_wakeup(now, 5) != 5:
+    fail("Scheduler woke up early with nothing scheduled.")
+  storage.create_token("scheduler@test.test", "test", now, duration=2)
+  wakeup = academibot.next_wakeup(now, 5)
+  if not 1.9 < wakeup <= 2:
+    fail("Scheduler didn't wake up for a token expiry.", wakeup)
+  batch = config.POLL_BATCH
+  config.POLL_BATCH = 2
+  with tempfile.TemporaryDirectory() as tmp:
+    source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+    for n in range(5):
+      source.add(loopback.compose("s{}@test.test".format(n), ":help"))
+    ch = maildir.MailboxChannel("test", source._path, os.path.join(tmp, "out"))
+    ch.setup()
+    pool = academibot.ChannelPool([ch], workers=1)
+    sizes = []
+    try:
+      while True:
+        sizes.append(len(pool.poll()))
+        pool.flush()
+        pool.checkpoint()
+        if not pool.saturated:
+          break
+    finally:
+      config.POLL_BATCH = batch
+      pool.shutdown()
+  if sizes != [2, 2, 1]:
+    fail("Polls weren't capped or didn't continue while saturated.", sizes)
+
+def test_dispatcher():
+  dispatcher = academibot.Dispatcher(workers=2)
+  slow = "slow@test.test"
+  fast = [
+    "fast{}@test.test".format(n) for n in range(10)
+      if dispatcher.worker_for("fast{}@test.test".format(n))
+      != dispatcher.worker_for(slow)
+  ][0]
+  replies = []
+  def rf_for(sender, n, delay):
+    def rf(response):
+      time.sleep(delay)
+      replies.append((sender, n))
+    return rf
+  messages = []
+  for n in range(3):
+    messages.append((slow, ":help", rf_for(slow, n, 0.1)))
+    messages.append((fast, ":help", rf_for(fast, n, 0)))
+  dispatcher.submit(messages, storage.now_ts())
+  finished = dispatcher.wait(5)
+  dispatcher.shutdown()
+  if not finished or len(replies) != 6:
+    fail("Dispatcher didn't process every message.", replies)
+  if [n for s, n in replies if s == slow] != [0, 1, 2]:
+    fail("Dispatcher reordered a sender's messages.", replies)
+  if replies.index((fast, 2)) > replies.index((slow, 0)):
+    fail("A slow sender held up another sender.", replies)
+
+def test_grading_queue():
+  now = storage.now_ts()
+  if not storage.queue_grading(90001, now) or not storage.queue_grading(90002, now + 1):
+    fail("Grading queue didn't queue submissions.")
+  if storage.queue_grading(90001, now):
+    fail("Grading queue queued a duplicate submission.")
+  claimed = storage.claim_grading("test-worker", now + 2, 10)
+  if claimed != [90001, 90002]:
+    fail("Grading queue didn't claim queued submissions in order.", claimed)
+  if storage.claim_grading("other-worker", now + 2, 10):
+    fail("Grading queue handed out a claimed submission.")
+  stale = now + 3 + config.GRADING_CLAIM_TIMEOUT
+  claimed = storage.claim_grading("other-worker", stale, 1)
+  if claimed != [90001]:
+    fail("Grading queue didn't reclaim a stale claim.", claimed)
+  storage.grading_done(90001, True)
+  storage.grading_done(90002, False, "test failure")
+  queued, oldest, failed = storage.grading_status(stale)
+  if (queued, failed) != (1, 0):
+    fail("Grading queue didn't requeue a failed submission.", (queued, failed))
+  # The grading worker gives up on the unknown submission after a few tries.
+  worker = grader.GraderProcess("academibot-test.db")
+  worker.start()
+  try:
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+      status = storage.worker_status(grader.WORKER_NAME)
+      if status and storage.grading_status(storage.now_ts())[2] == 1:
+        break
+      time.sleep(0.1)
+  finally:
+    worker.stop()
+  if not status or status["failed"] < 1:
+    fail("Grading worker didn't report its progress.", status)
+  timings = storage.worker_timings().get(grader.WORKER_NAME, {})
+  if "storage.maintain_grade_info" not in timings:
+    fail("Grading worker didn't publish its timings.", sorted(timings))
+  queued, oldest, failed = storage.grading_status(storage.now_ts())
+  if (queued, failed) != (0, 1):
+    fail("Grading worker didn't give up on a bad submission.", (queued, failed))
+  if worker.process.is_alive():
+    fail("Grading worker didn't stop.")
+
+def test_grade_scan():
+  now = storage.now_ts()
+  submit = "{}\n:submit {} hw map{{ 1 : a }}"
+  students = {
+    "grade-scan-future": ("scan-future@test.test", now + 3600, now),
+    "grade-scan-due": ("scan-due@test.test", now - 60, now - 120),
+    "grade-scan-late": ("scan-late@test.test", now - 60, now),
+  }
+  window = config.SURGE_WINDOW
+  config.SURGE_WINDOW = None
+  try:
+    for name, (student, late_after, submitted) in students.items():
+      tag, auth = component_course(name, student, late_after)
+      academibot.process(
+        student,
+        submit.format(auth, tag),
+        lambda r: None,
+        submitted
+      )
+  finally:
+    config.SURGE_WINDOW = window
+  queued_before = set(storage._db().execute(
+    "SELECT submission_id FROM grading_queue;"
+  ).fetchall())
+  parsed = []
+  parse_text = formats.parse_text
+  def counting_parse_text(*args, **kwargs):
+    parsed.append(args)
+    return parse_text(*args, **kwargs)
+  saved = config.GRADING_WORKER
+  config.GRADING_WORKER = True
+  formats.parse_text = counting_parse_text
+  try:
+    storage.maintain_grade_info(0, now)
+    storage.maintain_grade_info(0, now)
+  finally:
+    formats.parse_text = parse_text
+    config.GRADING_WORKER = saved
+  queued = [
+    row for row in storage._db().execute(
+      "SELECT submission_id FROM grading_queue;"
+    ).fetchall()
+      if row not in queued_before
+  ]
+  users = [
+    storage._db().execute(
+      "SELECT user FROM submissions WHERE id = ?;",
+      (sid,)
+    ).fetchone()[0]
+    for (sid,) in queued
+  ]
+  for (sid,) in queued:
+    storage.grading_done(sid, True)
+  if "scan-due@test.test" not in users or any(
+    u in users for u in ("scan-future@test.test", "scan-late@test.test")
+  ):
+    fail("The grading scan queued the wrong submissions.", users)
+  if parsed:
+    fail("The grading scan re-parsed assignments.", len(parsed))
+
+def test_trace_log():
+  names = [
+    "LOGFILE", "LOG_MAX_BYTES", "LOG_ROTATE_INTERVAL", "LOG_BACKUPS",
+    "LOG_COMPRESS", "LOG_BODY_CHARS"
+  ]
+  saved = { n: getattr(config, n) for n in names }
+  academibot.done_logging()
+  with tempfile.TemporaryDirectory() as tmp:
+    try:
+      config.LOGFILE = os.path.join(tmp, "trace.log")
+      config.LOG_MAX_BYTES = 1000
+      config.LOG_ROTATE_INTERVAL = None
+      config.LOG_BACKUPS = 2
+      config.LOG_COMPRESS = True
+      for n in range(90):
+        academibot.log("line {:03d} ".format(n) + "x" * 40)
+      academibot.done_logging()
+      logs = sorted(os.listdir(tmp))
+      if logs != ["trace.log", "trace.log.1.gz", "trace.log.2.gz"]:
+        fail("Trace log wasn't rotated as expected.", logs)
+      with gzip.open(config.LOGFILE + ".1.gz", 'rt') as fin:
+        rotated = fin.read()
+      with open(config.LOGFILE) as fin:
+        current = fin.read()
+      if "line 089" not in current or "line 079" not in rotated:
+        fail("Trace log lines are missing.", current)
+      config.LOG_BODY_CHARS = 10
+      if tracelog.truncate("y" * 25) != "y" * 10 + "\n...[15 more characters]...":
+        fail("Long log entries weren't truncated.", tracelog.truncate("y" * 25))
+      # A restart doesn't reset the age of the log.
+      config.LOG_MAX_BYTES = None
+      config.LOG_ROTATE_INTERVAL = 60 * 60
+      recently = time.time() - 60 * 30
+      os.utime(config.LOGFILE + ".1.gz", (recently, recently))
+      academibot.log("restarted")
+      academibot.done_logging()
+      with open(config.LOGFILE) as fin:
+        if "restarted" not in fin.read():
+          fail("Trace log was rotated too early after a restart.")
+      hours_ago = time.time() - 60 * 90
+      os.utime(config.LOGFILE + ".1.gz", (hours_ago, hours_ago))
+      academibot.log("restarted again")
+      academibot.done_logging()
+      with gzip.open(config.LOGFILE + ".1.gz", 'rt') as fin:
+        rotated = fin.read()
+      if "restarted again" not in rotated or os.path.getsize(config.LOGFILE):
+        fail("Trace log wasn't rotated by age after a restart.", rotated)
+    finally:
+      academibot.done_logging()
+      for n, v in saved.items():
+        setattr(config, n, v)
+
+def test_metrics():
+  stats.record("test.metric", 0.002)
+  stats.record("test.metric", 3)
+  storage.outbox_status(storage.now_ts())
+  buckets = [0] * (len(stats.BUCKETS) + 1)
+  buckets[1] = 2
+  storage.worker_heartbeat(
+    "test-worker",
+    0,
+    storage.now_ts(),
+    storage.now_ts(),
+    0,
+    0,
+    { "test.worker-metric": (2, 1, 0.006, 4, [0.003, 0.003], buckets) }
+  )
+  server = metrics.start(port=0)
+  try:
+    url = "http://127.0.0.1:{}/metrics".format(server.server_port)
+    with urllib.request.urlopen(url, timeout=10) as response:
+      text = response.read().decode()
+  finally:
+    metrics.stop(server)
+    storage._db().execute("DELETE FROM workers WHERE name = 'test-worker';")
+    storage._db().execute(
+      "DELETE FROM worker_timings WHERE name = 'test-worker';"
+    )
+    storage._db().commit()
+  expected = [
+    'academibot_latency_seconds_bucket{name="test.metric",le="0.001"} 0',
+    'academibot_latency_seconds_bucket{name="test.metric",le="0.005"} 1',
+    'academibot_latency_seconds_bucket{name="test.metric",le="+Inf"} 2',
+    'academibot_latency_seconds_count{name="test.metric"} 2',
+    'academibot_events_total{name="sqlite.statements"} ',
+    'academibot_outbox_queued ',
+    'academibot_grading_queued ',
+    'academibot_latency_seconds_bucket{name="test.worker-metric",worker="test-worker",le="0.005"} 2',
+    'academibot_latency_seconds_count{name="test.worker-metric",worker="test-worker"} 2',
+    'academibot_errors_total{name="test.worker-metric",worker="test-worker"} 1',
+  ]
+  for line in expected:
+    if line not in text:
+      fail("Metrics are missing '{}'.".format(line), text)
+
+def test_stats_threads():
+  def work():
+    stats.record("test.short-thread", 0.001)
+    stats.count("test.short-thread")
+  for n in range(50):
+    t = threading.Thread(target=work)
+    t.start()
+    t.join()
+  calls = stats.summary()["test.short-thread"][0]
+  if calls != 50 or stats.counts()["test.short-thread"] != 50:
+    fail(
+      "Statistics from finished threads were lost.",
+      (calls, stats.counts()["test.short-thread"])
+    )
+  if len(stats.REGISTRIES) > 10 or len(stats.COUNTS) > 10:
+    fail(
+      "Finished threads' statistics weren't retired.",
+      (len(stats.REGISTRIES), len(stats.COUNTS))
+    )
+
+def test_admission():
+  staff = "admission-staff@test.test"
+  storage.set_role(staff, "instructor")
+  queue = admission.AdmissionQueue(budget=3, aging=60)
+  now = storage.now_ts()
+  rf = lambda response: None
+  messages = [
+    ("s1@test.test", ":submit c a x", rf),
+    ("s2@test.test", ":help", rf),
+    ("s1@test.test", ":submit c b y", rf),
+    (staff, ":view-submissions s1@test.test c a", rf),
+    (staff, ":create-assignment c a x", rf),
+  ]
+  queue.add(messages, now)
+  if [ queue.classify(m[0], m[1]) for m in messages ] != [3, 2, 3, 1, 0]:
+    fail(
+      "Messages were classified wrongly.",
+      [ queue.classify(m[0], m[1]) for m in messages ]
+    )
+  taken = [ (m[0], m[1]) for m, received in queue.take(now) ]
+  expected = [
+    (staff, ":view-submissions s1@test.test c a"),
+    (staff, ":create-assignment c a x"),
+    ("s2@test.test", ":help"),
+  ]
+  if taken != expected:
+    fail("Messages weren't admitted by priority.", taken)
+  if queue.pending != 2:
+    fail("Admission queue miscounted waiting messages.", queue.pending)
+  queue.add([ (staff, ":expect c x", rf) ], now + 240)
+  taken = [ m[1] for m, received in queue.take(now + 240, budget=1) ]
+  if taken != [":submit c a x"]:
+    fail("Waiting messages didn't age ahead of new ones.", taken)
+  rest = queue.take(now + 240)
+  if [ received for m, received in rest ] != [now, now + 240]:
+    fail("Admission queue lost the time messages were received.", rest)
+
+def test_surge():
+  now = storage.now_ts()
+  if surge.applies("surge@test.test", ":submit c a x", now):
+    fail("Surge mode applied without an upcoming deadline.")
+  component_course("surge", "surge-student@test.test", now + 60)
+  if not surge.applies("surge-student@test.test", ":submit c a x", now):
+    fail("Surge mode didn't apply with an upcoming deadline.")
+  if surge.applies("surge-student@test.test", ":help", now):
+    fail("Surge mode applied to a message without submissions.")
+  if surge.applies("surge@test.test", ":submit c a x", now):
+    fail("Surge mode applied for a deadline in another course.")
+  saved = config.SUBMISSIONS_DIR
+  with tempfile.TemporaryDirectory() as tmp:
+    config.SUBMISSIONS_DIR = tmp
+    try:
+      replies = []
+      surge.defer("surge@test.test", ":submit c a x", now, replies.append)
+      if len(replies) != 1 or "receipt" not in replies[0]:
+        fail("Surge mode didn't send a receipt.", replies)
+      rf = lambda response: None
+      rf.route = {
+        "channel": "surge-test",
+        "message": {
+          "from": "surge@test.test",
+          "subject": "test",
+          "mid": "<surge@test.test>",
+          "references": "",
+        },
+      }
+      surge.append("surge@test.test", ":submit c b y", now, rf)
+      del surge.RESPONDERS[max(surge.RESPONDERS)] # as if after a restart
+      if surge.drain(now, limit=1) != 1 or len(replies) != 2:
+        fail("Logged submission wasn't processed.", replies)
+      if "you need user authorization to submit" not in replies[1]:
+        fail("Logged submission got an unexpected response.", replies[1])
+      if surge.drain(now) != 1:
+        fail("Second logged submission wasn't processed.")
+      due = storage.due_outbound("surge-test", storage.now_ts())
+      if len(due) != 1 or due[0].reply["to"] != ["surge@test.test"]:
+        fail("Reply to a logged submission wasn't routed.", due)
+      if os.path.getsize(surge.log_path()) != 0:
+        fail("Surge log wasn't emptied once processed.")
+      if surge.drain(now) != 0:
+        fail("Logged submissions were processed twice.")
+    finally:
+      surge.close()
+      config.SUBMISSIONS_DIR = saved
+
+def test_surge_order():
+  now = storage.now_ts()
+  student = "surge-order@test.test"
+  tag, auth = component_course("surge-order", student, now + 60)
+  replies = []
+  def rf(response):
+    replies.append((response, threading.current_thread()))
+  saved = config.SUBMISSIONS_DIR
+  dispatcher = academibot.Dispatcher(2)
+  with tempfile.TemporaryDirectory() as tmp:
+    config.SUBMISSIONS_DIR = tmp
+    try:
+      dispatcher.submit(
+        [
+          (student, "{}\n:submit {} hw map{{ 1 : a }}".format(auth, tag), rf),
+          (student, ":help", rf),
+        ],
+        now
+      )
+      dispatcher.wait()
+      if len(replies) != 1 or "receipt" not in replies[0][0]:
+        fail(
+          "A message was processed ahead of a logged submission.",
+          [ r for r, thread in replies ]
+        )
+      if surge.drain(now, dispatcher=dispatcher) != 2:
+        fail("Logged messages weren't processed.")
+      if (
+        len(replies) != 3
+     or "Added new submission" not in replies[1][0]
+     or "Academibot" not in replies[2][0]
+      ):
+        fail(
+          "Logged messages were answered out of order.",
+          [ r for r, thread in replies ]
+        )
+      if replies[1][1] not in dispatcher.workers:
+        fail("A logged submission wasn't processed on the sender's worker.")
+      if surge.waiting(student):
+        fail("A sender still had logged messages waiting after a drain.")
+    finally:
+      dispatcher.shutdown()
+      surge.close()
+      config.SUBMISSIONS_DIR = saved
+
+def test_surge_drain():
+  now = storage.now_ts()
+  dispatcher = academibot.Dispatcher(2)
+  slow = "surge-slow@test.test"
+  fast = [
+    "surge-fast{}@test.test".format(n) for n in range(8)
+      if dispatcher.worker_for("surge-fast{}@test.test".format(n))
+      != dispatcher.worker_for(slow)
+  ][0]
+  def cmd_test_sleep(context, *args):
+    time.sleep(0.6 if context["user"] == slow else 0.3)
+    return "slept"
+  commands.COMMANDS["test-sleep"] = {
+    "name": "test-sleep",
+    "run": cmd_test_sleep,
+    "priority": 5,
+    "argdesc": None,
+    "desc": "Takes a moment.",
+    "writes": False,
+  }
+  replies = []
+  def rf_for(sender):
+    rf = lambda response: replies.append((sender, response))
+    rf.message_id = "<{}>".format(sender)
+    return rf
+  saved = config.SUBMISSIONS_DIR
+  with tempfile.TemporaryDirectory() as tmp:
+    config.SUBMISSIONS_DIR = tmp
+    try:
+      surge.append(slow, ":test-sleep", now, rf_for(slow), receipt=False)
+      # Logged by a message whose transaction was rolled back, then again
+      # when it was processed again.
+      try:
+        with storage.transaction():
+          surge.defer(fast, ":test-sleep", now, rf_for(fast), receipt=False)
+          raise ValueError("rolled back")
+      except ValueError:
+        pass
+      surge.defer(fast, ":test-sleep", now, rf_for(fast), receipt=False)
+      drained = []
+      thread = threading.Thread(
+        target=lambda: drained.append(surge.drain(now, dispatcher=dispatcher)),
+        daemon=True
+      )
+      start = time.monotonic()
+      thread.start()
+      while not replies and time.monotonic() - start < 2:
+        time.sleep(0.01)
+      if storage.get_checkpoint(surge.checkpoint_name()) not in (None, "0"):
+        fail("The surge checkpoint moved past a message still being processed.")
+      thread.join()
+      elapsed = time.monotonic() - start
+      if drained != [3] or elapsed > 1.1:
+        fail("Different senders' logged messages weren't processed in parallel.", (drained, elapsed))
+      if sorted(s for s, r in replies) != [fast, slow]:
+        fail("A message logged twice was processed twice.", replies)
+      if os.path.getsize(surge.log_path()) != 0 or surge.waiting(fast):
+        fail("The surge log wasn't emptied once processed.")
+    finally:
+      dispatcher.shutdown()
+      surge.close()
+      config.SUBMISSIONS_DIR = saved
+      del commands.COMMANDS["test-sleep"]
+
+def test_ledger():
+  replies = []
+  def rf_for(mid):
+    rf = lambda response: replies.append(response)
+    rf.message_id = mid
+    return rf
+  now = storage.now_ts()
+  academibot.process("ledger@test.test", ":help", rf_for("<ledger-1@test>"), now)
+  academibot.process("ledger@test.test", ":help", rf_for("<ledger-1@test>"), now)
+  if len(replies) != 1:
+    fail("A message was processed twice.", len(replies))
+  academibot.process("ledger@test.test", ":help submit", rf_for("<ledger-1@test>"), now)
+  academibot.process("ledger@test.test", ":help", rf_for("?"), now)
+  academibot.process("ledger@test.test", ":help", rf_for("?"), now)
+  if len(replies) != 4:
+    fail("Distinct messages were skipped.", len(replies))
+  storage.clean_processed(now + config.LEDGER_RETENTION + 1)
+  academibot.process("ledger@test.test", ":help", rf_for("<ledger-1@test>"), now)
+  if len(replies) != 5:
+    fail("Processed messages weren't forgotten after retention.", len(replies))
+
+def test_schema_version():
+  version = storage._db().execute("PRAGMA user_version;").fetchone()[0]
+  if version != storage.SCHEMA_VERSION:
+    fail("The schema version wasn't recorded.", version)
+  statements = []
+  storage._db().set_trace_callback(statements.append)
+  try:
+    storage.init_db()
+  finally:
+    storage._db().set_trace_callback(storage._count_statement)
+  if any(s.startswith("CREATE") for s in statements):
+    fail("The schema was re-created for an up-to-date database.", statements)
+  storage._db().execute("PRAGMA user_version = 0;")
+  storage.init_db()
+  version = storage._db().execute("PRAGMA user_version;").fetchone()[0]
+  if version != storage.SCHEMA_VERSION:
+    fail("The schema version wasn't restored.", version)
+
+class ShutdownChannel(channel.Channel):
+  """
+  A channel that delivers one batch of messages, signalling the server to
+  shut down as it does so, and records how many replies each flush saw.
+  """
+  def __init__(self, count):
+    self.count = count
+    self.polls = 0
+    self.replies = []
+    self.flushed = []
+
+  def poll(self):
+    self.polls += 1
+    if self.polls > 1:
+      return []
+    os.kill(os.getpid(), signal.SIGTERM)
+    return [
+      ("shutdown{}@test.test".format(n), ":help", self.replies.append)
+        for n in range(self.count)
+    ]
+
+  def flush(self):
+    self.flushed.append(len(self.replies))
+
+  def __str__(self):
+    return "a shutdown test channel"
+
+def run_test_server(channels, **settings):
+  """
+  Runs the server on the test database with the given channels until it
+  shuts down, with the given config settings (plus ones that keep it
+  self-contained and quiet) in effect.
+  """
+  settings.setdefault("GRADING_WORKER", False)
+  settings.setdefault("STATS_FILE", None)
+  settings.setdefault("LOGFILE", "academibot-test.log")
+  saved = { name: getattr(config, name) for name in settings }
+  for name, value in settings.items():
+    setattr(config, name, value)
+  stdout = sys.stdout
+  sys.stdout = open(os.devnull, 'w')
+  try:
+    academibot.run_server(channels, "academibot-test.db", 0.01)
+  finally:
+    sys.stdout.close()
+    sys.stdout = stdout
+    for name, value in saved.items():
+      setattr(config, name, value)
+
+def test_shutdown():
+  ch = ShutdownChannel(3)
+  handler = signal.getsignal(signal.SIGTERM)
+  run_test_server([ch], ADMISSION_BUDGET=1)
+  if ch.polls > 2:
+    fail("Server kept checking for messages after a shutdown signal.", ch.polls)
+  if len(ch.replies) != 3:
+    fail("Server didn't finish admitted messages before exiting.", ch.replies)
+  if not ch.flushed or ch.flushed[-1] != 3:
+    fail("Server didn't flush replies before exiting.", ch.flushed)
+  if signal.getsignal(signal.SIGTERM) != handler:
+    fail("Server didn't restore the SIGTERM handler.")
+
+class CheckpointChannel(channel.Channel):
+  """
+  A channel that delivers one batch of messages whose replies take the given
+  time to send, records how many replies had arrived at each checkpoint,
+  and signals the server to shut down once every reply is in.
+  """
+  def __init__(self, messages, delay=0):
+    self.messages = messages
+    self.delay = delay
+    self.polls = 0
+    self.replies = []
+    self.checkpoints = []
+    self.signalled = False
+
+  def poll(self):
+    self.polls += 1
+    if self.polls == 1:
+      return [ (sender, body, self.reply) for sender, body in self.messages ]
+    if (
+      len(self.replies) == len(self.messages) or self.polls > 1000
+    ) and not self.signalled:
+      self.signalled = True
+      os.kill(os.getpid(), signal.SIGTERM)
+    return []
+
+  def reply(self, response):
+    time.sleep(self.delay)
+    self.replies.append(response)
+
+  def checkpoint(self):
+    self.checkpoints.append(len(self.replies))
+
+  def __str__(self):
+    return "a checkpoint test channel"
+
+def test_checkpoint_after_processing():
+  ch = CheckpointChannel([ ("slow@test.test", ":help") ], 0.3)
+  run_test_server([ch], DISPATCH_WAIT=0.05)
+  if ch.replies == [] or ch.checkpoints == []:
+    fail("Server didn't process and checkpoint a slow message.", ch.checkpoints)
+  if 0 in ch.checkpoints:
+    fail("A channel was checkpointed while its message was processing.")
+
+def test_checkpoint_after_admission():
+  ch = CheckpointChannel(
+    [ ("held{}@test.test".format(n), ":help") for n in range(3) ]
+  )
+  run_test_server([ch], ADMISSION_BUDGET=1)
+  if ch.replies == [] or ch.checkpoints == []:
+    fail("Server didn't process and checkpoint held messages.", ch.checkpoints)
+  if any(n < 3 for n in ch.checkpoints):
+    fail(
+      "A channel was checkpointed while messages were held for admission.",
+      ch.checkpoints
+    )
+
+def test_mailbox_replies_during_flush():
+  with tempfile.TemporaryDirectory() as tmp:
+    source = mailbox.Maildir(os.path.join(tmp, "in"), create=True)
+    source.add(loopback.compose("s@test.test", ":help"))
+    ch = maildir.MailboxChannel("test", source._path, os.path.join(tmp, "out"))
+    ch.setup()
+    [ (sender, body, rf) ] = ch.poll()
+    def reply():
+      for n in range(200):
+        rf("reply {}".format(n))
+    workers = [ threading.Thread(target=reply) for i in range(4) ]
+    for w in workers:
+      w.start()
+    while any(w.is_alive() for w in workers):
+      ch.flush()
+    ch.flush()
+    if len(mailbox.Maildir(ch.output)) != 800:
+      fail(
+        "Replies made during a Maildir flush were lost.",
+        len(mailbox.Maildir(ch.output))
+      )
+    class Racing(list):
+      """
+      A reply list that gets another reply (as if from a worker) just as a
+      flush finishes going through it.
+      """
+      def __iter__(self):
+        yield from list.__iter__(self)
+        rf("late reply")
+    rf("reply")
+    ch.replies = Racing(ch.replies)
+    ch.flush()
+    ch.flush()
+    if len(mailbox.Maildir(ch.output)) != 802:
+      fail(
+        "A reply made at the end of a Maildir flush was lost.",
+        len(mailbox.Maildir(ch.output))
+      )
+
+def test_async_handlers():
+  async def cmd_test_wait(context, *args):
+    await asyncio.sleep(float(args[0]))
+    return "waited " + args[1]
+  commands.COMMANDS["test-wait"] = {
+    "name": "test-wait",
+    "run": cmd_test_wait,
+    "writes": False,
+    "priority": 5,
+    "argdesc": "<seconds> <label>",
+    "desc": "Waits, then replies with the label.",
+  }
+  replies = []
+  def rf_for(sender):
+    return lambda response: replies.append(
+      (sender, response.split("waited ")[-1].strip())
+    )
+  try:
+    now = storage.now_ts()
+    academibot.process_all(
+      [
+        ("slow@test.test", ":test-wait 0.2 a1", rf_for("slow")),
+        ("slow@test.test", ":test-wait 0 a2", rf_for("slow")),
+        ("fast@test.test", ":test-wait 0 b1", rf_for("fast")),
+      ],
+      now
+    )
+    if sorted(replies) != [("fast", "b1"), ("slow", "a1"), ("slow", "a2")]:
+      fail("Coroutine handler replies didn't arrive.", replies)
+    if [label for sender, label in replies if sender == "slow"] != ["a1", "a2"]:
+      fail("A sender's messages were reordered.", replies)
+    if replies[0] != ("fast", "b1"):
+      fail("A waiting handler held up another sender.", replies)
+    async def inside_loop():
+      academibot.process("loop@test.test", ":test-wait 0 c1", rf_for("loop"), now)
+    asyncio.run(inside_loop())
+    if replies[-1] != ("loop", "c1"):
+      fail("Processing from inside an event loop failed.", replies)
+  finally:
+    del commands.COMMANDS["test-wait"]
+
+def test_help_suggestions():
+  for typo, expected in (
+    ("submti", ["submit"]), # substitution
+    ("sumbit", ["submit"]), # adjacent swap
+    ("Tme", ["time"]), # deletion, ignoring case
+    ("lixs", []), # two edits from "list", though their fuzzy keys overlap
+  ):
+    got = commands.suggest_topics(typo)
+    if got != expected:
+      fail("Wrong help suggestions for '{}'.".format(typo), got)
+  reply = commands.handle_commands(
+    "help@test.test",
+    ":help sumbit",
+    commands.parse(":help sumbit"),
+    storage.now_ts()
+  )
+  if "Did you mean:\n\n:help submit\n" not in reply:
+    fail("Help didn't suggest a close topic.", reply)
+
+def test_transactions():
+  now = storage.now_ts()
+  try:
+    with storage.transaction():
+      storage.set_checkpoint("tx-test", "rolled back", now)
+      raise RuntimeError("test")
+  except RuntimeError:
+    pass
+  if storage.get_checkpoint("tx-test") != None:
+    fail("A failed transaction wasn't rolled back.")
+  seen = []
+  def look():
+    seen.append(storage.get_checkpoint("tx-test"))
+    storage.close_db()
+  def cmd_test_write(context, *args):
+    storage.set_checkpoint("tx-test", args[0], context["now"])
+    other = threading.Thread(target=look) # uses its own connection
+    other.start()
+    other.join()
+    if args[0] == "fail":
+      raise RuntimeError("test")
+    return "wrote " + args[0]
+  commands.COMMANDS["test-write"] = {
+    "name": "test-write",
+    "run": cmd_test_write,
+    "priority": 5,
+    "argdesc": "<value>",
+    "desc": "Sets a checkpoint.",
+  }
+  def rf(response):
+    storage.queue_outbound(
+      "tx-test",
+      str(len(storage.due_outbound("tx-test", now))),
+      { "to": ["tx@test.test"], "subject": "test", "body": response },
+      now
+    )
+  try:
+    academibot.process("tx@test.test", ":test-write ok", rf, now)
+    if seen != [None]:
+      fail("A command's changes were committed before its reply.", seen)
+    if (
+      storage.get_checkpoint("tx-test") != "ok"
+   or len(storage.due_outbound("tx-test", now)) != 1
+    ):
+      fail("A command's changes and reply weren't committed.")
+    try:
+      academibot.process("tx@test.test", ":test-write fail", rf, now)
+      fail("A failing command didn't raise an error.")
+    except RuntimeError:
+      pass
+    if storage.get_checkpoint("tx-test") != "ok":
+      fail("A failed command's changes were committed.")
+  finally:
+    del commands.COMMANDS["test-write"]
+
+def test_interleaved_transactions():
+  async def cmd_test_block(context, *args):
+    await asyncio.sleep(float(args[0]))
+    storage.set_block(context["user"])
+    await asyncio.sleep(float(args[1]))
+    if args[2] == "fail":
+      raise RuntimeError("test")
+    return "blocked"
+  commands.COMMANDS["test-block"] = {
+    "name": "test-block",
+    "run": cmd_test_block,
+    "priority": 5,
+    "argdesc": "<seconds> <seconds> ok|fail",
+    "desc": "Waits, blocks the sender, waits, and maybe fails.",
+  }
+  replies = []
+  def rf_for(sender):
+    return lambda response: replies.append((sender, response))
+  def blocked(user):
+    return storage._db().execute(
+      "SELECT addr FROM blocking WHERE addr = ?;",
+      (user,)
+    ).fetchall() != []
+  try:
+    now = storage.now_ts()
+    # a failing message that has written waits while another one commits
+    academibot.process_all(
+      [
+        ("tx-a1@test.test", ":test-block 0 0.05 fail", rf_for("a1")),
+        ("tx-b1@test.test", ":test-block 0.01 0 ok", rf_for("b1")),
+      ],
+      now
+    )
+    if blocked("tx-a1@test.test"):
+      fail("A failed message's write was committed by another message.")
+    if not blocked("tx-b1@test.test"):
+      fail("A message's write was lost.", replies)
+    # a message that has written commits while another one is failing later
+    academibot.process_all(
+      [
+        ("tx-a2@test.test", ":test-block 0 0 ok", rf_for("a2")),
+        ("tx-b2@test.test", ":test-block 0.05 0 fail", rf_for("b2")),
+      ],
+      now
+    )
+    if not blocked("tx-a2@test.test"):
+      fail("A message's write was rolled back by another message's failure.")
+    errors = [ s for s, r in replies if "encountered an error" in r ]
+    if sorted(errors) != ["a1", "b2"]:
+      fail("Failing messages didn't get error replies.", replies)
+  finally:
+    del commands.COMMANDS["test-block"]
+    for user in ("tx-b1@test.test", "tx-a2@test.test"):
+      storage.remove_block(user)
+
+def test_nested_commands():
+  def cmd_test_outer(context, *args):
+    storage.set_checkpoint("nested-outer", "written", context["now"])
+    return commands.handle_commands(
+      context["user"],
+      ":test-inner",
+      commands.parse(":test-inner"),
+      context["now"]
+    )
+  def cmd_test_inner(context, *args):
+    storage.set_checkpoint("nested-inner", "written", context["now"])
+    return "inner done"
+  for name, function in (
+    ("test-outer", cmd_test_outer),
+    ("test-inner", cmd_test_inner),
+  ):
+    commands.COMMANDS[name] = {
+      "name": name,
+      "run": function,
+      "priority": 5,
+      "argdesc": None,
+      "desc": "Sets a checkpoint.",
+    }
+  saved = config.DB_BUSY_TIMEOUT
+  config.DB_BUSY_TIMEOUT = 0.5
+  replies = []
+  try:
+    academibot.process(
+      "nested@test.test",
+      ":test-outer",
+      replies.append,
+      storage.now_ts()
+    )
+    if len(replies) != 1 or "inner done" not in replies[0]:
+      fail("A command calling back into command handling failed.", replies)
+    if (
+      storage.get_checkpoint("nested-outer") != "written"
+   or storage.get_checkpoint("nested-inner") != "written"
+    ):
+      fail("A nested command's writes weren't committed.")
+  finally:
+    config.DB_BUSY_TIMEOUT = saved
+    del commands.COMMANDS["test-outer"]
+    del commands.COMMANDS["test-inner"]
+
+def test_slow_writer():
+  now = storage.now_ts()
+  dispatcher = academibot.Dispatcher(4)
+  slow = "slow-writer@test.test"
+  tag, auth = component_course("slow-writer", slow, now + 3600)
+  fast = [
+    "fast-writer{}@test.test".format(n) for n in range(12)
+      if dispatcher.worker_for("fast-writer{}@test.test".format(n))
+      != dispatcher.worker_for(slow)
+  ][:3]
+  submit = "{}\n:submit {} hw map{{ 1 : a }}"
+  messages = []
+  for student in fast:
+    messages.append((student, submit.format(*component_course(
+      "slow-writer-" + student.split("@")[0],
+      student,
+      now + 3600
+    )[::-1])))
+  academibot.process(slow, submit.format(auth, tag), lambda r: None, now)
+  [ submission ] = storage._db().execute(
+    "SELECT id FROM submissions WHERE user = ?;",
+    (slow,)
+  ).fetchall()
+  def cmd_test_slow(context, *args):
+    storage.request_grading(submission[0], context["now"])
+    time.sleep(1) # e.g. rendering every student's submissions
+    return "done"
+  commands.COMMANDS["test-slow"] = {
+    "name": "test-slow",
+    "run": cmd_test_slow,
+    "priority": 5,
+    "argdesc": None,
+    "desc": "Requests grading, then takes a second.",
+  }
+  saved = config.GRADING_WORKER
+  config.GRADING_WORKER = True
+  replies = []
+  def rf_for(sender):
+    return lambda response: replies.append(
+      (sender, time.monotonic() - start, response)
+    )
+  try:
+    start = time.monotonic()
+    dispatcher.submit([ (slow, ":test-slow", rf_for(slow)) ], now)
+    time.sleep(0.1)
+    dispatcher.submit(
+      [ (student, body, rf_for(student)) for student, body in messages ],
+      now
+    )
+    dispatcher.wait()
+    times = { sender: elapsed for sender, elapsed, response in replies }
+    if len(replies) != 4 or times[slow] < 1:
+      fail("The slow command didn't run as expected.", replies)
+    if any(times[student] > 0.6 for student in fast):
+      fail("Fast senders waited for a slow writer.", times)
+    if not all("Added new submission" in r for s, e, r in replies if s != slow):
+      fail("Fast senders' submissions weren't added.", replies)
+  finally:
+    config.GRADING_WORKER = saved
+    dispatcher.shutdown()
+    del commands.COMMANDS["test-slow"]
+    for (sid,) in storage._db().execute(
+      "SELECT submission_id FROM grading_queue WHERE submission_id IN"
+    + " (SELECT id FROM submissions WHERE user LIKE '%-writer%@test.test');"
+    ).fetchall():
+      storage.grading_done(sid, True)
+
+COMPONENT_TESTS = [
+  test_submit_batch,
+  test_rate_limiter,
+  test_batched_fetch,
+  test_imap_session,
+  test_body_extraction,
+  test_smtp_session,
+  test_outbox,
+  test_coalesce,
+  test_loopback,
+  test_async_channel_send,
+  test_channel_pool,
+  test_mailbox_channel,
+  test_mailbox_replay,
+  test_mailbox_bulk,
+  test_scheduler,
+  test_dispatcher,
+  test_grading_queue,
+  test_grade_scan,
+  test_trace_log,
+  test_metrics,
+  test_stats_threads,
+  test_admission,
+  test_surge,
+  test_surge_order,
+  test_surge_drain,
+  test_help_suggestions,
+  test_async_handlers,
+  test_ledger,
+  test_transactions,
+  test_interleaved_transactions,
+  test_nested_commands,
+  test_slow_writer,
+  test_schema_version,
+  test_shutdown,
+  test_checkpoint_after_processing,
+  test_checkpoint_after_admission,
+  test_mailbox_replies_during_flush,
+]
+
 if __name__ == "__main__":
-  if os.path.exists("academibot-test.db"):
-    os.remove("academibot-test.db")
+  for suffix in ("", "-wal", "-shm"):
+    if os.path.exists("academibot-test.db" + suffix):
+      os.remove("academibot-test.db" + suffix)
+  storage.setup("academibot-test.db")
+  for test in COMPONENT_TESTS:
+    test()
   tc = TestChannel(tests)
+  # The scenario expects to see grades as soon as they're due, and expects
+  # each batch of messages to be handled in order, even across senders (so
+  # every message gets the same admission priority).
+  config.GRADING_WORKER = False
+  config.WORKERS = 1
+  config.ADMISSION_STAFF_ROLES = ()
+  config.ADMISSION_BULK_COMMANDS = ()
   config.LOGFILE = "academibot-test.log"
+  config.STATS_FILE = "academibot-test-stats.txt"
   academibot.run_server(
     [tc],
     "academibot-test.db",
@@ -0,0 +1,161 @@
+"""
+tracelog.py
+The trace log (config.LOGFILE). Lines are queued and written by a background
+thread, so logging never waits on the disk, and the log is rotated by size
+and age, optionally compressing old logs.
+"""
+
+import os
+import sys
+import time
+import gzip
+import shutil
+import queue
+import threading
+
+import config
+
+QUEUE = queue.Queue()
+WRITER = None
+WRITER_LOCK = threading.Lock()
+
+# Number of lines dropped because the queue was full
+DROPPED = 0
+
+def truncate(text, limit=None):
+  """
+  Shortens text to at most limit characters (config.LOG_BODY_CHARS by
+  default; None means no limit), noting how much was cut.
+  """
+  if limit == None:
+    limit = config.LOG_BODY_CHARS
+  if limit == None or len(text) <= limit:
+    return text
+  return text[:limit] + "\n...[{} more characters]...".format(
+    len(text) - limit
+  )
+
+def write(text):
+  """
+  Queues text to be written to the log, starting the writer thread if
+  necessary. If config.LOG_QUEUE_SIZE lines are already waiting, the text is
+  dropped instead.
+  """
+  global WRITER, DROPPED
+  if WRITER == None:
+    with WRITER_LOCK:
+      if WRITER == None:
+        WRITER = threading.Thread(
+          target=run_writer,
+          args=(config.LOGFILE,),
+          name="tracelog",
+          daemon=True
+        )
+        WRITER.start()
+  if config.LOG_QUEUE_SIZE and QUEUE.qsize() >= config.LOG_QUEUE_SIZE:
+    DROPPED += 1
+    return
+  QUEUE.put(text)
+
+def close():
+  """
+  Writes out any queued lines, then stops the writer thread and closes the
+  log. Logging again afterwards starts a new writer.
+  """
+  global WRITER
+  with WRITER_LOCK:
+    if WRITER == None:
+      return
+    QUEUE.put(None)
+    WRITER.join()
+    WRITER = None
+
+def run_writer(filename):
+  """
+  Writes queued text to the given file until None is queued. Everything
+  waiting in the queue is written before each flush, so a burst of lines
+  costs one flush rather than one per line. The size of the log is counted
+  as lines are written rather than asked of the file, and its age is checked
+  once per batch.
+  """
+  global DROPPED
+  log = open(filename, 'a')
+  size = os.path.getsize(filename)
+  started = log_started(filename)
+  stopping = False
+  while not stopping:
+    lines = [ QUEUE.get() ]
+    while True:
+      try:
+        lines.append(QUEUE.get_nowait())
+      except queue.Empty:
+        break
+    if None in lines:
+      lines = lines[:lines.index(None)]
+      stopping = True
+    if DROPPED:
+      lines.append("...dropped {} log lines (queue full)...\n".format(DROPPED))
+      DROPPED = 0
+    try:
+      for line in lines:
+        log.write(line)
+        size += len(line.encode(log.encoding))
+        if config.LOG_MAX_BYTES and size >= config.LOG_MAX_BYTES:
+          log = reopen(log, filename)
+          size = 0
+          started = time.time()
+      log.flush()
+      if (
+        config.LOG_ROTATE_INTERVAL
+    and time.time() - started >= config.LOG_ROTATE_INTERVAL
+      ):
+        log = reopen(log, filename)
+        size = 0
+        started = time.time()
+    except OSError as e:
+      print("Error writing to log {}: {}".format(filename, e), file=sys.stderr)
+  log.close()
+
+def reopen(log, filename):
+  """
+  Closes and rotates the given log, returning a new one.
+  """
+  log.close()
+  rotate(filename)
+  return open(filename, 'a')
+
+def log_started(filename):
+  """
+  Returns when the current log was started, so that a restart doesn't put
+  off time-based rotation: when the previous log was rotated (the
+  modification time of backup 1), or else the log's creation time if the
+  system records it, or else now.
+  """
+  try:
+    return os.path.getmtime(backup_name(filename, 1))
+  except OSError:
+    pass
+  return getattr(os.stat(filename), "st_birthtime", time.time())
+
+def backup_name(filename, n):
+  return "{}.{}{}".format(filename, n, ".gz" if config.LOG_COMPRESS else "")
+
+def rotate(filename):
+  """
+  Renames the log to filename.1 (compressing it if config.LOG_COMPRESS is
+  set), shifting older logs up by one and removing the ones beyond
+  config.LOG_BACKUPS.
+  """
+  if config.LOG_BACKUPS < 1:
+    os.remove(filename)
+    return
+  for n in range(config.LOG_BACKUPS - 1, 0, -1):
+    if os.path.exists(backup_name(filename, n)):
+      os.replace(backup_name(filename, n), backup_name(filename, n + 1))
+  if config.LOG_COMPRESS:
+    with open(filename, 'rb') as fin:
+      with gzip.open(backup_name(filename, 1), 'wb') as fout:
+        shutil.copyfileobj(fin, fout)
+    os.remove(filename)
+  else:
+    os.replace(filename, backup_name(filename, 1))